@@ -10,7 +10,7 @@ __authors__ = [
     ("Gary F. Egan", "gary.egan@monash.edu")]
 
 install_requires = [
-    'xnat>=0.3.17',
+    'xnat>=0.3.27',
     'nipype>=1.1.7',
     'pydicom>=1.0.2',
     'networkx>=2.2',
@@ -8,18 +8,19 @@ import os.path as op
 import types
 from copy import copy
 from logging import getLogger
-from nipype.interfaces.utility import IdentityInterface
+from concurrent.futures import ThreadPoolExecutor
+from tqdm import tqdm
 from arcana.pipeline import Pipeline
 from arcana.data import (
     BaseData, BaseInputMixin, BaseInputSpecMixin, FilesetFilter, FieldFilter,
     BaseFileset)
 from nipype.pipeline import engine as pe
 from .parameter import Parameter, SwitchSpec
-from arcana.repository.interfaces import RepositorySource
 from arcana.repository import Dataset
 from arcana.processor import SingleProc
 from arcana.environment import StaticEnv
-from arcana.utils import get_class_info, wrap_text
+from arcana.utils import (
+    get_class_info, wrap_text, ExitStack, BandwidthLimiter)
 from arcana.exceptions import (
     ArcanaMissingInputError, ArcanaNoConverterError, ArcanaDesignError,
     ArcanaCantPickleAnalysisError, ArcanaUsageError, ArcanaError,
@@ -343,20 +344,18 @@ class Analysis(object):
                     visit_ids = []
                 if session_ids is None:
                     session_ids = []
-                if spec.frequency == 'per_session':
-                    data = [d for d in data
-                            if (d.subject_id in subject_ids
-                                or d.visit_id in visit_ids
-                                or d.session_id in session_ids)]
-                elif spec.frequency == 'per_subject':
-                    data = [
-                        d for d in data
-                        if (d.subject_id in subject_ids
-                            or d.subject_id in [s[0] for s in session_ids])]
-                elif spec.frequency == 'per_visit':
-                    data = [d for d in data
-                            if (d.visit_id in visit_ids
-                                or d.visit_id in [s[1] for s in session_ids])]
+
+                def selected(subj_id, visit_id):
+                    # IDs not relevant to the frequency of the spec are None
+                    return (subj_id in subject_ids
+                            or visit_id in visit_ids
+                            or any((subj_id is None or subj_id == s)
+                                   and (visit_id is None or visit_id == v)
+                                   for s, v in session_ids))
+
+                # Only the selected items of slices over lazily constructed
+                # trees are resolved
+                data = data.select(selected)
                 if not data:
                     raise ArcanaUsageError(
                         "No matching data found (subject_ids={}, visit_ids={} "
@@ -1092,26 +1091,75 @@ class Analysis(object):
 
     def cache_inputs(self):
         """
-        Runs the Analysis's repository source node for each of the inputs
-        of the analysis, thereby caching any data required from remote
-        repositorys. Useful when launching many parallel jobs that will
-        all try to concurrently access the remote repository, and probably
-        lead to timeout errors.
+        Caches any data required from remote repositories for each of the
+        inputs of the analysis. Useful when launching many parallel jobs that
+        will all try to concurrently access the remote repository, and
+        probably lead to timeout errors. See 'prefetch' for finer control over
+        how the data is downloaded.
+        """
+        self.prefetch()
+
+    def prefetch(self, num_workers=4, max_bandwidth=None, input_names=None):
+        """
+        Downloads the input filesets of the analysis from remote repositories
+        to their local caches ahead of processing, using a bounded pool of
+        worker threads. Items are downloaded in the order the sessions will
+        be processed in, with summary (e.g. per_subject) items fetched before
+        the first session that requires them, so processing of the first
+        sessions can overlap with downloads of the later ones.
+
+        Parameters
+        ----------
+        num_workers : int
+            The maximum number of concurrent downloads
+        max_bandwidth : float | None
+            The maximum average download rate in MB/s across all workers. If
+            None the rate isn't limited
+        input_names : list[str] | None
+            The names of the inputs to prefetch. If None all inputs are
+            prefetched
         """
-        workflow = pe.Workflow(name='cache_download',
-                               base_dir=self.processor.work_dir)
-        subjects = pe.Node(IdentityInterface(['subject_id']), name='subjects',
-                           environment=self.environment)
-        sessions = pe.Node(IdentityInterface(['subject_id', 'visit_id']),
-                           name='sessions', environment=self.environment)
-        subjects.iterables = ('subject_id', tuple(self.subject_ids))
-        sessions.iterables = ('visit_id', tuple(self.visit_ids))
-        source = pe.Node(RepositorySource(
-            self.bound_spec(i).slice for i in self.inputs), name='source')
-        workflow.connect(subjects, 'subject_id', sessions, 'subject_id')
-        workflow.connect(sessions, 'subject_id', source, 'subject_id')
-        workflow.connect(sessions, 'visit_id', source, 'visit_id')
-        workflow.run()
+        if input_names is None:
+            inputs = self.inputs
+        else:
+            inputs = [self.input(n) for n in input_names]
+        # Determine the position of each session in the processing order and
+        # the first session that requires each summary item
+        order = {}
+        for subject_id in self.subject_ids:
+            for visit_id in self.visit_ids:
+                pos = len(order)
+                order[(subject_id, visit_id)] = pos
+                order.setdefault((subject_id, None), pos)
+                order.setdefault((None, visit_id), pos)
+        order[(None, None)] = -1
+        items = []
+        for inpt in inputs:
+            if not isinstance(inpt, BaseFileset):
+                continue  # Field values are loaded with the dataset tree
+            # Skip items that are already stored locally or cached
+            items.extend(i for i in self.bound_spec(inpt.name).slice
+                         if i.exists and i._path is None)
+        items.sort(key=lambda i: order.get((i.subject_id, i.visit_id),
+                                           len(order)))
+        if max_bandwidth is not None:
+            limiter = BandwidthLimiter(max_bandwidth * 1e6)
+        else:
+            limiter = None
+        with ExitStack() as stack:
+            # Hold a connection to each repository open for all workers
+            for repository in set(i.dataset.repository for i in items):
+                stack.enter_context(repository)
+                if limiter is not None:
+                    # Downloads are throttled chunk by chunk as they are
+                    # streamed from the repository
+                    stack.enter_context(repository.limit_bandwidth(limiter))
+            with ThreadPoolExecutor(max_workers=num_workers) as executor:
+                for _ in tqdm(executor.map(lambda i: i.get(), items),
+                              total=len(items),
+                              desc="Prefetching inputs of {}"
+                              .format(self.name)):
+                    pass
 
     @classmethod
     def print_specs(cls):
@@ -1175,7 +1223,13 @@ class Analysis(object):
         for input in self.inputs:
             inputs[input.name] = {
                 'dataset_index': input_datasets.index(input.dataset)}
-            if input.frequency == 'per_dataset':
+            if input.slice.lazy:
+                # Record the pattern instead of the names of the items
+                # matched in every node, which would load every node of a
+                # lazily constructed tree
+                inputs[input.name]['pattern'] = input.pattern
+                inputs[input.name]['is_regex'] = input.is_regex
+            elif input.frequency == 'per_dataset':
                 inputs[input.name]['names'] = next(input.slice).name
             elif input.frequency == 'per_subject':
                 inputs[input.name]['names'] = {i.subject_id: i.name
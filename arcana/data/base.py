@@ -6,12 +6,15 @@ from copy import copy
 from logging import getLogger
 from arcana.exceptions import ArcanaError
 from future.types import newstr
-from arcana.utils import PATH_SUFFIX, FIELD_SUFFIX, CHECKSUM_SUFFIX
+from arcana.utils import (
+    PATH_SUFFIX, FIELD_SUFFIX, CHECKSUM_SUFFIX, intern)
 logger = getLogger('arcana')
 
 
 class BaseData(object, metaclass=ABCMeta):
 
+    __slots__ = ('_name', '_frequency')
+
     VALID_FREQUENCIES = ('per_session', 'per_subject', 'per_visit',
                          'per_dataset')
 
@@ -23,8 +26,8 @@ class BaseData(object, metaclass=ABCMeta):
         if frequency not in self.VALID_FREQUENCIES:
             raise ArcanaError(
                 "Unrecognised frequency '{}'".format(frequency))
-        self._name = name
-        self._frequency = frequency
+        self._name = intern(name)
+        self._frequency = intern(frequency)
 
     def __eq__(self, other):
         return (self.basename == other.basename and
@@ -101,6 +104,8 @@ class BaseFileset(BaseData, metaclass=ABCMeta):
         A collection of BIDS attributes for the fileset or spec
     """
 
+    __slots__ = ('_format',)
+
     is_fileset = True
 
     def __init__(self, name, format=None, frequency='per_session'):
@@ -167,6 +172,8 @@ class BaseField(BaseData, metaclass=ABCMeta):
         Whether the field contains scalar or array data
     """
 
+    __slots__ = ('_dtype', '_array')
+
     is_field = True
 
     dtypes = (int, float, str)
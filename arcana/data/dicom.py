@@ -0,0 +1,292 @@
+"""
+Reads the DICOM header values used to select filesets by their DICOM tags
+(see the 'dicom_tags' argument of FilesetFilter), caching them so each
+series only needs to be read once
+"""
+import os
+import os.path as op
+import json
+import hashlib
+import pickle as pkl
+import logging
+from threading import Lock, get_ident
+from contextlib import ExitStack
+from concurrent.futures import ThreadPoolExecutor
+import pydicom
+from pydicom.tag import Tag
+from arcana.exceptions import ArcanaError
+
+
+logger = logging.getLogger('arcana')
+
+
+def read_dicom_header(fileset, tags, format=None):
+    """
+    Reads the values of DICOM header tags of a fileset. If the format of the
+    fileset defines a 'dicom_values' method, it is used to read the values.
+    Otherwise, where the fileset is stored in a remote repository that can
+    read DICOM headers server-side (e.g. XnatRepo.dicom_header) and it
+    hasn't been downloaded, the header is read on the server, or else the
+    header of the first file of the fileset is read up until the pixel data.
+
+    Parameters
+    ----------
+    fileset : Fileset
+        The fileset to read the header of
+    tags : list[tuple[str, str]]
+        The DICOM tags to read as 2-tuples of hex strings,
+        e.g. [('0020', '0011')]
+    format : FileFormat | None
+        The format to read the header with, if not the format of the fileset
+
+    Returns
+    -------
+    values : dict[tuple[str, str], object]
+        The values of the tags present in the header
+    complete : bool
+        Whether the values of all tags in the header were returned, rather
+        than just the requested tags
+    """
+    if format is None:
+        format = fileset.format
+    dicom_values = getattr(format, 'dicom_values', None)
+    if dicom_values is not None:
+        return dict(zip(tags, dicom_values(fileset, tags))), False
+    repository = (fileset.dataset.repository
+                  if fileset.dataset is not None else None)
+    if fileset._path is None and hasattr(repository, 'dicom_header'):
+        values = repository.dicom_header(fileset)
+        if not values:
+            raise ArcanaError(
+                "No DICOM tags retrieved from {} by {}".format(
+                    repository, fileset))
+        return values, True
+    path = fileset.path
+    if op.isdir(path):
+        fnames = sorted(f for f in os.listdir(path) if not f.startswith('.'))
+        dcm_fnames = [f for f in fnames if f.endswith('.dcm')] or fnames
+        if not dcm_fnames:
+            raise ArcanaError(
+                "Did not find any DICOM files in {} ('{}')".format(fileset,
+                                                                   path))
+        path = op.join(path, dcm_fnames[0])
+    dcm = pydicom.dcmread(path, stop_before_pixels=True,
+                          specific_tags=[Tag(t) for t in tags])
+    values = {}
+    for tag in tags:
+        try:
+            values[tag] = dcm[Tag(tag)].value
+        except KeyError:
+            pass
+    return values, False
+
+
+class DicomHeaderCache(object):
+    """
+    A cache of the DICOM header values of filesets, saved to disk if a
+    cache directory is provided. Filesets are keyed by their checksums if
+    they are already known, otherwise by their URI if they are stored in a
+    remote repository and haven't been downloaded, or by their path and
+    modification time
+
+    Parameters
+    ----------
+    cache_dir : str | None
+        The directory to save the header values in. If None, the values are
+        only cached in memory
+    num_workers : int
+        The number of headers to read concurrently in 'prefetch'
+    """
+
+    CACHE_DIR_NAME = 'dicom-headers'
+
+    # Caches shared between the filters of each dataset (see 'for_dataset')
+    _dataset_caches = {}
+    _dataset_caches_lock = Lock()
+
+    def __init__(self, cache_dir=None, num_workers=4):
+        self._cache_dir = cache_dir
+        self._num_workers = num_workers
+        self._entries = {}
+        self._lock = Lock()
+        if cache_dir is not None:
+            os.makedirs(cache_dir, exist_ok=True)
+
+    def __repr__(self):
+        return "{}(cache_dir={})".format(type(self).__name__,
+                                         self._cache_dir)
+
+    @property
+    def cache_dir(self):
+        return self._cache_dir
+
+    @classmethod
+    def for_dataset(cls, dataset):
+        """
+        Returns the header cache of a dataset, which is saved in the cache
+        directory of the repository if it has one (e.g. XnatRepo) and kept in
+        memory otherwise
+        """
+        try:
+            cache_dir = op.join(
+                dataset.repository.dataset_cache_dir(dataset.name),
+                cls.CACHE_DIR_NAME)
+        except AttributeError:
+            cache_dir = None
+        key = (cache_dir if cache_dir is not None
+               else (dataset.repository, dataset.name))
+        with cls._dataset_caches_lock:
+            try:
+                cache = cls._dataset_caches[key]
+            except KeyError:
+                cache = cls._dataset_caches[key] = cls(cache_dir)
+        return cache
+
+    @classmethod
+    def key(cls, fileset):
+        "The key the header values of the fileset are cached under"
+        if fileset._checksums is not None:
+            key = 'checksums:' + json.dumps(
+                sorted(fileset._checksums.items()))
+        elif fileset._path is None and fileset.uri is not None:
+            key = 'uri:{}{}'.format(
+                getattr(fileset.dataset.repository, 'server', ''),
+                fileset.uri)
+        else:
+            path = fileset.path
+            if op.isdir(path):
+                # Include the files so modifications in-place are detected
+                mtime = max([op.getmtime(path)]
+                            + [op.getmtime(op.join(path, f))
+                               for f in os.listdir(path)])
+            else:
+                mtime = op.getmtime(path)
+            key = 'path:{}:{}'.format(path, mtime)
+        return hashlib.sha1(key.encode()).hexdigest()
+
+    def values(self, fileset, tags, format=None):
+        """
+        Returns the values of DICOM tags in the header of a fileset, reading
+        the header if the values haven't been cached
+
+        Parameters
+        ----------
+        fileset : Fileset
+            The fileset to return the header values of
+        tags : list[tuple[str, str]]
+            The DICOM tags to return the values of as 2-tuples of hex
+            strings, e.g. [('0020', '0011')]
+        format : FileFormat | None
+            The format to read the header with (see read_dicom_header), if
+            not the format of the fileset
+
+        Returns
+        -------
+        values : list[object]
+            The values of the tags in the order they were requested
+        """
+        values = self._header(fileset, tags, format)
+        try:
+            return [values[t] for t in tags]
+        except KeyError as e:
+            raise ArcanaError("{} does not have dicom tag {}".format(
+                fileset, str(e)))
+
+    def prefetch(self, filesets, tags, format=None):
+        """
+        Reads the headers of filesets that haven't been cached concurrently,
+        so they don't need to be read one at a time when they are matched
+
+        Parameters
+        ----------
+        filesets : list[Fileset]
+            The filesets to read the headers of
+        tags : list[tuple[str, str]]
+            The DICOM tags to read as 2-tuples of hex strings
+        format : FileFormat | None
+            The format to read the headers with (see read_dicom_header), if
+            not the formats of the filesets
+        """
+        filesets = list(filesets)
+        if not filesets:
+            return
+        with ExitStack() as stack:
+            # Hold a connection to each repository open for all workers
+            for repository in set(f.dataset.repository for f in filesets
+                                  if f.dataset is not None):
+                stack.enter_context(repository)
+            with ThreadPoolExecutor(
+                    max_workers=self._num_workers) as executor:
+                for fileset, error in zip(filesets, executor.map(
+                        lambda f: self._try_header(f, tags, format),
+                        filesets)):
+                    if error is not None:
+                        # Raised again when the fileset is matched
+                        logger.debug("Could not prefetch DICOM header of {}:"
+                                     " {}".format(fileset, error))
+
+    def lookup(self, fileset, tags):
+        """
+        Returns the cached header values of a fileset, or None if they
+        haven't all been cached
+        """
+        entry = self._entry(self.key(fileset))
+        if entry is None:
+            return None
+        values, read_tags = entry
+        if read_tags is not None and not read_tags.issuperset(tags):
+            return None
+        return values
+
+    def _try_header(self, fileset, tags, format):
+        try:
+            self._header(fileset, tags, format)
+        except Exception as e:  # pylint: disable=broad-except
+            return e
+        return None
+
+    def _header(self, fileset, tags, format=None):
+        key = self.key(fileset)
+        entry = self._entry(key)
+        if entry is not None:
+            values, read_tags = entry
+            if read_tags is None or read_tags.issuperset(tags):
+                return values
+        values, complete = read_dicom_header(fileset, tags, format)
+        read_tags = None if complete else frozenset(tags)
+        with self._lock:
+            prev = self._entries.get(key)
+            if not complete and prev is not None:
+                # Combine with the values of tags read previously
+                prev_values, prev_read_tags = prev
+                values = dict(list(prev_values.items())
+                              + list(values.items()))
+                read_tags = (None if prev_read_tags is None
+                             else prev_read_tags | read_tags)
+            entry = self._entries[key] = (values, read_tags)
+        self._save(key, entry)
+        return values
+
+    def _entry(self, key):
+        try:
+            return self._entries[key]
+        except KeyError:
+            pass
+        if self._cache_dir is None:
+            return None
+        try:
+            with open(op.join(self._cache_dir, key + '.pkl'), 'rb') as f:
+                entry = pkl.load(f)
+        except (IOError, EOFError, pkl.UnpicklingError):
+            return None
+        with self._lock:
+            return self._entries.setdefault(key, entry)
+
+    def _save(self, key, entry):
+        if self._cache_dir is None:
+            return
+        path = op.join(self._cache_dir, key + '.pkl')
+        tmp_path = '{}.{}-{}.tmp'.format(path, os.getpid(), get_ident())
+        with open(tmp_path, 'wb') as f:
+            pkl.dump(entry, f)
+        os.replace(tmp_path, path)
@@ -1,13 +1,15 @@
 from builtins import object
 import os
 import os.path as op
+import stat
 from collections import defaultdict
 from arcana.exceptions import (
     ArcanaUsageError, ArcanaNoConverterError, ArcanaFileFormatError,
     ArcanaNameError)
 from nipype.interfaces.utility import IdentityInterface
 from arcana.utils.interfaces import (
-    ZipDir, UnzipDir, TarGzDir, UnTarGzDir)
+    ZipDir, UnzipDir, TarGzDir, UnTarGzDir, NativeZipDir, NativeUnzipDir,
+    NativeTarGzDir, NativeUnTarGzDir)
 from arcana.utils import split_extension
 import logging
 
@@ -46,6 +48,12 @@ class FileFormat(object):
         saved by format name, e.g. XNAT, instead of a file with an extension)
     """
 
+    # Memoised results of 'detect' and the extension lookups of sets of
+    # candidate formats it uses
+    MAX_DETECTED = 100000
+    _detected = {}
+    _extension_indices = {}
+
     def __init__(self, name, extension=None, desc='',
                  directory=False, within_dir_exts=None,
                  aux_files=None, resource_names=None):
@@ -303,6 +311,88 @@ class FileFormat(object):
             else:
                 return False
 
+    @classmethod
+    def detect(cls, fileset, candidates):
+        """
+        Returns the first of the candidate formats that matches the fileset
+        (see 'matches'), or None if none of them match.
+
+        Results are memoised by the path and modification time of the
+        fileset along with the candidates, so the contents of directories
+        and potential auxiliary files are only scanned once. Files without
+        auxiliary files are matched by their extension alone, so only need
+        to be stat'ed.
+
+        Parameters
+        ----------
+        fileset : Fileset
+            The fileset to detect the format of
+        candidates : Sequence[FileFormat]
+            The formats to select from, in order of preference
+
+        Returns
+        -------
+        file_format : FileFormat | None
+            The first candidate that matches the fileset
+        """
+        candidates = tuple(candidates)
+        if fileset._resource_name is not None:
+            # Matched by resource name, without any filesystem calls
+            return next((c for c in candidates if c.matches(fileset)), None)
+        path = fileset.path
+        try:
+            path_stat = os.stat(path)
+        except OSError:
+            return None  # Neither a file or directory so can't match
+        aux_files = fileset._potential_aux_files
+        key = (path, path_stat.st_mtime_ns,
+               tuple(aux_files) if aux_files is not None else None,
+               candidates)
+        try:
+            return cls._detected[key]
+        except KeyError:
+            pass
+        index = None
+        if stat.S_ISREG(path_stat.st_mode) and not aux_files:
+            index = cls._extension_index(candidates)
+        if index is not None:
+            file_format = index.get(split_extension(path)[1].lower())
+        else:
+            file_format = next(
+                (c for c in candidates if c.matches(fileset)), None)
+        if len(cls._detected) >= cls.MAX_DETECTED:
+            cls._detected.clear()
+        cls._detected[key] = file_format
+        return file_format
+
+    @classmethod
+    def _extension_index(cls, candidates):
+        """
+        Returns a dictionary mapping file extensions to the first of the
+        candidate formats that matches a file with that extension (and no
+        auxiliary files), or None if any of the candidates override how
+        they are matched
+        """
+        try:
+            return cls._extension_indices[candidates]
+        except KeyError:
+            pass
+        index = {}
+        for candidate in candidates:
+            candidate_type = type(candidate)
+            if (getattr(candidate_type, 'matches', None) is not
+                    FileFormat.matches
+                    or getattr(candidate_type, 'assort_files', None) is not
+                    FileFormat.assort_files):
+                index = None
+                break
+            # Directory formats can't match files and formats with
+            # auxiliary files can't match files without them
+            if not candidate.directory and not candidate.aux_files:
+                index.setdefault(candidate.ext, candidate)
+        cls._extension_indices[candidates] = index
+        return index
+
     def set_converter(self, file_format, converter):
         """
         Register a Converter and the FileFormat that it is able to convert from
@@ -426,6 +516,11 @@ class Converter(object):
     def wall_time(self):
         return self._wall_time
 
+    @property
+    def n_procs(self):
+        "The number of threads the conversion node runs on"
+        return 1
+
     def __repr__(self):
         return "{}(input_format={}, output_format={})".format(
             type(self).__name__, self.input_format, self.output_format)
@@ -439,34 +534,108 @@ class IdentityConverter(Converter):
     output = 'i'
 
 
-class UnzipConverter(Converter):
+class ArchiveConverter(Converter):
+    """
+    Base class for converters to and from archives. By default archives are
+    created and extracted in-process with 'zipfile'/'tarfile', avoiding a
+    process spawn per conversion, but the command line tools can be used
+    instead by setting 'native' to False
+
+    Parameters
+    ----------
+    input_format : FileFormat
+        The input format to convert from
+    output_format : FileFormat
+        The output format to convert to
+    native : bool
+        Whether to create/extract the archive in-process instead of with the
+        command line tools (e.g. 'zip' and 'tar')
+    """
 
-    interface = UnzipDir()
     mem_gb = 12
+    native_interface = None  # To be overridden by subclasses
+    command_interface = None
+
+    def __init__(self, input_format, output_format, native=True, **kwargs):
+        super(ArchiveConverter, self).__init__(input_format, output_format,
+                                               **kwargs)
+        self._native = native
+
+    @property
+    def native(self):
+        return self._native
+
+    @property
+    def interface(self):
+        if self._native:
+            return self.native_interface()  # pylint: disable=not-callable
+        return self.command_interface()  # pylint: disable=not-callable
+
+
+class UnzipConverter(ArchiveConverter):
+
+    native_interface = NativeUnzipDir
+    command_interface = UnzipDir
     input = 'zipped'
     output = 'unzipped'
 
 
-class ZipConverter(Converter):
+class ZipConverter(ArchiveConverter):
 
-    interface = ZipDir()
-    mem_gb = 12
+    native_interface = NativeZipDir
+    command_interface = ZipDir
     input = 'dirname'
     output = 'zipped'
 
 
-class TarGzConverter(Converter):
+class TarGzConverter(ArchiveConverter):
+    """
+    Converts a directory into a tar_gz archive
 
-    interface = TarGzDir()
-    mem_gb = 12
+    Parameters
+    ----------
+    input_format : FileFormat
+        The input format to convert from
+    output_format : FileFormat
+        The output format to convert to
+    native : bool
+        Whether to create the archive in-process instead of with 'tar'
+    num_threads : int
+        The number of threads to compress the archive with when it is
+        created in-process
+    """
+
+    native_interface = NativeTarGzDir
+    command_interface = TarGzDir
     input = 'dirname'
     output = 'zipped'
 
+    def __init__(self, input_format, output_format, num_threads=1,
+                 **kwargs):
+        super(TarGzConverter, self).__init__(input_format, output_format,
+                                             **kwargs)
+        self._num_threads = num_threads
 
-class UnTarGzConverter(Converter):
+    @property
+    def num_threads(self):
+        return self._num_threads
 
-    interface = UnTarGzDir()
-    mem_gb = 12
+    @property
+    def n_procs(self):
+        return self._num_threads if self._native else 1
+
+    @property
+    def interface(self):
+        interface = super(TarGzConverter, self).interface
+        if self._native:
+            interface.inputs.num_threads = self._num_threads
+        return interface
+
+
+class UnTarGzConverter(ArchiveConverter):
+
+    native_interface = NativeUnTarGzDir
+    command_interface = UnTarGzDir
     input = 'gzipped'
     output = 'gunzipped'
 
@@ -1,14 +1,16 @@
 from builtins import object
 from past.builtins import basestring
-import re
 from copy import copy
 from itertools import chain
+from functools import partial
 from arcana.exceptions import (
     ArcanaUsageError, ArcanaInputError,
     ArcanaInputMissingMatchError, ArcanaNotBoundToAnalysisError)
 from .base import BaseFileset, BaseField
+from .file_format import FileFormat
 from .item import Fileset, Field
 from .slice import FilesetSlice, FieldSlice
+from .dicom import DicomHeaderCache
 
 
 class BaseInputMixin(object):
@@ -209,32 +211,22 @@ class BaseInputMixin(object):
             assert False, "Unrecognised frequency '{}'".format(self.frequency)
         return nodes
 
+    def _defer_match(self, tree):
+        """
+        Whether matching against the nodes of the tree can be deferred until
+        the items of the slice are accessed, so nodes of lazily constructed
+        trees are only loaded if they are used. Inputs that are dropped if
+        they are missing need to be matched up front
+        """
+        return tree.lazy and not self.drop_if_missing
+
     def _match(self, tree, item_cls, **kwargs):
         matches = []
         errors = []
         for node in self.nodes(tree):
             try:
-                try:
-                    matches.append(self.match_node(node, **kwargs))
-                except ArcanaInputMissingMatchError as e:
-                    if self._fallback is not None:
-                        matches.append(self._fallback.slice.item(
-                            subject_id=node.subject_id,
-                            visit_id=node.visit_id))
-                    elif self.skip_missing:
-                        # Insert a non-existant item placeholder in-place of
-                        # the the missing item
-                        matches.append(item_cls(
-                            self.name,
-                            frequency=self.frequency,
-                            subject_id=node.subject_id,
-                            visit_id=node.visit_id,
-                            dataset=self.analysis.dataset,
-                            from_analysis=self.from_analysis,
-                            exists=False,
-                            **self._specific_kwargs))
-                    else:
-                        raise e
+                matches.append(self._match_or_fallback(node, item_cls,
+                                                       **kwargs))
             except ArcanaInputError as e:
                 errors.append(e)
         # Collate potentially multiple errors into a single error message
@@ -247,6 +239,30 @@ class BaseInputMixin(object):
             raise ErrorClass('\n'.join(str(e) for e in errors))
         return matches
 
+    def _match_or_fallback(self, node, item_cls, **kwargs):
+        try:
+            match = self.match_node(node, **kwargs)
+        except ArcanaInputMissingMatchError as e:
+            if self._fallback is not None:
+                match = self._fallback.slice.item(
+                    subject_id=node.subject_id,
+                    visit_id=node.visit_id)
+            elif self.skip_missing:
+                # Insert a non-existant item placeholder in-place of
+                # the the missing item
+                match = item_cls(
+                    self.name,
+                    frequency=self.frequency,
+                    subject_id=node.subject_id,
+                    visit_id=node.visit_id,
+                    dataset=self.analysis.dataset,
+                    from_analysis=self.from_analysis,
+                    exists=False,
+                    **self._specific_kwargs)
+            else:
+                raise e
+        return match
+
     def match_node(self, node, **kwargs):
         # Get names matching pattern
         matches = self._filtered_matches(node, **kwargs)
@@ -312,7 +328,8 @@ class FilesetFilter(BaseInputMixin, BaseFileset):
     dicom_tags : dct(str | str)
         To be used to distinguish multiple filesets that match the
         pattern in the same session. The provided DICOM values dicom
-        header values must match exactly.
+        header values must match exactly. The headers are read in parallel
+        and cached (see arcana.data.dicom.DicomHeaderCache).
     from_analysis : str
         The name of the analysis that generated the derived fileset to match.
         Is used to determine the location of the filesets in the
@@ -413,6 +430,17 @@ class FilesetFilter(BaseInputMixin, BaseFileset):
                     "'valid_formats' need to be provided to the 'match' "
                     "method if the FilesetFilter ({}) doesn't specify a format"
                     .format(self))
+        if self._defer_match(tree) and len(valid_formats) == 1:
+            # The filesets are matched as the nodes are accessed, with their
+            # DICOM headers read individually rather than prefetched
+            return FilesetSlice(
+                self.name, self.nodes(tree), format=valid_formats[0],
+                frequency=self.frequency,
+                resolve=partial(self._match_or_fallback, item_cls=Fileset,
+                                valid_formats=valid_formats, **kwargs))
+        if self.dicom_tags is not None:
+            kwargs['candidates'] = self._prefetch_dicom_headers(
+                tree, valid_formats)
         # Run the match against the tree
         return FilesetSlice(self.name,
                             self._match(
@@ -446,15 +474,53 @@ class FilesetFilter(BaseInputMixin, BaseFileset):
     def dicom_tags(self):
         return self._dicom_tags
 
-    def _filtered_matches(self, node, valid_formats=None, **kwargs):  # noqa: E501 @UnusedVariable
+    def _filtered_matches(self, node, valid_formats=None, candidates=None,
+                          **kwargs):  # noqa: E501 @UnusedVariable
+        if candidates is None:
+            matches = self._candidate_matches(node, valid_formats)
+        else:
+            # Reuse the candidates found when the DICOM headers were
+            # prefetched
+            matches = candidates[(node.subject_id, node.visit_id)]
+            if isinstance(matches, ArcanaInputMissingMatchError):
+                raise matches
+        # Filter matches by dicom tags
+        if self.dicom_tags is not None:
+            format = self._dicom_format
+            filtered = []
+            keys, ref_values = zip(*self.dicom_tags.items())
+            header_cache = DicomHeaderCache.for_dataset(node.tree.dataset)
+            for fileset in matches:
+                values = tuple(header_cache.values(fileset, keys,
+                                                   format=format))
+                if ref_values == values:
+                    filtered.append(fileset)
+            if not filtered:
+                raise ArcanaInputMissingMatchError(
+                    "Did not find filesets names matching pattern {}"
+                    "that matched DICOM tags {} in {}. Found:\n    {}"
+                    .format(self.pattern, self.dicom_tags,
+                            '\n    '.join(str(m) for m in matches), node))
+            matches = filtered
+        return matches
+
+    @property
+    def _dicom_format(self):
+        "The format used to read the DICOM headers of the matches"
+        if self.valid_formats is None or len(self.valid_formats) != 1:
+            raise ArcanaUsageError(
+                "Can only match header tags if exactly one valid format "
+                "is specified ({})".format(self.valid_formats))
+        return self.valid_formats[0]
+
+    def _candidate_matches(self, node, valid_formats):
+        """
+        Returns the filesets in the node that match the filter, apart from
+        its DICOM tags
+        """
         if self.pattern is not None:
-            if self.is_regex:
-                pattern_re = re.compile(self.pattern)
-                matches = [f for f in node.filesets
-                           if pattern_re.match(f.basename)]
-            else:
-                matches = [f for f in node.filesets
-                           if f.basename == self.pattern]
+            matches = node.matching_items('fileset', self.pattern,
+                                          self.is_regex)
         else:
             matches = list(node.filesets)
         if not matches:
@@ -484,7 +550,8 @@ class FilesetFilter(BaseInputMixin, BaseFileset):
             matches = filtered
         if valid_formats is not None:
             format_matches = [
-                m for m in matches if any(f.matches(m) for f in valid_formats)]
+                m for m in matches
+                if FileFormat.detect(m, valid_formats) is not None]
             if not format_matches:
                 for f in matches:
                     self.format.matches(f)
@@ -494,28 +561,32 @@ class FilesetFilter(BaseInputMixin, BaseFileset):
                     .format(self, node,
                             '\n    '.join(str(f) for f in matches)))
             matches = format_matches
-        # Filter matches by dicom tags
-        if self.dicom_tags is not None:
-            if self.valid_formats is None or len(self.valid_formats) != 1:
-                raise ArcanaUsageError(
-                    "Can only match header tags if exactly one valid format "
-                    "is specified ({})".format(self.valid_formats))
-            format = self.valid_formats[0]
-            filtered = []
-            for fileset in matches:
-                keys, ref_values = zip(*self.dicom_tags.items())
-                values = tuple(format.dicom_values(fileset, keys))
-                if ref_values == values:
-                    filtered.append(fileset)
-            if not filtered:
-                raise ArcanaInputMissingMatchError(
-                    "Did not find filesets names matching pattern {}"
-                    "that matched DICOM tags {} in {}. Found:\n    {}"
-                    .format(self.pattern, self.dicom_tags,
-                            '\n    '.join(str(m) for m in matches), node))
-            matches = filtered
         return matches
 
+    def _prefetch_dicom_headers(self, tree, valid_formats):
+        """
+        Reads the DICOM headers of all candidate filesets in the tree in
+        parallel before they are matched against the DICOM tags
+
+        Returns
+        -------
+        candidates : dict[tuple[str, str], list[Fileset] | Exception]
+            The candidate filesets of each node by its subject and visit IDs,
+            or the error raised if there weren't any, so they don't need to
+            be found again when the nodes are matched
+        """
+        candidates = {}
+        for node in self.nodes(tree):
+            try:
+                matches = self._candidate_matches(node, valid_formats)
+            except ArcanaInputMissingMatchError as e:
+                matches = e  # Raised when the node is matched
+            candidates[(node.subject_id, node.visit_id)] = matches
+        DicomHeaderCache.for_dataset(tree.dataset).prefetch(
+            chain(*(m for m in candidates.values() if isinstance(m, list))),
+            list(self.dicom_tags), format=self._dicom_format)
+        return candidates
+
     def cache(self):
         """
         Forces the cache of the input fileset. Can be useful for before running
@@ -602,6 +673,15 @@ class FieldFilter(BaseInputMixin, BaseField):
                 BaseInputMixin.__eq__(self, other))
 
     def match(self, tree, **kwargs):
+        if (self._defer_match(tree) and self._analysis is not None
+                and self.dtype is not None):
+            # The fields are matched as the nodes are accessed
+            return FieldSlice(
+                self.name, self.nodes(tree), frequency=self.frequency,
+                dtype=self.dtype,
+                array=self.analysis.data_spec(self.name).array,
+                resolve=partial(self._match_or_fallback, item_cls=Field,
+                                **kwargs))
         # Run the match against the tree
         return FieldSlice(self.name,
                           self._match(tree, Field, **kwargs),
@@ -628,13 +708,7 @@ class FieldFilter(BaseInputMixin, BaseField):
         return dct
 
     def _filtered_matches(self, node, **kwargs):
-        if self.is_regex:
-            pattern_re = re.compile(self.pattern)
-            matches = [f for f in node.fields
-                       if pattern_re.match(f.name)]
-        else:
-            matches = [f for f in node.fields
-                       if f.name == self.pattern]
+        matches = node.matching_items('field', self.pattern, self.is_regex)
         if self.from_analysis is not None:
             matches = [f for f in matches
                        if f.from_analysis == self.from_analysis]
@@ -2,27 +2,31 @@ from past.builtins import basestring
 import os
 from itertools import chain
 import os.path as op
-import hashlib
-from arcana.utils import split_extension, parse_value
+import shutil
+from arcana.utils import (
+    split_extension, parse_value, intern, DEFAULT_CHECKSUM_ALGORITHM,
+    format_checksum, checksum_algorithm, FileHasher, staging_dir, swap_in)
 from arcana.exceptions import (
     ArcanaError, ArcanaFileFormatError, ArcanaUsageError, ArcanaNameError,
     ArcanaDataNotDerivedYetError)
 from .file_format import FileFormat
 from .base import BaseFileset, BaseField
 
-HASH_CHUNK_SIZE = 2 ** 20  # 1MB
-
 
 class BaseItemMixin(object):
 
+    # Attributes are stored in the slots of the concrete item classes, as
+    # the mixin can't declare non-empty slots alongside BaseFileset|BaseField
+    __slots__ = ()
+
     is_spec = False
 
     def __init__(self, subject_id, visit_id, dataset, from_analysis,
                  exists, record):
-        self._subject_id = subject_id
-        self._visit_id = visit_id
+        self._subject_id = intern(subject_id)
+        self._visit_id = intern(visit_id)
         self._dataset = dataset
-        self._from_analysis = from_analysis
+        self._from_analysis = intern(from_analysis)
         self._exists = exists
         self._record = record
 
@@ -178,13 +182,25 @@ class Fileset(BaseItemMixin, BaseFileset):
         is matched to.
     quality : str
         The quality label assigned to the fileset (e.g. as is saved on XNAT)
+    modified : str | None
+        A stamp listed by remote repositories that changes when the files
+        of the fileset are modified (e.g. the file count, size and
+        modification time of XNAT resources). Used to fingerprint filesets
+        that haven't been downloaded
     """
 
+    # Slots are used instead of a __dict__ to reduce the memory footprint of
+    # large data trees
+    __slots__ = ('_subject_id', '_visit_id', '_dataset', '_from_analysis',
+                 '_exists', '_record', '_path', '_aux_files', '_uri', '_id',
+                 '_checksums', '_resource_name', '_quality',
+                 '_potential_aux_files', '_rehashed_checksums', '_modified')
+
     def __init__(self, name, format=None, frequency='per_session',
                  path=None, aux_files=None, id=None, uri=None, subject_id=None,
                  visit_id=None, dataset=None, from_analysis=None,
                  exists=True, checksums=None, record=None, resource_name=None,
-                 potential_aux_files=None, quality=None):
+                 potential_aux_files=None, quality=None, modified=None):
         BaseFileset.__init__(self, name=name, format=format,
                              frequency=frequency)
         BaseItemMixin.__init__(self, subject_id, visit_id, dataset,
@@ -210,10 +226,12 @@ class Fileset(BaseItemMixin, BaseFileset):
         self._path = path
         self._aux_files = aux_files if aux_files is not None else {}
         self._uri = uri
-        self._id = id
+        self._id = intern(id)
         self._checksums = checksums
-        self._resource_name = resource_name
-        self._quality = quality
+        self._rehashed_checksums = None
+        self._resource_name = intern(resource_name)
+        self._quality = intern(quality)
+        self._modified = modified
         if potential_aux_files is not None and format is not None:
             raise ArcanaUsageError(
                 "Potential paths should only be provided to Fileset.__init__ "
@@ -235,8 +253,8 @@ class Fileset(BaseItemMixin, BaseFileset):
         of the format class that take the fileset as the first argument
         """
         try:
-            frmt = self.__dict__['_format']
-        except KeyError:
+            frmt = object.__getattribute__(self, '_format')
+        except AttributeError:
             frmt = None
         else:
             try:
@@ -370,8 +388,13 @@ class Fileset(BaseItemMixin, BaseFileset):
                     "('{}')".format("', '".join(aux_files.keys()),
                                     "', '".join(self.format.aux_files.keys())))
             self._aux_files = aux_files
-        self._checksums = self.calculate_checksums()
-        self.put()  # Push to dataset
+        self._checksums = None
+        self._rehashed_checksums = None
+        # Push to dataset. Repositories that copy the files calculate their
+        # checksums as they are copied so they only need to be read once
+        checksums = self.put()
+        self._checksums = (checksums if checksums is not None
+                           else self.calculate_checksums())
 
     @path.setter
     def path(self, path):
@@ -398,6 +421,12 @@ class Fileset(BaseItemMixin, BaseFileset):
     def quality(self):
         return self._quality
 
+    @property
+    def modified(self):
+        # Filesets in trees cached before the stamps were listed don't have
+        # the slot set
+        return getattr(self, '_modified', None)
+
     @format.setter
     def format(self, format):
         assert isinstance(format, FileFormat)
@@ -484,17 +513,63 @@ class Fileset(BaseItemMixin, BaseFileset):
                 self._checksums = self.calculate_checksums()
         return self._checksums
 
-    def calculate_checksums(self):
-        checksums = {}
-        for fpath in self.paths:
-            fhash = hashlib.md5()
-            with open(fpath, 'rb') as f:
-                # Calculate hash in chunks so we don't run out of memory for
-                # large files.
-                for chunk in iter(lambda: f.read(HASH_CHUNK_SIZE), b''):
-                    fhash.update(chunk)
-            checksums[op.relpath(fpath, self.path)] = fhash.hexdigest()
-        return checksums
+    @property
+    def checksum_algorithm(self):
+        """
+        The algorithm used to calculate the checksums of the fileset, as set
+        for the repository it is stored in
+        """
+        try:
+            return self.dataset.repository.checksum_algorithm
+        except AttributeError:
+            return DEFAULT_CHECKSUM_ALGORITHM
+
+    def calculate_checksums(self, algorithm=None):
+        """
+        Calculates the checksums of the files in the fileset
+
+        Parameters
+        ----------
+        algorithm : str | None
+            The algorithm to calculate the checksums with. If None the
+            algorithm of the repository the fileset is stored in is used
+
+        Returns
+        -------
+        checksums : dict[str, str]
+            The checksums of the files relative to the path of the fileset
+        """
+        if algorithm is None:
+            algorithm = self.checksum_algorithm
+        paths = list(self.paths)
+        # The files of multi-file filesets are hashed concurrently
+        digests = FileHasher.hash_files(paths, algorithm)
+        return {op.relpath(p, self.path): format_checksum(d, algorithm)
+                for p, d in zip(paths, digests)}
+
+    def checksums_as(self, algorithm):
+        """
+        Returns the checksums of the fileset calculated with the given
+        algorithm, so they can be compared with checksums saved in
+        provenance records by a different algorithm. The fileset is only
+        re-hashed if the algorithm differs from that of its checksums.
+
+        Parameters
+        ----------
+        algorithm : str | None
+            The algorithm of the checksums to compare with. If None the
+            checksums are returned as is
+        """
+        checksums = self.checksums
+        if algorithm is None or algorithm == checksum_algorithm(checksums):
+            return checksums
+        # Pickled trees from before re-hashed checksums were retained
+        rehashed = getattr(self, '_rehashed_checksums', None)
+        if rehashed is None:
+            rehashed = self._rehashed_checksums = {}
+        if algorithm not in rehashed:
+            rehashed[algorithm] = self.calculate_checksums(algorithm)
+        return rehashed[algorithm]
 
     @classmethod
     def from_path(cls, path, **kwargs):
@@ -529,12 +604,12 @@ class Fileset(BaseItemMixin, BaseFileset):
         if self._format is not None:
             raise ArcanaFileFormatError(
                 "Format has already been set for {}".format(self))
-        matches = [c for c in candidates if c.matches(self)]
-        if not matches:
+        file_format = FileFormat.detect(self, candidates)
+        if file_format is None:
             raise ArcanaFileFormatError(
                 "None of the candidate file formats ({}) match {}"
                 .format(', '.join(str(c) for c in candidates), self))
-        return matches[0]
+        return file_format
 
     def initkwargs(self):
         dct = BaseFileset.initkwargs(self)
@@ -547,6 +622,7 @@ class Fileset(BaseItemMixin, BaseFileset):
         dct['resource_name'] = self._resource_name
         dct['potential_aux_files'] = self._potential_aux_files
         dct['quality'] = self._quality
+        dct['modified'] = self._modified
         return dct
 
     def get(self):
@@ -556,7 +632,101 @@ class Fileset(BaseItemMixin, BaseFileset):
 
     def put(self):
         if self.dataset is not None and self._path is not None:
-            self.dataset.put_fileset(self)
+            return self.dataset.put_fileset(self)
+        return None
+
+    def transfer_to(self, target_path, method='copy', algorithm=None):
+        """
+        Transfers the files of the fileset to a new location and returns
+        their checksums. Files that are copied are hashed from the data as
+        it is copied, so each file is only read once. Auxiliary files are
+        transferred to their default paths relative to the new primary path.
+        Directories are transferred into a hidden staging directory next to
+        the target and then renamed into place, with any existing directory
+        deleted in the background, so the target is never partially written.
+
+        Parameters
+        ----------
+        target_path : str
+            The path to transfer the primary file or directory to
+        method : str
+            How the files are transferred, 'copy', 'reflink' (copy-on-write
+            clones where supported by the filesystem), 'hardlink' or 'move'.
+            Falls back to copying where the method isn't possible (e.g.
+            across filesystems). Moved filesets are updated to point to the
+            new location
+        algorithm : str | None
+            The algorithm to calculate the checksums with. If None the
+            algorithm of the repository the fileset is stored in is used
+
+        Returns
+        -------
+        checksums : dict[str, str]
+            The checksums of the files, as returned by 'calculate_checksums'
+        """
+        if algorithm is None:
+            algorithm = self.checksum_algorithm
+        if op.exists(target_path) and op.samefile(self.path, target_path):
+            return self.calculate_checksums(algorithm)
+        src_path = self.path
+        checksums = None
+        staging = None
+        renamed = False
+        if op.isdir(src_path):
+            # Directories are written alongside the target and swapped in
+            # once complete, so readers never see a partially written one
+            staging = staging_dir(target_path)
+            new_path = op.join(staging, 'new')
+            if method == 'move':
+                try:
+                    os.rename(src_path, new_path)
+                except OSError:
+                    pass  # E.g. across filesystems, so move files separately
+                else:
+                    renamed = True
+                    fpaths = [op.join(root, f)
+                              for root, _, files in os.walk(new_path)
+                              for f in files]
+                    checksums = {
+                        op.relpath(p, new_path): format_checksum(
+                            d, algorithm)
+                        for p, d in zip(fpaths, FileHasher.hash_files(
+                            fpaths, algorithm))}
+            if checksums is None:
+                transfers = []
+                for root, _, files in os.walk(src_path):
+                    target_root = op.normpath(
+                        op.join(new_path, op.relpath(root, src_path)))
+                    os.makedirs(target_root)
+                    transfers.extend(
+                        (op.join(root, f), op.join(target_root, f))
+                        for f in files)
+        else:
+            transfers = [(src_path, target_path)]
+            transfers.extend(
+                (self.aux_files[n], p) for n, p in
+                self.format.default_aux_file_paths(target_path).items())
+        try:
+            if checksums is None:
+                digests = FileHasher.transfer_files(transfers, algorithm,
+                                                    method)
+                checksums = {op.relpath(src, src_path): format_checksum(
+                    d, algorithm) for (src, _), d in zip(transfers, digests)}
+            if staging is not None:
+                swap_in(new_path, target_path, staging)
+        except BaseException:
+            if renamed:
+                os.rename(new_path, src_path)  # Restore the moved directory
+            if staging is not None:
+                shutil.rmtree(staging, ignore_errors=True)
+            raise
+        if method == 'move':
+            if op.isdir(src_path):
+                shutil.rmtree(src_path)  # Empty directories left after move
+            self._path = target_path
+            self._aux_files = dict(
+                self.format.default_aux_file_paths(target_path))
+        return checksums
 
     def contents_equal(self, other, **kwargs):
         """
@@ -573,7 +743,8 @@ class Fileset(BaseItemMixin, BaseFileset):
         if hasattr(self.format, 'contents_equal'):
             equal = self.format.contents_equal(self, other, **kwargs)
         else:
-            equal = (self.checksums == other.checksums)
+            equal = (self.checksums == other.checksums_as(
+                checksum_algorithm(self.checksums)))
         return equal
 
 
@@ -606,12 +777,19 @@ class Field(BaseItemMixin, BaseField):
     record : arcana.pipeline.provenance.Record | None
         The provenance record for the pipeline that generated the field,
         if applicable
+    modified : str | None
+        A stamp that changes when the binary file an array field is stored in
+        is modified (see Repository.binary_array_length). Used to fingerprint
+        fields whose values haven't been loaded
     """
 
+    __slots__ = ('_subject_id', '_visit_id', '_dataset', '_from_analysis',
+                 '_exists', '_record', '_value', '_modified')
+
     def __init__(self, name, value=None, dtype=None,
                  frequency='per_session', array=None, subject_id=None,
                  visit_id=None, dataset=None, from_analysis=None,
-                 exists=True, record=None):
+                 exists=True, record=None, modified=None):
         # Try to determine dtype and array from value if they haven't
         # been provided.
         if value is None:
@@ -651,6 +829,7 @@ class Field(BaseItemMixin, BaseField):
         BaseItemMixin.__init__(self, subject_id, visit_id, dataset,
                                from_analysis, exists, record)
         self._value = value
+        self._modified = modified
 
     def __eq__(self, other):
         return (BaseField.__eq__(self, other)
@@ -733,12 +912,34 @@ class Field(BaseItemMixin, BaseField):
 
     @value.setter
     def value(self, value):
+        self.set_value(value)
+
+    @property
+    def modified(self):
+        # Fields in trees cached before the stamps were recorded don't have
+        # the slot set
+        return getattr(self, '_modified', None)
+
+    def set_value(self, value, put=True):
+        """
+        Sets the value of the field
+
+        Parameters
+        ----------
+        value : int | float | str | list[int] | list[float] | list[str]
+            The value of the field
+        put : bool
+            Whether to put the value into the repository. Can be disabled so
+            the fields of a session can be put together (see
+            Dataset.put_fields)
+        """
         if self.array:
             self._value = [self.dtype(v) for v in value]
         else:
             self._value = self.dtype(value)
         self._exists = True
-        self.put()
+        if put:
+            self.put()
 
     @property
     def checksums(self):
@@ -748,14 +949,27 @@ class Field(BaseItemMixin, BaseField):
         """
         return self.value
 
+    def checksums_as(self, algorithm):  # pylint: disable=unused-argument
+        "For duck-typing with Fileset.checksums_as"
+        return self.checksums
+
     def initkwargs(self):
         dct = BaseField.initkwargs(self)
         dct.update(BaseItemMixin.initkwargs(self))
         dct['value'] = self.value
         return dct
 
-    def get(self):
-        if self.dataset is not None:
+    def get(self, refresh=False):
+        """
+        Retrieves the value of the field from the dataset
+
+        Parameters
+        ----------
+        refresh : bool
+            Whether to read the value from the dataset even if it has already
+            been loaded (e.g. when the field was found in the dataset tree)
+        """
+        if self.dataset is not None and (refresh or self._value is None):
             self._exists = True
             self._value = self.dataset.get_field(self)
 
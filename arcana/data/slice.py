@@ -3,7 +3,7 @@ from arcana.exceptions import (
     ArcanaError, ArcanaUsageError, ArcanaIndexError)
 from .base import BaseFileset, BaseField
 from .item import Fileset, Field
-from collections import OrderedDict
+from collections import OrderedDict, defaultdict
 from operator import itemgetter
 from itertools import chain
 
@@ -11,6 +11,30 @@ from itertools import chain
 DICOM_SERIES_NUMBER_TAG = ('0020', '0011')
 
 
+class _Unresolved(object):
+    """
+    Placeholder for an item of a slice over a lazily constructed tree (see
+    Tree.construct_lazy), which is resolved from its node the first time it
+    is accessed
+    """
+
+    __slots__ = ('node', 'tree')
+
+    def __init__(self, node):
+        self.node = node
+        # Nodes only hold weak references to their tree, which needs to be
+        # kept alive until the item is resolved
+        self.tree = node.tree
+
+    @property
+    def subject_id(self):
+        return self.node.subject_id
+
+    @property
+    def visit_id(self):
+        return self.node.visit_id
+
+
 class BaseSliceMixin(object):
     """
     Base class for slce of filesets and field items
@@ -22,8 +46,13 @@ class BaseSliceMixin(object):
     drop_if_missing = False
     derivable = False
 
-    def __init__(self, slce, frequency):
+    def __init__(self, slce, frequency, resolve=None):
         self._frequency = frequency
+        self._resolve = resolve
+        if resolve is not None:
+            # Store placeholders for the items of each node, which are
+            # resolved on first access
+            slce = [_Unresolved(n) for n in slce]
         if frequency == 'per_dataset':
             # If wrapped in an iterable
             if not isinstance(slce, self.SlicedClass):
@@ -35,12 +64,14 @@ class BaseSliceMixin(object):
                 slce = list(slce)
             self._slice = slce
         elif frequency == 'per_session':
-            self._slice = OrderedDict()
-            for subj_id in sorted(set(c.subject_id for c in slce)):
-                self._slice[subj_id] = OrderedDict(
-                    sorted(((c.visit_id, c) for c in slce
-                            if c.subject_id == subj_id),
-                           key=itemgetter(0)))
+            # Group the items by subject in a single pass
+            by_subject = defaultdict(list)
+            for c in slce:
+                by_subject[c.subject_id].append((c.visit_id, c))
+            self._slice = OrderedDict(
+                (subj_id, OrderedDict(sorted(by_subject[subj_id],
+                                             key=itemgetter(0))))
+                for subj_id in sorted(by_subject))
         elif frequency == 'per_subject':
             self._slice = OrderedDict(
                 sorted(((c.subject_id, c) for c in slce),
@@ -51,12 +82,16 @@ class BaseSliceMixin(object):
                        key=itemgetter(0)))
         else:
             assert False
-        for datum in self:
-            if not isinstance(datum, self.SlicedClass):
-                raise ArcanaUsageError(
-                    "Invalid class {} in {}".format(datum, self))
+        if resolve is None:
+            for datum in self:
+                self._check_class(datum)
 
     def __iter__(self):
+        if self._resolve is not None:
+            return (self._resolved(e) for e in self._entries())
+        return self._entries()
+
+    def _entries(self):
         if self._frequency == 'per_dataset':
             return iter(self._slice)
         elif self._frequency == 'per_session':
@@ -65,6 +100,40 @@ class BaseSliceMixin(object):
         else:
             return iter(self._slice.values())
 
+    def _check_class(self, datum):
+        if not isinstance(datum, self.SlicedClass):
+            raise ArcanaUsageError(
+                "Invalid class {} in {}".format(datum, self))
+
+    def _resolved(self, entry):
+        """
+        Resolves the item of a node in a lazily constructed slice the first
+        time it is accessed and stores it in place of the placeholder
+        """
+        if not isinstance(entry, _Unresolved):
+            return entry
+        node = entry.node
+        item = self._resolve(node)
+        self._check_class(item)
+        item = self._prepare(item)
+        if self._frequency == 'per_session':
+            self._slice[node.subject_id][node.visit_id] = item
+        elif self._frequency == 'per_subject':
+            self._slice[node.subject_id] = item
+        elif self._frequency == 'per_visit':
+            self._slice[node.visit_id] = item
+        else:
+            self._slice[0] = item
+        return item
+
+    def _prepare(self, item):
+        return item
+
+    @property
+    def lazy(self):
+        "Whether the items are resolved from their nodes on first access"
+        return self._resolve is not None
+
     def __len__(self):
         if self.frequency == 'per_session':
             ln = sum(len(d) for d in self._slice.values())
@@ -159,7 +228,122 @@ class BaseSliceMixin(object):
                 raise ArcanaIndexError(
                     0, ("'{}' Slice is empty so doesn't have a "
                         + "per_dataset node").format(self.name))
-        return fileset
+        return self._resolved(fileset)
+
+    def items(self, subject_ids=None, visit_ids=None):
+        """
+        Returns the items in the slice corresponding to each pair of subject
+        and visit IDs, i.e. the bulk equivalent of calling 'item' for each
+        pair. As with 'item', the IDs not relevant to the frequency of the
+        slice are ignored and can be omitted.
+
+        Parameter
+        ---------
+        subject_ids : Sequence[str] | None
+            The subject IDs of the items to return
+        visit_ids : Sequence[str] | None
+            The visit IDs of the items to return
+
+        Returns
+        -------
+        items : list[Fileset | Field]
+            The items corresponding to each pair of IDs
+        """
+        if subject_ids is None and visit_ids is None:
+            raise ArcanaUsageError(
+                "Either 'subject_ids' or 'visit_ids' must be provided to get "
+                "items from {}".format(self))
+        if subject_ids is None:
+            subject_ids = [None] * len(visit_ids)
+        elif visit_ids is None:
+            visit_ids = [None] * len(subject_ids)
+        elif len(subject_ids) != len(visit_ids):
+            raise ArcanaUsageError(
+                "Mismatching number of subject ({}) and visit ({}) IDs "
+                "provided to get items from {}".format(
+                    len(subject_ids), len(visit_ids), self))
+        slce = self._slice
+        try:
+            if self.frequency == 'per_session':
+                items = [slce[s][v] for s, v in zip(subject_ids, visit_ids)]
+            elif self.frequency == 'per_subject':
+                items = [slce[s] for s in subject_ids]
+            elif self.frequency == 'per_visit':
+                items = [slce[v] for v in visit_ids]
+            else:
+                items = [slce[0]] * len(subject_ids) if subject_ids else []
+        except (KeyError, IndexError):
+            # Let 'item' raise the appropriate error for the missing item
+            for subject_id, visit_id in zip(subject_ids, visit_ids):
+                self.item(subject_id, visit_id)
+            raise
+        if self._resolve is not None:
+            items = [self._resolved(i) for i in items]
+        return items
+
+    def select(self, condition):
+        """
+        Returns the items in the slice for which the condition is True,
+        without resolving the other items of lazily constructed slices
+
+        Parameter
+        ---------
+        condition : Callable[[str | None, str | None], bool]
+            Called with the subject and visit IDs of each item, where the
+            IDs that aren't relevant to the frequency of the slice are None
+
+        Returns
+        -------
+        items : list[Fileset | Field]
+            The items that satisfy the condition
+        """
+        if self.frequency == 'per_session':
+            entries = [e for subj_id, d in self._slice.items()
+                       for visit_id, e in d.items()
+                       if condition(subj_id, visit_id)]
+        elif self.frequency == 'per_subject':
+            entries = [e for subj_id, e in self._slice.items()
+                       if condition(subj_id, None)]
+        elif self.frequency == 'per_visit':
+            entries = [e for visit_id, e in self._slice.items()
+                       if condition(None, visit_id)]
+        else:
+            entries = list(self._slice) if condition(None, None) else []
+        return [self._resolved(e) for e in entries]
+
+    def subset(self, condition):
+        """
+        Returns a copy of the slice that only contains the items for which
+        the condition is True (see 'select'), with all of them resolved so
+        the copy can be pickled independently of the tree it was matched
+        against
+
+        Parameter
+        ---------
+        condition : Callable[[str | None, str | None], bool]
+            Called with the subject and visit IDs of each item, where the
+            IDs that aren't relevant to the frequency of the slice are None
+
+        Returns
+        -------
+        subset : FilesetSlice | FieldSlice
+            The slice containing the selected items
+        """
+        items = self.select(condition)
+        subset = copy(self)
+        subset._resolve = None
+        if self.frequency == 'per_session':
+            subset._slice = OrderedDict()
+            for item in items:
+                subset._slice.setdefault(item.subject_id, OrderedDict())[
+                    item.visit_id] = item
+        elif self.frequency == 'per_subject':
+            subset._slice = OrderedDict((i.subject_id, i) for i in items)
+        elif self.frequency == 'per_visit':
+            subset._slice = OrderedDict((i.visit_id, i) for i in items)
+        else:
+            subset._slice = items
+        return subset
 
     @property
     def slice(self):
@@ -232,12 +416,25 @@ class FilesetSlice(BaseSliceMixin, BaseFileset):
     format : FileFormat | None
         The file format of the slce (will be determined from filesets
         if not provided).
+    resolve : Callable[[TreeNode], Fileset] | None
+        If provided, 'slce' is an iterable of tree nodes and the fileset of
+        each node is only resolved by passing it to this function the first
+        time it is accessed. Both 'format' and 'frequency' must be provided
+        in this case
     """
 
     SlicedClass = Fileset
 
     def __init__(self, name, slce, format=None, frequency=None,
-                 candidate_formats=None):
+                 candidate_formats=None, resolve=None):
+        if resolve is not None:
+            if format is None or frequency is None:
+                raise ArcanaUsageError(
+                    "Both 'format' and 'frequency' need to be provided to "
+                    "lazily resolved FilesetSlice ('{}')".format(name))
+            BaseFileset.__init__(self, name, format, frequency=frequency)
+            BaseSliceMixin.__init__(self, slce, frequency, resolve=resolve)
+            return
         if format is None and candidate_formats is None:
             formats = set(d.format for d in slce)
             if len(formats) > 1:
@@ -264,18 +461,23 @@ class FilesetSlice(BaseSliceMixin, BaseFileset):
                     "Implicit frequency '{}' does not match explicit "
                     "frequency '{}' for '{}' FilesetSlice"
                     .format(implicit_frequency, frequency, name))
-            formatted_slice = []
-            for fileset in slce:
-                fileset = copy(fileset)
-                if fileset.exists and fileset.format is None:
-                    fileset.format = (fileset.detect_format(candidate_formats)
-                                      if format is None else format)
-                formatted_slice.append(fileset)
-            slce = formatted_slice
+            slce = [self._formatted(f, format, candidate_formats)
+                    for f in slce]
             format = self._common_attr(slce, 'format')
         BaseFileset.__init__(self, name, format, frequency=frequency)
         BaseSliceMixin.__init__(self, slce, frequency)
 
+    def _prepare(self, item):
+        return self._formatted(item, self.format)
+
+    @classmethod
+    def _formatted(cls, fileset, format, candidate_formats=None):
+        fileset = copy(fileset)
+        if fileset.exists and fileset.format is None:
+            fileset.format = (fileset.detect_format(candidate_formats)
+                              if format is None else format)
+        return fileset
+
     def path(self, subject_id=None, visit_id=None):
         return self.item(
             subject_id=subject_id, visit_id=visit_id).path
@@ -291,14 +493,19 @@ class FieldSlice(BaseSliceMixin, BaseField):
         Name of the slce
     slce : List[Fileset]
         An iterable of equivalent filesets
+    resolve : Callable[[TreeNode], Field] | None
+        If provided, 'slce' is an iterable of tree nodes and the field of
+        each node is only resolved by passing it to this function the first
+        time it is accessed. Both 'frequency' and 'dtype' must be provided
+        in this case
     """
 
     SlicedClass = Field
 
     def __init__(self, name, slce, frequency=None, dtype=None,
-                 array=None):
+                 array=None, resolve=None):
         slce = list(slce)
-        if slce:
+        if slce and resolve is None:
             implicit_frequency = self._common_attr(slce,
                                                    'frequency')
             if frequency is None:
@@ -334,7 +541,7 @@ class FieldSlice(BaseSliceMixin, BaseField):
                 "FieldSlice")
         BaseField.__init__(self, name, dtype=dtype, frequency=frequency,
                            array=array)
-        BaseSliceMixin.__init__(self, slce, frequency)
+        BaseSliceMixin.__init__(self, slce, frequency, resolve=resolve)
 
     def value(self, subject_id=None, visit_id=None):
         return self.item(subject_id=subject_id, visit_id=visit_id).value
@@ -2,6 +2,7 @@ from past.builtins import basestring
 from builtins import object
 from operator import attrgetter
 from copy import copy, deepcopy
+from functools import partial
 from arcana.exceptions import (
     ArcanaError, ArcanaUsageError,
     ArcanaOutputNotProducedException,
@@ -508,6 +509,12 @@ class FilesetSpec(BaseFileset, BaseSpecMixin):
         return fileset
 
     def _bind_tree(self, tree, **kwargs):
+        if tree.lazy:
+            # Only bind the nodes as they are accessed
+            self._slice = FilesetSlice(
+                self.name, self.nodes(tree), frequency=self.frequency,
+                format=self.format, resolve=partial(self._bind_node, **kwargs))
+            return
         self._slice = FilesetSlice(
             self.name,
             (self._bind_node(n, **kwargs) for n in self.nodes(tree)),
@@ -659,6 +666,13 @@ class FieldSpec(BaseField, BaseSpecMixin):
         return field
 
     def _bind_tree(self, tree, **kwargs):
+        if tree.lazy:
+            # Only bind the nodes as they are accessed
+            self._slice = FieldSlice(
+                self.name, self.nodes(tree), frequency=self.frequency,
+                dtype=self.dtype, array=self.array,
+                resolve=partial(self._bind_node, **kwargs))
+            return
         self._slice = FieldSlice(
             self.name,
             (self._bind_node(n, **kwargs) for n in self.nodes(tree)),
@@ -78,8 +78,12 @@ class NodeMixin(object):
 
     @property
     def prov(self):
+        # Record the interface wrapped by a conversion cache, so provenance
+        # doesn't depend on whether the conversion cache is enabled
+        interface = getattr(self.interface, 'wrapped_interface',
+                            self.interface)
         prov = {
-            'interface': get_class_info(type(self.interface)),
+            'interface': get_class_info(type(interface)),
             'requirements': {v.name: v.prov for v in self.versions},
             'parameters': {}}
         for trait_name in self.inputs.visible_traits():
@@ -15,7 +15,9 @@ from networkx import __version__ as networkx_version
 from nipype.pipeline import engine as pe
 from nipype.interfaces.utility import IdentityInterface
 from logging import getLogger
-from arcana.utils import extract_package_version
+from arcana.utils import (
+    extract_package_version, checksum_algorithm, get_class_info)
+from arcana.utils.interfaces import CachedInterface
 from arcana.__about__ import __version__
 from arcana.exceptions import (
     ArcanaDesignError, ArcanaError, ArcanaUsageError, ArcanaNoConverterError,
@@ -805,10 +807,11 @@ class Pipeline(object):
                         in_node = prev_conv_nodes[format.name] = self.add(
                             'conv_{}_to_{}_format'.format(input.name,
                                                           format.name),
-                            conv.interface,
+                            self._conversion_interface(conv, conv_kwargs),
                             inputs={conv.input: (inputnode, input.name)},
                             requirements=conv.requirements,
                             mem_gb=conv.mem_gb,
+                            n_procs=conv.n_procs,
                             wall_time=conv.wall_time)
                     try:
                         in_node_out = conv.output_aux(format.aux_name)
@@ -827,6 +830,23 @@ class Pipeline(object):
                     self.connect(inputnode, iterator, node, node_in)
         return inputnode
 
+    def _conversion_interface(self, converter, conv_kwargs):
+        """
+        Returns the interface of a converter of a pipeline input, wrapped so
+        its outputs are cached between pipelines and runs if the processor
+        has a conversion cache (see Processor.conversion_cache_dir)
+        """
+        interface = converter.interface
+        cache_dir = self.analysis.processor.conversion_cache_dir
+        if cache_dir is None:
+            return interface
+        return CachedInterface(
+            interface, converter.input, cache_dir,
+            key={'converter': get_class_info(type(converter)),
+                 'input_format': converter.input_format.name,
+                 'output_format': converter.output_format.name,
+                 'kwargs': conv_kwargs})
+
     def _make_outputnode(self, frequency):
         """
         Generates an output node for the given frequency. It also adds implicit
@@ -875,6 +895,7 @@ class Pipeline(object):
                     inputs={conv.input: (node, node_out)},
                     requirements=conv.requirements,
                     mem_gb=conv.mem_gb,
+                    n_procs=conv.n_procs,
                     wall_time=conv.wall_time)
                 node_out = conv.output
             self.connect(node, node_out, outputnode, output.name)
@@ -926,7 +947,7 @@ class Pipeline(object):
             'joined_ids': self._joined_ids()}
         return prov
 
-    def expected_record(self, node):
+    def expected_record(self, node, record=None):
         """
         Constructs the provenance record that would be saved in the given node
         if the pipeline was run on the current state of the repository
@@ -936,6 +957,11 @@ class Pipeline(object):
         node : arcana.repository.tree.TreeNode
             A node of the Tree representation of the analysis data stored in the
             repository (i.e. a Session, Visit, Subject or Tree node)
+        record : arcana.provenance.Record | None
+            The record saved in the node that the expected record will be
+            compared with. If provided, the checksums of filesets are
+            calculated with the same algorithms as the checksums saved in it
+            (re-hashing the filesets if necessary) so they can be compared
 
         Returns
         -------
@@ -943,11 +969,14 @@ class Pipeline(object):
             The record that would be produced if the pipeline is run over the
             analysis tree.
         """
+        recorded_inputs = record.inputs if record is not None else {}
+        recorded_outputs = record.outputs if record is not None else {}
         exp_inputs = {}
         # Get checksums/values of all inputs that would have been used in
         # previous runs of an equivalent pipeline to compare with that saved
         # in provenance to see if any have been updated.
         for inpt in self.inputs:
+            recorded = recorded_inputs.get(inpt.name)
             # Get iterators present in the input that aren't in this node
             # and need to be joined
             iterators_to_join = (self.iterators(inpt.frequency) -
@@ -956,30 +985,40 @@ class Pipeline(object):
                 # No iterators to join so we can just extract the checksums
                 # of the corresponding input
                 exp_inputs[inpt.name] = inpt.slice.item(
-                    node.subject_id, node.visit_id).checksums
+                    node.subject_id, node.visit_id).checksums_as(
+                        checksum_algorithm(recorded))
             elif len(iterators_to_join) == 1:
                 # Get list of checksums dicts for each node of the input
                 # frequency that relates to the current node
+                nodes = list(node.nodes(inpt.frequency))
                 exp_inputs[inpt.name] = [
-                    inpt.slice.item(n.subject_id, n.visit_id).checksums
-                    for n in node.nodes(inpt.frequency)]
+                    item.checksums_as(
+                        checksum_algorithm(_recorded_at(recorded, i)))
+                    for i, item in enumerate(inpt.slice.items(
+                        [n.subject_id for n in nodes],
+                        [n.visit_id for n in nodes]))]
             else:
                 # In the case where the node is the whole treee and the input
                 # is per_seession, we need to create a list of lists to match
                 # how the checksums are joined in the processor
                 exp_inputs[inpt.name] = []
-                for subj in node.subjects:
+                for i, subj in enumerate(node.subjects):
+                    sessions = list(subj.sessions)
+                    subj_recorded = _recorded_at(recorded, i)
                     exp_inputs[inpt.name].append([
-                        inpt.slice.item(s.subject_id,
-                                             s.visit_id).checksums
-                        for s in subj.sessions])
+                        item.checksums_as(checksum_algorithm(
+                            _recorded_at(subj_recorded, j)))
+                        for j, item in enumerate(inpt.slice.items(
+                            [s.subject_id for s in sessions],
+                            [s.visit_id for s in sessions]))])
         # Get checksums/value for all outputs of the pipeline. We are assuming
         # that they exist here (otherwise they will be None)
         exp_outputs = {}
         for output in self.outputs:
             try:
                 exp_outputs[output.name] = output.slice.item(
-                    node.subject_id, node.visit_id).checksums
+                    node.subject_id, node.visit_id).checksums_as(
+                        checksum_algorithm(recorded_outputs.get(output.name)))
             except ArcanaDataNotDerivedYetError:
                 pass
         exp_prov = copy(self.prov)
@@ -1003,3 +1042,13 @@ class Pipeline(object):
         if self.joins_visits:
             joined_prov['visit_ids'] = list(self.analysis.visit_ids)
         return joined_prov
+
+
+def _recorded_at(recorded, index):
+    """
+    Returns an element of a list of checksums saved in a provenance record, or
+    None if there isn't a corresponding element
+    """
+    if isinstance(recorded, list) and index < len(recorded):
+        return recorded[index]
+    return None
@@ -6,6 +6,7 @@ from pprint import pformat
 from datetime import datetime
 from deepdiff import DeepDiff
 from arcana.exceptions import ArcanaError, ArcanaUsageError
+from arcana.utils import intern
 from arcana.__about__ import install_requires
 
 
@@ -42,17 +43,20 @@ class Record(object):
         A dictionary containing the provenance recorded/to record
     """
 
+    __slots__ = ('_prov', '_pipeline_name', '_frequency', '_subject_id',
+                 '_visit_id', '_from_analysis')
+
     # For duck-typing with Filesets and Fields
     derived = True
 
     def __init__(self, pipeline_name, frequency, subject_id, visit_id,
                  from_analysis, prov):
         self._prov = deepcopy(prov)
-        self._pipeline_name = pipeline_name
-        self._frequency = frequency
-        self._subject_id = subject_id
-        self._visit_id = visit_id
-        self._from_analysis = from_analysis
+        self._pipeline_name = intern(pipeline_name)
+        self._frequency = intern(frequency)
+        self._subject_id = intern(subject_id)
+        self._visit_id = intern(visit_id)
+        self._from_analysis = intern(from_analysis)
         if 'datetime' not in self._prov:
             self._prov['datetime'] = datetime.now().isoformat()
 
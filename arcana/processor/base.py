@@ -5,13 +5,14 @@ import os.path as op
 from collections import defaultdict, OrderedDict
 import shutil
 from itertools import repeat
+from functools import partial
 from copy import copy, deepcopy
 from logging import getLogger
 import numpy as np
 from nipype.pipeline import engine as pe
 from nipype.interfaces.utility import IdentityInterface, Merge
 from arcana.repository.interfaces import RepositorySource, RepositorySink
-from arcana.utils import get_class_info
+from arcana.utils import get_class_info, checksum_algorithm
 from arcana.exceptions import (
     ArcanaMissingDataException,
     ArcanaNoRunRequiredException, ArcanaUsageError, ArcanaDesignError,
@@ -60,6 +61,15 @@ class Processor(object):
     default_mem_gb : float
         The default memory assumed to be required for nodes where it isn't
         specified
+    cache_conversions : bool
+        Whether to cache the outputs of the format conversions of pipeline
+        inputs, so that the conversion of each version of an input is only
+        run once across pipelines, analyses and runs
+    conversion_cache_dir : str | None
+        The directory to cache the outputs of format conversions in. Can be
+        shared between processors (e.g. on a shared filesystem). If None, a
+        'conversion-cache' sub-directory of the work directory is used, which
+        isn't removed when the work directory is cleaned between runs
 
     NB: Other keyword wargs are passed to the wrapped Nipype plugin. Some
     useful ones for debugging are 'remove_unnecessary_outputs=False' and
@@ -71,6 +81,8 @@ class Processor(object):
 
     WORKFLOW_MAX_NAME_LEN = 100
 
+    CONVERSION_CACHE_DIR = 'conversion-cache'
+
     # The default paths in the provenance JSON to check for mismatches that
     # would require the derivative to be reprocessed
     DEFAULT_PROV_CHECK = ['workflow', 'inputs', 'outputs', 'joined_ids']
@@ -88,7 +100,8 @@ class Processor(object):
                  max_process_time=None,
                  clean_work_dir_between_runs=True,
                  default_wall_time=DEFAULT_WALL_TIME,
-                 default_mem_gb=DEFAULT_MEM_GB, **kwargs):
+                 default_mem_gb=DEFAULT_MEM_GB, cache_conversions=True,
+                 conversion_cache_dir=None, **kwargs):
         self._work_dir = work_dir
         self._max_process_time = max_process_time
         self._reprocess = reprocess
@@ -101,6 +114,8 @@ class Processor(object):
         self._init_plugin()
         self._analysis = None
         self._clean_work_dir_between_runs = clean_work_dir_between_runs
+        self._cache_conversions = cache_conversions
+        self._conversion_cache_dir = conversion_cache_dir
 
     def __repr__(self):
         return "{}(work_dir='{}')".format(
@@ -460,6 +475,17 @@ class Processor(object):
         # processed
         iter_nodes = self._iterate(pipeline, to_process_array, subject_inds,
                                    visit_inds)
+        if self.analysis.dataset.tree.lazy:
+            # Only pass the items of the nodes to be processed to the sources
+            # and sinks so the rest of the nodes of the tree aren't loaded
+            to_process = partial(self._in_array, to_process_array,
+                                 subject_inds, visit_inds)
+
+            def slices(specs):
+                return [s.slice.subset(to_process) for s in specs]
+        else:
+            def slices(specs):
+                return (s.slice for s in specs)
         sources = {}
         # Loop through each frequency present in the pipeline inputs and
         # create a corresponding source node
@@ -473,8 +499,7 @@ class Processor(object):
             inputnode = pipeline.inputnode(freq)
             sources[freq] = source = pipeline.add(
                 '{}_source'.format(freq),
-                RepositorySource(
-                    i.slice for i in inputs),
+                RepositorySource(slices(inputs)),
                 inputs=({'prereqs': (prereqs, 'out')}
                         if prereqs is not None else {}))
             # Connect iter_nodes to source and input nodes
@@ -548,7 +573,7 @@ class Processor(object):
             sink = pipeline.add(
                 '{}_sink'.format(freq),
                 RepositorySink(
-                    (o.slice for o in outputs), pipeline,
+                    slices(outputs), pipeline,
                     required_outputs),
                 inputs=to_connect)
             # "De-iterate" (join) over iterators to get back to single child
@@ -790,6 +815,19 @@ class Processor(object):
             return (subject_inds.get(x.subject_id, 0),
                     visit_inds.get(x.visit_id, 0))
 
+        if tree.lazy:
+            # Only check the items in the nodes that can be processed so the
+            # rest of the nodes of lazily constructed trees aren't loaded
+            can_process = partial(
+                self._in_array,
+                self._dialate_array(filter_array | prqs_to_process_array,
+                                    pipeline.joins),
+                subject_inds, visit_inds)
+
+            def slice_items(slce):
+                return slce.select(can_process)
+        else:
+            slice_items = iter
         # Initalise array to represent which sessions need to be reprocessed
         to_process_array = np.zeros((len(subject_inds), len(visit_inds)),
                                     dtype=bool)
@@ -809,7 +847,7 @@ class Processor(object):
             # NB: Analysis inputs that don't have skip_missing set and have
             # missing data should raise an error before this point
             if input.skip_missing:
-                for item in input.slice:
+                for item in slice_items(input.slice):
                     if not item.exists:
                         to_skip_array[array_inds(item)] = True
                         to_skip[array_inds(item)].append(item)
@@ -820,13 +858,15 @@ class Processor(object):
             # Check to see if output is required by downstream processing
             required = (required_outputs is None
                         or output.name in required_outputs)
-            for item in output.slice:
+            for item in slice_items(output.slice):
                 if item.exists:
                     # Check to see if checksums recorded when derivative
                     # was generated by previous run match those of current file
                     # set. If not we assume they have been manually altered and
                     # therefore should not be overridden
-                    if item.checksums != item.recorded_checksums:
+                    recorded_checksums = item.recorded_checksums
+                    if (item.checksums_as(checksum_algorithm(
+                            recorded_checksums)) != recorded_checksums):
                         logger.warning(
                             "Checksums for {} do not match those recorded in "
                             "provenance. Assuming it has been manually "
@@ -873,7 +913,7 @@ class Processor(object):
                 try:
                     # Retrieve record stored in tree node
                     record = node.record(pipeline.name, pipeline.analysis.name)
-                    expected_record = pipeline.expected_record(node)
+                    expected_record = pipeline.expected_record(node, record)
 
                     # Compare record with expected
                     mismatches = record.mismatches(
@@ -978,6 +1018,21 @@ class Processor(object):
                                                pipeline.joins)
         return to_process_array, to_protect_array, to_skip_array
 
+    @staticmethod
+    def _in_array(array, subject_inds, visit_inds, subject_id, visit_id):
+        """
+        Whether any of the subject/visit ID pairs that an item or node covers
+        are marked True in a to_process|to_protect|filter array, where the
+        IDs that aren't relevant to its frequency are None
+        """
+        rows = (subject_inds.get(subject_id)
+                if subject_id is not None else slice(None))
+        cols = (visit_inds.get(visit_id)
+                if visit_id is not None else slice(None))
+        if rows is None or cols is None:
+            return False
+        return bool(array[rows, cols].any())
+
     def _dialate_array(self, array, iterators):
         """
         'Dialates' a to_process/to_protect array to include all subject and/or
@@ -1013,6 +1068,18 @@ class Processor(object):
     def work_dir(self):
         return self._work_dir
 
+    @property
+    def conversion_cache_dir(self):
+        """
+        The directory the outputs of format conversions are cached in, or
+        None if they aren't cached
+        """
+        if not getattr(self, '_cache_conversions', False):
+            return None  # E.g. processors pickled before caching was added
+        if self._conversion_cache_dir is not None:
+            return self._conversion_cache_dir
+        return op.join(self.work_dir, self.CONVERSION_CACHE_DIR)
+
     def __getstate__(self):
         dct = copy(self.__dict__)
         # Delete the NiPype plugin as it can be regenerated
@@ -1,5 +1,10 @@
 from abc import ABCMeta, abstractmethod
 import logging
+from itertools import chain
+from threading import RLock
+from contextlib import contextmanager
+from arcana.utils import (
+    DEFAULT_CHECKSUM_ALGORITHM, checksum_hasher, BINARY_ARRAY_DTYPES)
 from .dataset import Dataset
 
 
@@ -11,10 +16,85 @@ class Repository(metaclass=ABCMeta):
     Abstract base class for all Repository systems, DaRIS, XNAT and
     local file system. Sets out the interface that all Repository
     classes should implement.
+
+    Parameters
+    ----------
+    checksum_algorithm : str
+        The algorithm used to calculate the checksums of filesets stored in
+        the repository, one of CHECKSUM_ALGORITHMS in arcana.utils (e.g.
+        'md5', 'sha256', 'blake2b' (Python >= 3.6) or 'xxh3' if the 'xxhash'
+        package is installed)
+    binary_array_length : int | None
+        The minimum length of integer and float array fields that are stored
+        in binary '.npy' files instead of alongside the other fields, so they
+        don't need to be parsed each time the fields are read and are only
+        loaded when accessed. If None (the default), all fields are stored
+        with the others, so they can still be read by older versions of
+        Arcana and other tools
     """
 
-    def __init__(self):
+    # For repositories pickled before the algorithm was configurable
+    _checksum_algorithm = DEFAULT_CHECKSUM_ALGORITHM
+    _binary_array_length = None
+    _bandwidth_limiter = None
+
+    def __init__(self, checksum_algorithm=DEFAULT_CHECKSUM_ALGORITHM,
+                 binary_array_length=None):
         self._connection_depth = 0
+        # Guards the connection depth counter so the repository can be
+        # accessed from multiple threads (e.g. when prefetching inputs)
+        self._connection_lock = RLock()
+        self._bandwidth_limiter = None
+        checksum_hasher(checksum_algorithm)  # Check algorithm is available
+        self._checksum_algorithm = checksum_algorithm
+        self._binary_array_length = binary_array_length
+
+    @property
+    def checksum_algorithm(self):
+        return self._checksum_algorithm
+
+    @property
+    def binary_array_length(self):
+        return self._binary_array_length
+
+    def stores_binary(self, field):
+        """
+        Whether the value of the field is stored in a binary '.npy' file
+        instead of alongside the other fields (see 'binary_array_length')
+        """
+        return (self._binary_array_length is not None
+                and field.array
+                and field.dtype in BINARY_ARRAY_DTYPES.values()
+                and len(field.value) >= self._binary_array_length)
+
+    def __getstate__(self):
+        dct = self.__dict__.copy()
+        dct.pop('_connection_lock', None)
+        dct.pop('_bandwidth_limiter', None)
+        return dct
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._connection_lock = RLock()
+
+    @contextmanager
+    def limit_bandwidth(self, limiter):
+        """
+        Throttles the files downloaded from the repository within the context
+        (by any thread) to the rate of the limiter. Only applies to
+        repositories that download files from remote servers (e.g. XnatRepo)
+
+        Parameters
+        ----------
+        limiter : BandwidthLimiter
+            The limiter to throttle the downloads with
+        """
+        prev_limiter = self._bandwidth_limiter
+        self._bandwidth_limiter = limiter
+        try:
+            yield
+        finally:
+            self._bandwidth_limiter = prev_limiter
 
     def __enter__(self):
         # This allows the repository to be used within nested contexts
@@ -22,15 +102,17 @@ class Repository(metaclass=ABCMeta):
         # methods that need connections, and therefore control their
         # own connection, in batches using the same connection by
         # placing the batch calls within an outer context.
-        if self._connection_depth == 0:
-            self.connect()
-        self._connection_depth += 1
+        with self._connection_lock:
+            if self._connection_depth == 0:
+                self.connect()
+            self._connection_depth += 1
         return self
 
     def __exit__(self, exception_type, exception_value, traceback):
-        self._connection_depth -= 1
-        if self._connection_depth == 0:
-            self.disconnect()
+        with self._connection_lock:
+            self._connection_depth -= 1
+            if self._connection_depth == 0:
+                self.disconnect()
 
     def standardise_name(self, name):
         return name
@@ -90,6 +172,76 @@ class Repository(metaclass=ABCMeta):
             The provenance records found in the repository
         """
 
+    def find_session_ids(self, dataset, subject_ids=None, visit_ids=None):
+        """
+        List the subject and visit IDs of the sessions in a dataset without
+        loading their contents, used to construct lazy trees (see the 'lazy'
+        argument of Dataset). Repositories that can list their sessions
+        more cheaply than finding all of their data should override this
+        method
+
+        Parameters
+        ----------
+        dataset : Dataset
+            The dataset to list the sessions of
+        subject_ids : list(str)
+            List of subject IDs with which to filter the sessions with. If
+            None all are returned
+        visit_ids : list(str)
+            List of visit IDs with which to filter the sessions with. If
+            None all are returned
+
+        Returns
+        -------
+        session_ids : list[tuple[str, str]]
+            The (subject ID, visit ID) pairs of the sessions in the dataset
+        """
+        return sorted(set(
+            (i.subject_id, i.visit_id)
+            for i in chain(*self.find_data(dataset, subject_ids=subject_ids,
+                                           visit_ids=visit_ids))
+            if i.frequency == 'per_session'))
+
+    def find_node_data(self, dataset, subject_id=None, visit_id=None,
+                       **kwargs):
+        """
+        Find the data stored in a single node of a dataset, i.e. a session
+        or a subject, visit or dataset summary if either or both of the IDs
+        are None. Used to load the nodes of lazy trees the first time they
+        are accessed. The default implementation filters the data returned
+        by find_data so should be overridden by repositories that can access
+        nodes individually
+
+        Parameters
+        ----------
+        dataset : Dataset
+            The dataset to return the data for
+        subject_id : str | None
+            The subject ID of the node (None for visit and dataset summaries)
+        visit_id : str | None
+            The visit ID of the node (None for subject and dataset summaries)
+
+        Returns
+        -------
+        filesets : list[Fileset]
+            The filesets found in the node
+        fields : list[Field]
+            The fields found in the node
+        records : list[Record]
+            The provenance records found in the node
+        """
+        found = self.find_data(
+            dataset,
+            subject_ids=(None if subject_id is None
+                         else [dataset.inv_map_subject_id(subject_id)]),
+            visit_ids=(None if visit_id is None
+                       else [dataset.inv_map_visit_id(visit_id)]),
+            **kwargs)
+        return tuple(
+            [i for i in items
+             if i.subject_id == subject_id and i.visit_id == visit_id]
+            for items in found)
+
     @abstractmethod
     def get_fileset(self, fileset):
         """
@@ -152,6 +304,13 @@ class Repository(metaclass=ABCMeta):
         ----------
         fileset : Fileset
             The fileset to insert into the repository
+
+        Returns
+        -------
+        checksums : dict[str, str] | None
+            The checksums of the fileset, if they were calculated while it was
+            copied into the repository (see Fileset.transfer_to), so that the
+            files don't need to be read again to calculate them
         """
 
     @abstractmethod
@@ -165,6 +324,20 @@ class Repository(metaclass=ABCMeta):
             The field to insert into the repository
         """
 
+    def put_fields(self, fields):
+        """
+        Inserts or updates multiple fields into the repository. Repositories
+        that store the fields of a session together should override this
+        method to write them in a single update
+
+        Parameters
+        ----------
+        fields : list[Field]
+            The fields to insert into the repository
+        """
+        for field in fields:
+            self.put_field(field)
+
     @abstractmethod
     def put_record(self, record, dataset):
         """
@@ -42,13 +42,19 @@ class Dataset():
         Maps subject IDs in dataset to a global name-space
     visit_id_map : dict[str, str]
         Maps visit IDs in dataset to a global name-space
+    lazy : bool
+        Whether to construct the tree from a listing of the session IDs in
+        the repository and only load the data in each node the first time
+        it is accessed, instead of crawling the whole repository up front.
+        Lazy trees are not saved in the tree cache
     """
 
     type = 'basic'
 
     def __init__(self, name, repository=None, subject_ids=None, visit_ids=None,
                  fill_tree=False, depth=0, subject_id_map=None,
-                 visit_id_map=None, file_formats=(), clear_cache=True):
+                 visit_id_map=None, file_formats=(), clear_cache=True,
+                 lazy=False):
         if repository is None:
             # needs to be imported here to avoid circular imports
             from .local import LocalFileSystemRepo
@@ -64,6 +70,8 @@ class Dataset():
         self._visit_ids = tuple(visit_ids) if visit_ids is not None else None
         self._fill_tree = fill_tree
         self._depth = depth
+        self._lazy = lazy
+        self._cached_tree = None
         if clear_cache:
             self.clear_cache()
 
@@ -72,7 +80,6 @@ class Dataset():
         self._inv_subject_id_map = {}
         self._inv_visit_id_map = {}
         self._file_formats = file_formats
-        self._cached_tree = None
 
     def __repr__(self):
         return "Dataset(name='{}', depth={}, repository={})".format(
@@ -205,9 +212,16 @@ class Dataset():
         ----------
         fileset : Fileset
             The fileset to insert into the repository
+
+        Returns
+        -------
+        checksums : dict[str, str] | None
+            The checksums of the fileset if they were calculated as it was
+            copied into the repository
         """
-        self.repository.put_fileset(fileset)
+        checksums = self.repository.put_fileset(fileset)
         self.clear_cache()
+        return checksums
 
     def put_field(self, field):
         """
@@ -221,6 +235,18 @@ class Dataset():
         self.repository.put_field(field)
         self.clear_cache()
 
+    def put_fields(self, fields):
+        """
+        Inserts or updates multiple fields into the repository together
+
+        Parameters
+        ----------
+        fields : list[Field]
+            The fields to insert into the repository
+        """
+        self.repository.put_fields(fields)
+        self.clear_cache()
+
     def put_record(self, record):
         """
         Inserts a provenance record into a session or subject|visit|analysis
@@ -252,6 +278,14 @@ class Dataset():
                     self._cached_tree = pkl.load(f)
             except (FileNotFoundError, TypeError):
                 pass
+            except (AttributeError, ImportError, EOFError,
+                    pkl.UnpicklingError) as e:
+                # E.g. saved by a version of Arcana that stored the data
+                # items in a different layout, or only partially written
+                logger.warning(
+                    "Could not load data tree saved in cache directory ({}), "
+                    "rebuilding it".format(e))
+                self._cached_tree = None
             else:
                 cached_dataset = self._cached_tree.dataset
                 if (cached_dataset.name == self.name
@@ -263,7 +297,17 @@ class Dataset():
                          "(name: '{}' v '{}', repository {} v {}) ").format(
                             cached_dataset.name, self.name,
                             cached_dataset.repository, self.repository))
-        if self._cached_tree is None:
+        if self._cached_tree is None and self._lazy:
+            self._cached_tree = Tree.construct_lazy(
+                self,
+                self.repository.find_session_ids(
+                    dataset=self,
+                    subject_ids=self._subject_ids,
+                    visit_ids=self._visit_ids),
+                fill_subjects=(self._subject_ids
+                                if self._fill_tree else None),
+                fill_visits=(self._visit_ids if self._fill_tree else None))
+        elif self._cached_tree is None:
             # Find all data present in the repository (filtered by the
             # passed IDs)
             self._cached_tree = Tree.construct(
@@ -277,6 +321,9 @@ class Dataset():
                 fill_visits=(self._visit_ids if self._fill_tree else None))
             try:
                 with open(self._tree_cache_path, 'wb') as f:
+                    # Save the fingerprints of the nodes with the tree so
+                    # it can be diffed against later versions
+                    self._cached_tree.fingerprint  # noqa pylint: disable=pointless-statement
                     pkl.dump(self._cached_tree, f)
             except TypeError:
                 pass  # No cache path
@@ -294,6 +341,8 @@ class Dataset():
         return cache_path
 
     def clear_cache(self):
+        if self._cached_tree is not None:
+            self._cached_tree.clear_fingerprints()
         self._cached_tree = None
         try:
             os.remove(self._tree_cache_path)
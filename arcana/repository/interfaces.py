@@ -3,6 +3,7 @@ from nipype.interfaces.base import (
     traits, DynamicTraitedSpec, Undefined, File, Directory,
     BaseInterface, isdefined)
 from itertools import chain
+from collections import defaultdict
 from copy import copy
 from arcana.utils import PATH_SUFFIX, FIELD_SUFFIX, CHECKSUM_SUFFIX
 from arcana.pipeline.provenance import Record
@@ -175,7 +176,10 @@ class RepositorySource(RepositoryInterface):
                         + CHECKSUM_SUFFIX] = fileset.checksums
             for field_slice in self.field_collections:
                 field = field_slice.item(subject_id, visit_id)
-                field.get()
+                # Values of acquired fields are loaded with the dataset tree
+                # so only derived fields, which may have been regenerated by
+                # upstream pipelines, need to be read from the repository
+                field.get(refresh=field.derived)
                 outputs[field_slice.name + FIELD_SUFFIX] = field.value
         return outputs
 
@@ -270,6 +274,7 @@ class RepositorySink(RepositoryInterface):
                     continue  # skip the upload for this fileset
                 fileset.path = path  # Push to repository
                 output_checksums[fileset.name] = fileset.checksums
+            fields = defaultdict(list)
             for field_slice in self.field_collections:
                 field = field_slice.item(
                     subject_id,
@@ -280,8 +285,14 @@ class RepositorySink(RepositoryInterface):
                     if field.name in self._required:
                         missing_inputs.append(field.name)
                     continue  # skip the upload for this field
-                field.value = value  # Push to repository
+                field.set_value(value, put=False)
+                fields[field.dataset].append(field)
                 output_checksums[field.name] = field.value
+            # Push the fields of each dataset to the repository together so
+            # they can be written in a single update
+            for dataset, dataset_fields in fields.items():
+                if dataset is not None:
+                    dataset.put_fields(dataset_fields)
             # Add input and output checksums to provenance record and sink to
             # all repositories that have received data (typically only one)
             prov = copy(self._prov)
@@ -2,10 +2,11 @@ import os
 import os.path as op
 import errno
 from itertools import chain
+from collections import defaultdict
 import stat
-import shutil
 import logging
 import json
+from threading import get_ident
 from fasteners import InterProcessLock
 from arcana.data import Fileset, Field
 from arcana.pipeline.provenance import Record
@@ -14,7 +15,10 @@ from arcana.exceptions import (
     ArcanaRepositoryError,
     ArcanaMissingDataException,
     ArcanaInsufficientRepoDepthError)
-from arcana.utils import get_class_info, HOSTNAME, split_extension
+from arcana.utils import (
+    get_class_info, HOSTNAME, split_extension, FileHasher,
+    BINARY_ARRAY_DTYPES, save_array, load_array, wait_for_swap,
+    in_cache_entry, array_stamp)
 from .base import Repository
 
 
@@ -42,6 +46,31 @@ class LocalFileSystemRepo(Repository):
         sub-directories for each subject, and if depth == 2 there is
         an additional layer of sub-directories for each visit of each
         subject.
+    transfer : str
+        How filesets are transferred into the repository when they are sunk
+        from the work directory. Can be one of
+
+            'copy': the files are copied (the default)
+            'reflink': copy-on-write clones of the files are created where
+                       supported by the filesystem (e.g. Btrfs or XFS)
+            'hardlink': the files are hard-linked into the repository
+            'move': the files are moved into the repository. Only appropriate
+                    if the work directory is cleaned after each run
+
+        Falls back to copying the files where the method isn't possible, e.g.
+        if the work directory is on a different filesystem. Files in the
+        conversion cache (see Processor.conversion_cache_dir) are always
+        cloned or copied
+    checksum_algorithm : str
+        The algorithm used to calculate the checksums of the filesets, e.g.
+        'md5' (default), 'sha256', 'blake2b' (requires Python >= 3.6) or
+        'xxh3' (requires 'xxhash')
+    binary_array_length : int | None
+        The minimum length of integer and float array fields that are saved
+        in binary '.npy' files (in a hidden '.field-arrays' sub-directory of
+        the session) instead of the fields JSON, so they are only loaded when
+        accessed. If None (the default), all fields are saved in the fields
+        JSON
     """
 
     type = 'directory'
@@ -49,10 +78,19 @@ class LocalFileSystemRepo(Repository):
     FIELDS_FNAME = 'fields.json'
     PROV_DIR = '__prov__'
     LOCK_SUFFIX = '.lock'
+    FIELD_ARRAYS_DIR = '.field-arrays'
     DEFAULT_SUBJECT_ID = 'SUBJECT'
     DEFAULT_VISIT_ID = 'VISIT'
     MAX_DEPTH = 2
 
+    def __init__(self, transfer='copy', **kwargs):
+        super().__init__(**kwargs)
+        if transfer not in FileHasher.TRANSFER_METHODS:
+            raise ArcanaUsageError(
+                "Unrecognised transfer method '{}' (available '{}')".format(
+                    transfer, "', '".join(FileHasher.TRANSFER_METHODS)))
+        self._transfer = transfer
+
     def __repr__(self):
         return "{}()".format(type(self).__name__)
 
@@ -62,11 +100,16 @@ class LocalFileSystemRepo(Repository):
         except AttributeError:
             return False
 
+    @property
+    def transfer(self):
+        return self._transfer
+
     @property
     def prov(self):
         return {
             'type': get_class_info(type(self)),
-            'host': HOSTNAME}
+            'host': HOSTNAME,
+            'checksum_algorithm': self.checksum_algorithm}
 
     def __hash__(self):
         return hash(self.type)
@@ -83,7 +126,9 @@ class LocalFileSystemRepo(Repository):
         if fileset._path is None:
             primary_path = self.fileset_path(fileset)
             aux_files = fileset.format.default_aux_file_paths(primary_path)
-            if not op.exists(primary_path):
+            # The fileset may be in the middle of being replaced (see
+            # 'Fileset.transfer_to')
+            if not wait_for_swap(primary_path):
                 raise ArcanaMissingDataException(
                     "{} does not exist in {}"
                     .format(fileset, self))
@@ -101,16 +146,16 @@ class LocalFileSystemRepo(Repository):
         """
         Update the value of the field from the repository
         """
-        # Load fields JSON, locking to prevent read/write conflicts
-        # Would be better if only checked if locked to allow
-        # concurrent reads but not possible with multi-process
-        # locks (in my understanding at least).
+        # The fields JSON is replaced atomically when it is written (see
+        # 'put_fields'), so it can be read without locking
         fpath = self.fields_json_path(field)
         try:
-            with InterProcessLock(fpath + self.LOCK_SUFFIX,
-                                  logger=logger), open(fpath, 'r') as f:
+            with open(fpath, 'r') as f:
                 dct = json.load(f)
             val = dct[field.name]
+            if isinstance(val, dict):
+                # Stored in a binary array file (see 'put_fields')
+                val = load_array(op.join(op.dirname(fpath), val['npy']))
             if field.array:
                 val = [field.dtype(v) for v in val]
             else:
@@ -132,42 +177,81 @@ class LocalFileSystemRepo(Repository):
         """
         Inserts or updates a fileset in the repository
         """
-        target_path = self.fileset_path(fileset)
-        if op.isfile(fileset.path):
-            shutil.copyfile(fileset.path, target_path)
-            # Copy side car files into repository
-            for aux_name, aux_path in fileset.format.default_aux_file_paths(
-                    target_path).items():
-                shutil.copyfile(fileset.format.aux_files[aux_name], aux_path)
-        elif op.isdir(fileset.path):
-            if op.exists(target_path):
-                shutil.rmtree(target_path)
-            shutil.copytree(fileset.path, target_path)
-        else:
-            assert False
+        # Checksums are calculated as the files are copied so they only need
+        # to be read once
+        return fileset.transfer_to(self.fileset_path(fileset),
+                                   method=self.transfer_method(fileset))
+
+    def transfer_method(self, fileset):
+        """
+        The method the files of a fileset are transferred into the
+        repository with. Filesets in a cache of conversion outputs are
+        cloned or copied instead of being moved or hard-linked, so the
+        cached files aren't removed or modified through the repository
+        """
+        if (self.transfer in ('move', 'hardlink') and fileset.path is not None
+                and in_cache_entry(fileset.path)):
+            return 'reflink'
+        return self.transfer
 
     def put_field(self, field):
         """
         Inserts or updates a field in the repository
         """
-        fpath = self.fields_json_path(field)
-        # Open fields JSON, locking to prevent other processes
-        # reading or writing
-        with InterProcessLock(fpath + self.LOCK_SUFFIX, logger=logger):
-            try:
-                with open(fpath, 'r') as f:
-                    dct = json.load(f)
-            except IOError as e:
-                if e.errno == errno.ENOENT:
-                    dct = {}
-                else:
-                    raise
-            if field.array:
-                dct[field.name] = list(field.value)
-            else:
-                dct[field.name] = field.value
-            with open(fpath, 'w') as f:
-                json.dump(dct, f, indent=2)
+        self.put_fields([field])
+
+    def put_fields(self, fields):
+        """
+        Inserts or updates fields in the repository. The fields stored in
+        each fields JSON are updated together, with a single write that
+        replaces the file atomically. Large numeric arrays are saved in '.npy'
+        files in a hidden sub-directory and referenced from the JSON (see
+        'binary_array_length')
+        """
+        by_path = defaultdict(list)
+        for field in fields:
+            by_path[self.fields_json_path(field)].append(field)
+        for fpath, path_fields in by_path.items():
+            # Lock the fields JSON to prevent other processes writing to it
+            # between it being read and replaced
+            with InterProcessLock(fpath + self.LOCK_SUFFIX, logger=logger):
+                try:
+                    with open(fpath, 'r') as f:
+                        dct = json.load(f)
+                except IOError as e:
+                    if e.errno == errno.ENOENT:
+                        dct = {}
+                    else:
+                        raise
+                stale_arrays = []
+                for field in path_fields:
+                    if self.stores_binary(field):
+                        array_path = op.join(op.dirname(fpath),
+                                             self.FIELD_ARRAYS_DIR,
+                                             field.name + '.npy')
+                        os.makedirs(op.dirname(array_path), exist_ok=True)
+                        save_array(array_path, field.value, field.dtype)
+                        dct[field.name] = {
+                            'npy': op.relpath(array_path, op.dirname(fpath)),
+                            'dtype': field.dtype.__name__}
+                        continue
+                    prev = dct.get(field.name)
+                    if isinstance(prev, dict):
+                        stale_arrays.append(
+                            op.join(op.dirname(fpath), prev['npy']))
+                    if field.array:
+                        dct[field.name] = list(field.value)
+                    else:
+                        dct[field.name] = field.value
+                tmp_path = '{}.{}-{}.tmp'.format(fpath, os.getpid(),
+                                                get_ident())
+                with open(tmp_path, 'w') as f:
+                    json.dump(dct, f, indent=2)
+                os.replace(tmp_path, fpath)
+                # Binary files of arrays that are now stored in the JSON are
+                # removed once it no longer references them
+                for array_path in stale_arrays:
+                    os.remove(array_path)
 
     def put_record(self, record, dataset):
         fpath = self.prov_json_path(record, dataset)
@@ -206,12 +290,69 @@ class LocalFileSystemRepo(Repository):
         records : list[Record]
             The provenance records found in the repository
         """
+        return self._find_data_in_dir(dataset, dataset.name,
+                                      subject_ids=subject_ids,
+                                      visit_ids=visit_ids, **kwargs)
+
+    def find_session_ids(self, dataset, subject_ids=None, visit_ids=None):
+        root_dir = dataset.name
+        if dataset.depth == 0:
+            return [(dataset.map_subject_id(self.DEFAULT_SUBJECT_ID),
+                     dataset.map_visit_id(self.DEFAULT_VISIT_ID))]
+        session_ids = []
+        for subj_id in self._list_id_dirs(root_dir):
+            if subject_ids is not None and subj_id not in subject_ids:
+                continue
+            if dataset.depth == 1:
+                visit_dirs = [self.DEFAULT_VISIT_ID]
+            else:
+                visit_dirs = self._list_id_dirs(op.join(root_dir, subj_id))
+            for visit_id in visit_dirs:
+                if visit_ids is not None and visit_id not in visit_ids:
+                    continue
+                session_ids.append((dataset.map_subject_id(subj_id),
+                                    dataset.map_visit_id(visit_id)))
+        return session_ids
+
+    def find_node_data(self, dataset, subject_id=None, visit_id=None,
+                       **kwargs):
+        # Only walk the directory of the node (and the analysis
+        # sub-directories within it)
+        dir_names = [
+            (self.SUMMARY_NAME if subject_id is None
+             else str(dataset.inv_map_subject_id(subject_id))),
+            (self.SUMMARY_NAME if visit_id is None
+             else str(dataset.inv_map_visit_id(visit_id)))]
+        node_dir = op.join(dataset.name, *dir_names[:dataset.depth])
+        if not op.isdir(node_dir):
+            return [], [], []
+        found = self._find_data_in_dir(dataset, node_dir, **kwargs)
+        return tuple(
+            [i for i in items
+             if i.subject_id == subject_id and i.visit_id == visit_id]
+            for items in found)
+
+    def _list_id_dirs(self, dpath):
+        "Lists the subject or visit sub-directories of a directory"
+        try:
+            return sorted(d for d in os.listdir(dpath)
+                          if not (d.startswith('.') or d == self.SUMMARY_NAME)
+                          and op.isdir(op.join(dpath, d)))
+        except FileNotFoundError:
+            return []
+
+    def _find_data_in_dir(self, dataset, walk_dir, subject_ids=None,
+                          visit_ids=None, **kwargs):
+        """
+        Find the data stored within a directory of the dataset, i.e. the
+        root directory or the directory of a single subject or session
+        """
         all_filesets = []
         all_fields = []
         all_records = []
         # if root_dir is None:
         root_dir = dataset.name
-        for session_path, dirs, files in os.walk(root_dir):
+        for session_path, dirs, files in os.walk(walk_dir):
             relpath = op.relpath(session_path, root_dir)
             path_parts = relpath.split(op.sep) if relpath != '.' else []
             ids = self._extract_ids_from_path(dataset.depth, path_parts, dirs,
@@ -276,12 +417,21 @@ class LocalFileSystemRepo(Repository):
                 with open(op.join(session_path,
                                   self.FIELDS_FNAME), 'r') as f:
                     dct = json.load(f)
-                all_fields.extend(
-                    Field(name=k, value=v, frequency=frequency,
-                          subject_id=subj_id, visit_id=visit_id,
-                          dataset=dataset, from_analysis=from_analysis,
-                          **kwargs)
-                    for k, v in list(dct.items()))
+                for name, value in dct.items():
+                    if isinstance(value, dict):
+                        # Binary arrays are only loaded when accessed
+                        value_kwargs = {
+                            'dtype': BINARY_ARRAY_DTYPES[value['dtype']],
+                            'array': True,
+                            'modified': array_stamp(
+                                op.join(session_path, value['npy']))}
+                    else:
+                        value_kwargs = {'value': value}
+                    all_fields.append(
+                        Field(name=name, frequency=frequency,
+                              subject_id=subj_id, visit_id=visit_id,
+                              dataset=dataset, from_analysis=from_analysis,
+                              **value_kwargs, **kwargs))
             if self.PROV_DIR in dirs:
                 if from_analysis is None:
                     raise ArcanaRepositoryError(
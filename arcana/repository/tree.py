@@ -1,8 +1,15 @@
 from builtins import zip
 from builtins import object
+import os
+import os.path as op
+import re
+import json
+import hashlib
 import weakref
+from threading import RLock
 from itertools import chain, groupby
 from collections import defaultdict
+from functools import partial
 from operator import attrgetter, itemgetter
 from collections import OrderedDict
 import logging
@@ -16,9 +23,98 @@ id_getter = attrgetter('id')
 logger = logging.getLogger('arcana')
 
 
+def _fingerprint(strings):
+    return hashlib.sha1('\n'.join(strings).encode()).hexdigest()
+
+
+def _latest_mtime(path):
+    "The latest modification time of a file or anything within a directory"
+    mtime = op.getmtime(path)
+    if op.isdir(path):
+        for base_dir, dnames, fnames in os.walk(path):
+            for name in chain(dnames, fnames):
+                mtime = max(mtime, op.getmtime(op.join(base_dir, name)))
+    return mtime
+
+
+def _item_fingerprint(item):
+    """
+    Returns a string that changes whenever the given fileset, field or
+    provenance record is modified, without having to read the contents of
+    filesets. Checksums of filesets are used where they are already known,
+    otherwise the modification times of local files (including everything
+    within directories and side-car files) or the modification stamps of
+    remote resources listed by the repository (see Fileset.modified).
+    Fields stored in binary files are fingerprinted by the stamps of the
+    files (see Field.modified) so their values don't need to be loaded
+    """
+    if isinstance(item, BaseFileset):
+        if item._checksums is not None:
+            content = json.dumps(sorted(item._checksums.items()))
+        elif item._path is not None and op.exists(item._path):
+            content = '{}:{}'.format(
+                item._path,
+                max(_latest_mtime(p)
+                    for p in chain([item._path], item._aux_files.values())
+                    if op.exists(p)))
+        else:
+            content = '{}:{}'.format(item.uri, item.modified)
+        parts = ('fileset', item.name, item.from_analysis, item.id,
+                 item._resource_name, item.quality, content)
+    elif isinstance(item, BaseField):
+        parts = ('field', item.name, item.from_analysis,
+                 (item.modified if item.modified is not None
+                  else repr(item._value)))
+    else:
+        parts = ('record', item.pipeline_name, item.from_analysis,
+                 json.dumps(item.prov, sort_keys=True, default=str))
+    return '\t'.join(str(p) for p in parts)
+
+
+def _warn_about_records(nodes):
+    """
+    Logs single warnings for all of the derivatives in the given nodes with
+    missing or duplicate provenance records
+    """
+    missing_records = defaultdict(lambda: defaultdict(list))
+    duplicate_records = defaultdict(lambda: defaultdict(list))
+    for node in nodes:
+        for missing in node._missing_records:
+            missing_records[missing][node.visit_id].append(node.subject_id)
+        for duplicate in node._duplicate_records:
+            duplicate_records[duplicate][node.visit_id].append(
+                node.subject_id)
+    for name, ids in missing_records.items():
+        logger.warning(
+            "No provenance records found for {} derivative in "
+            "the following nodes: {}. Will assume they are a "
+            "\"protected\" (manually created) derivatives"
+            .format(name, '; '.join("visit='{}', subjects={}".format(k, v)
+                                    for k, v in ids.items())))
+    for name, ids in duplicate_records.items():
+        logger.warning(
+            "Duplicate provenance records found for {} in the following "
+            "nodes: {}. Will select the latest record in each case"
+            .format(name, '; '.join("visit='{}', subjects={}".format(k, v)
+                                    for k, v in ids.items())))
+
+
 class TreeNode(object):
 
-    def __init__(self, filesets, fields, records):
+    # Attributes that are populated from the node's loader on first access
+    # in lazily constructed trees (see Tree.construct_lazy)
+    LAZY_ATTRS = ('_filesets', '_fields', '_records', '_missing_records',
+                  '_duplicate_records')
+    _load_lock = RLock()
+
+    def __init__(self, filesets, fields, records, loader=None):
+        self._tree = None
+        if loader is not None:
+            self._loader = loader
+        else:
+            self._add_items(filesets, fields, records)
+
+    def _add_items(self, filesets, fields, records):
         if filesets is None:
             filesets = []
         if fields is None:
@@ -51,14 +147,18 @@ class TreeNode(object):
                                                     r.from_analysis)))
         self._missing_records = []
         self._duplicate_records = []
-        self._tree = None
+        # Index the provenance records by the outputs they record so they
+        # can be matched up with the derived items in the node in one pass
+        records_index = defaultdict(list)
+        for record in self.records:
+            for output_name in record.outputs:
+                records_index[(record.from_analysis, output_name)].append(
+                    record)
         # Match up provenance records with items in the node
         for item in chain(self.filesets, self.fields):
             if not item.derived:
                 continue  # Skip acquired items
-            records = [r for r in self.records
-                       if (item.from_analysis == r.from_analysis
-                           and item.name in r.outputs)]
+            records = records_index.get((item.from_analysis, item.name))
             if not records:
                 self._missing_records.append(item.name)
             elif len(records) > 1:
@@ -67,6 +167,68 @@ class TreeNode(object):
             else:
                 item.record = records[0]
 
+    def __getattr__(self, attr):
+        # Only called if the attribute isn't found by the standard lookup,
+        # i.e. if the items of a lazily constructed node haven't been loaded
+        # yet
+        if attr not in self.LAZY_ATTRS or '_loader' not in self.__dict__:
+            raise AttributeError(
+                "'{}' object has no attribute '{}'".format(
+                    type(self).__name__, attr))
+        with self._load_lock:
+            if '_loader' in self.__dict__:  # Not loaded by another thread
+                loaded = TreeNode(*self._loader())
+                # Update all lazy attributes in one step so other threads
+                # never see a partially loaded node
+                self.__dict__.update(
+                    {a: loaded.__dict__[a] for a in self.LAZY_ATTRS})
+                del self._loader
+                _warn_about_records([self])
+        return object.__getattribute__(self, attr)
+
+    @property
+    def loaded(self):
+        "Whether the items of the node have been loaded from the repository"
+        return '_loader' not in self.__dict__
+
+    @property
+    def items_fingerprint(self):
+        """
+        A hash of the filesets, fields and provenance records that belong
+        directly to the node (i.e. not to the sessions within it). Only
+        calculated once per node so it is saved with the tree cache
+        """
+        fingerprint = self.__dict__.get('_items_fingerprint')
+        if fingerprint is None:
+            fingerprint = self._items_fingerprint = _fingerprint(sorted(
+                _item_fingerprint(i)
+                for i in chain(self.filesets, self.fields, self.records)))
+        return fingerprint
+
+    @property
+    def fingerprint(self):
+        """
+        A hierarchical (Merkle) hash of the data in the node and all nodes
+        below it, i.e. sessions are hashed from their items, subjects and
+        visits from their sessions and the tree from its subjects and
+        visits, so unchanged subtrees can be identified by comparing a
+        single hash (see Tree.diff)
+        """
+        fingerprint = self.__dict__.get('_fingerprint')
+        if fingerprint is None:
+            fingerprint = self._fingerprint = _fingerprint(
+                [self.items_fingerprint]
+                + [n.fingerprint for n in self._child_nodes()])
+        return fingerprint
+
+    def _child_nodes(self):
+        "To be overridden by subclasses with nodes below them"
+        return []
+
+    def _clear_fingerprints(self):
+        self.__dict__.pop('_items_fingerprint', None)
+        self.__dict__.pop('_fingerprint', None)
+
     def __eq__(self, other):
         if not (isinstance(other, type(self))
                 or isinstance(self, type(other))):
@@ -266,6 +428,40 @@ class TreeNode(object):
     def data(self):
         return chain(self.filesets, self.fields)
 
+    def matching_items(self, item_type, pattern, is_regex=False):
+        """
+        Returns the filesets or fields in the node whose names match a
+        pattern, in the order they are stored in the node. If the node
+        belongs to a tree, the names are looked up in an index of the items
+        in all nodes of the same frequency (see Tree.name_index) instead of
+        scanning the items of the node, unless the tree is lazily
+        constructed, in which case building the index would load every node
+
+        Parameters
+        ----------
+        item_type : str
+            The type of the items to match, either 'fileset' or 'field'
+        pattern : str
+            The name of the items to match, or a regular expression to match
+            it with if 'is_regex' is True
+        is_regex : bool
+            Whether the pattern is a regular expression
+
+        Returns
+        -------
+        matches : list[Fileset] | list[Field]
+            The items that match the pattern
+        """
+        if ((self._tree is not None or isinstance(self, Tree))
+                and not self.tree.lazy):
+            return self.tree._matching_items(self, item_type, pattern,
+                                             is_regex)
+        items = self.filesets if item_type == 'fileset' else self.fields
+        if is_regex:
+            pattern_re = re.compile(pattern)
+            return [i for i in items if pattern_re.match(i.basename)]
+        return [i for i in items if i.basename == pattern]
+
     def __ne__(self, other):
         return not (self == other)
 
@@ -373,14 +569,19 @@ class Tree(TreeNode):
         from the provided list. Typically only used if all
         the inputs to the analysis are coming from different datasets
         to the one that the derived products are stored in
+    loader : callable | None
+        Called without arguments to load the filesets, fields and records of
+        the node from the repository the first time they are accessed, in
+        which case the 'filesets', 'fields' and 'records' arguments are
+        ignored (see Tree.construct_lazy)
     """
 
     frequency = 'per_dataset'
 
     def __init__(self, subjects, visits, dataset, filesets=None,
                  fields=None, records=None, fill_subjects=None,
-                 fill_visits=None, **kwargs):  # noqa: E501 @UnusedVariable
-        TreeNode.__init__(self, filesets, fields, records)
+                 fill_visits=None, loader=None, **kwargs):  # noqa: E501 @UnusedVariable
+        TreeNode.__init__(self, filesets, fields, records, loader=loader)
         self._subjects = OrderedDict(sorted(
             ((s.id, s) for s in subjects), key=itemgetter(0)))
         self._visits = OrderedDict(sorted(
@@ -394,28 +595,12 @@ class Tree(TreeNode):
         for session in self.sessions:
             session.tree = self
         self._dataset = dataset
-        # Collate missing and duplicates provenance records for single warnings
-        missing_records = defaultdict(lambda: defaultdict(list))
-        duplicate_records = defaultdict(lambda: defaultdict(list))
-        for node in self.nodes():
-            for missing in node._missing_records:
-                missing_records[missing][node.visit_id].append(node.subject_id)
-            for duplicate in node._duplicate_records:
-                duplicate_records[duplicate][node.visit_id].append(
-                    node.subject_id)
-        for name, ids in missing_records.items():
-            logger.warning(
-                "No provenance records found for {} derivative in "
-                "the following nodes: {}. Will assume they are a "
-                "\"protected\" (manually created) derivatives"
-                .format(name, '; '.join("visit='{}', subjects={}".format(k, v)
-                                        for k, v in ids.items())))
-        for name, ids in duplicate_records.items():
-            logger.warning(
-                "Duplicate provenance records found for {} in the following "
-                "nodes: {}. Will select the latest record in each case"
-                .format(name, '; '.join("visit='{}', subjects={}".format(k, v)
-                                        for k, v in ids.items())))
+        self._lazy = loader is not None
+        self._name_indices = {}
+        self._regex_matches = {}
+        # Collate missing and duplicates provenance records for single
+        # warnings (lazily loaded nodes are checked as they are loaded)
+        _warn_about_records(n for n in self.nodes() if n.loaded)
 
     def __eq__(self, other):
         return (super(Tree, self).__eq__(other)
@@ -431,6 +616,14 @@ class Tree(TreeNode):
     def dataset(self):
         return self._dataset
 
+    @property
+    def lazy(self):
+        """
+        Whether the nodes of the tree are loaded the first time they are
+        accessed (see Tree.construct_lazy)
+        """
+        return self._lazy
+
     @property
     def subjects(self):
         return self._subjects.values()
@@ -537,6 +730,147 @@ class Tree(TreeNode):
             assert False
         return nodes
 
+    def _child_nodes(self):
+        return chain(self.subjects, self.visits)
+
+    def clear_fingerprints(self):
+        """
+        Clears the fingerprints memoised in the nodes of the tree, so they
+        are recalculated from the current state of the data the next time
+        they are accessed (called when the tree is dropped from the cache of
+        its dataset because data has been put into it)
+        """
+        for node in self.nodes():
+            node._clear_fingerprints()
+
+    def diff(self, other):
+        """
+        Returns the nodes of the tree that have been added or whose data
+        has changed compared to another tree of the same dataset (e.g. a
+        tree loaded from the cache before the dataset was modified).
+        Subtrees with matching fingerprints are skipped without comparing
+        the nodes within them. Nodes that have been removed can be found by
+        diffing the other way around.
+
+        Parameters
+        ----------
+        other : Tree
+            The tree to compare against
+
+        Returns
+        -------
+        changed : list[TreeNode]
+            The nodes that have been added or whose filesets, fields or
+            provenance records differ, in the order the tree, subjects,
+            visits and then sessions
+        """
+        if self.fingerprint == other.fingerprint:
+            return []
+        changed = []
+        changed_sessions = []
+        if self.items_fingerprint != other.items_fingerprint:
+            changed.append(self)
+        for subject in self.subjects:
+            try:
+                other_subject = other.subject(subject.id)
+            except ArcanaNameError:
+                changed.append(subject)
+                changed_sessions.extend(subject.sessions)
+                continue
+            if subject.fingerprint == other_subject.fingerprint:
+                continue
+            if subject.items_fingerprint != other_subject.items_fingerprint:
+                changed.append(subject)
+            for session in subject.sessions:
+                try:
+                    other_session = other_subject.session(session.visit_id)
+                except ArcanaNameError:
+                    changed_sessions.append(session)
+                else:
+                    if session.fingerprint != other_session.fingerprint:
+                        changed_sessions.append(session)
+        for visit in self.visits:
+            try:
+                other_visit = other.visit(visit.id)
+            except ArcanaNameError:
+                changed.append(visit)
+            else:
+                if visit.items_fingerprint != other_visit.items_fingerprint:
+                    changed.append(visit)
+        return changed + changed_sessions
+
+    def name_index(self, item_type, frequency):
+        """
+        Returns an index of the filesets or fields in all nodes of the given
+        frequency by name, which is built the first time it is requested.
+        Note that building the index loads all nodes of the frequency in
+        lazily constructed trees
+
+        Parameters
+        ----------
+        item_type : str
+            The type of the items to index, either 'fileset' or 'field'
+        frequency : str
+            The frequency of the nodes to index
+
+        Returns
+        -------
+        index : dict[str, dict[tuple[str, str], list[tuple[int, BaseItem]]]]
+            Maps the names of the items to the (subject ID, visit ID) of the
+            nodes that contain them, and then to the items with that name in
+            the node along with their position in the node
+        """
+        key = (item_type, frequency)
+        try:
+            return self._name_indices[key]
+        except KeyError:
+            pass
+        index = {}
+        for node in self._nodes(frequency):
+            node_key = (node.subject_id, node.visit_id)
+            items = node.filesets if item_type == 'fileset' else node.fields
+            for position, item in enumerate(items):
+                index.setdefault(item.basename, {}).setdefault(
+                    node_key, []).append((position, item))
+        self._name_indices[key] = index
+        return index
+
+    def _matching_items(self, node, item_type, pattern, is_regex):
+        index = self.name_index(item_type, node.frequency)
+        if is_regex:
+            # Match the regular expression against the distinct names in
+            # the index rather than the items in each node
+            key = (item_type, node.frequency, pattern)
+            try:
+                names = self._regex_matches[key]
+            except KeyError:
+                pattern_re = re.compile(pattern)
+                names = self._regex_matches[key] = [
+                    n for n in index if pattern_re.match(n)]
+        else:
+            names = [pattern] if pattern in index else []
+        node_key = (node.subject_id, node.visit_id)
+        matches = []
+        for name in names:
+            matches.extend(index[name].get(node_key, ()))
+        if len(names) > 1:
+            matches.sort(key=itemgetter(0))
+        return [i for _, i in matches]
+
+    def __getstate__(self):
+        # The name indices are rebuilt on demand rather than pickled
+        dct = TreeNode.__getstate__(self).copy()
+        dct['_name_indices'] = {}
+        dct['_regex_matches'] = {}
+        return dct
+
+    def __setstate__(self, state):
+        TreeNode.__setstate__(self, state)
+        # Trees cached before the name indices were added
+        self.__dict__.setdefault('_lazy', False)
+        self.__dict__.setdefault('_name_indices', {})
+        self.__dict__.setdefault('_regex_matches', {})
+
     def find_mismatch(self, other, indent=''):
         """
         Used in debugging unittests
@@ -680,6 +1014,54 @@ class Tree(TreeNode):
                     **kwargs)
 
 
+    @classmethod
+    def construct_lazy(cls, dataset, session_ids, **kwargs):
+        """
+        Return a tree of the subjects, visits and sessions in a dataset in
+        which the filesets, fields and records of each node are only loaded
+        from the repository (via Repository.find_node_data) the first time
+        they are accessed. Avoids crawling the whole repository when only a
+        subset of a large dataset is accessed
+
+        Parameters
+        ----------
+        dataset : Dataset
+            The dataset that the tree represents
+        session_ids : iterable[tuple[str, str]]
+            The subject and visit IDs of the sessions in the dataset, as
+            returned by Repository.find_session_ids
+
+        Returns
+        -------
+        tree : arcana.repository.Tree
+            A hierarchical tree of subject, session and fileset
+            information for the dataset
+        """
+        subj_sessions = defaultdict(list)
+        visit_sessions = defaultdict(list)
+        for subj_id, visit_id in session_ids:
+            session = Session(
+                subject_id=subj_id, visit_id=visit_id,
+                loader=_node_loader(dataset, subj_id, visit_id))
+            subj_sessions[subj_id].append(session)
+            visit_sessions[visit_id].append(session)
+        subjects = [
+            Subject(subj_id, sessions,
+                    loader=_node_loader(dataset, subj_id, None))
+            for subj_id, sessions in subj_sessions.items()]
+        visits = [
+            Visit(visit_id, sessions,
+                  loader=_node_loader(dataset, None, visit_id))
+            for visit_id, sessions in visit_sessions.items()]
+        return Tree(subjects, visits, dataset,
+                    loader=_node_loader(dataset, None, None), **kwargs)
+
+
+def _node_loader(dataset, subject_id, visit_id):
+    return partial(dataset.repository.find_node_data, dataset,
+                   subject_id=subject_id, visit_id=visit_id)
+
+
 class Subject(TreeNode):
     """
     Represents a subject as stored in a dataset
@@ -701,8 +1083,8 @@ class Subject(TreeNode):
     frequency = 'per_subject'
 
     def __init__(self, subject_id, sessions, filesets=None,
-                 fields=None, records=None):
-        TreeNode.__init__(self, filesets, fields, records)
+                 fields=None, records=None, loader=None):
+        TreeNode.__init__(self, filesets, fields, records, loader=loader)
         self._id = subject_id
         self._sessions = OrderedDict(sorted(
             ((s.visit_id, s) for s in sessions), key=itemgetter(0)))
@@ -741,6 +1123,9 @@ class Subject(TreeNode):
     def sessions(self):
         return self._sessions.values()
 
+    def _child_nodes(self):
+        return self.sessions
+
     def nodes(self, frequency=None):
         """
         Returns all sessions in the subject. If a frequency is passed then
@@ -832,8 +1217,8 @@ class Visit(TreeNode):
     frequency = 'per_visit'
 
     def __init__(self, visit_id, sessions, filesets=None, fields=None,
-                 records=None):
-        TreeNode.__init__(self, filesets, fields, records)
+                 records=None, loader=None):
+        TreeNode.__init__(self, filesets, fields, records, loader=loader)
         self._id = visit_id
         self._sessions = OrderedDict(sorted(
             ((s.subject_id, s) for s in sessions), key=itemgetter(0)))
@@ -871,6 +1256,9 @@ class Visit(TreeNode):
     def sessions(self):
         return self._sessions.values()
 
+    def _child_nodes(self):
+        return self.sessions
+
     def nodes(self, frequency=None):
         """
         Returns all sessions in the visit. If a frequency is passed then
@@ -955,8 +1343,8 @@ class Session(TreeNode):
     frequency = 'per_session'
 
     def __init__(self, subject_id, visit_id, filesets=None, fields=None,
-                 records=None):
-        TreeNode.__init__(self, filesets, fields, records)
+                 records=None, loader=None):
+        TreeNode.__init__(self, filesets, fields, records, loader=loader)
         self._subject_id = subject_id
         self._visit_id = visit_id
         self._subject = None
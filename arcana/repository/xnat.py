@@ -8,10 +8,13 @@ import logging
 import errno
 import json
 import re
+import pickle as pkl
+from collections import defaultdict, OrderedDict
 from tqdm import tqdm
 from zipfile import ZipFile, BadZipfile
 import os.path as op
 import shutil
+from fasteners import InterProcessLock
 from arcana.utils import JSON_ENCODING
 from arcana.utils import makedirs
 from arcana.data import Fileset, Field
@@ -20,8 +23,11 @@ from arcana.exceptions import (
     ArcanaError, ArcanaUsageError, ArcanaFileFormatError,
     ArcanaWrongRepositoryError)
 from arcana.pipeline.provenance import Record
-from arcana.utils import dir_modtime, get_class_info, parse_value
+from arcana.utils import (
+    dir_modtime, get_class_info, parse_value, BINARY_ARRAY_DTYPES, save_array,
+    load_array)
 import xnat
+from xnat.exceptions import XNATError
 from .dataset import Dataset
 
 
@@ -64,6 +70,26 @@ class XnatRepo(Repository):
         relies on summary derivatives (i.e. of 'per_visit/subject/analysis'
         frequency) then the filter should match all sessions in the Analysis's
         subject_ids and visit_ids.
+    share_session : bool
+        Whether to save the session token (JSESSIONID) of the login in a
+        user-only readable file in the cache directory so that it can be
+        reused by other processes (e.g. nipype workers) on the same host
+        instead of each logging in separately. A new login is only performed
+        when the saved token has expired. Off by default, as sessions are then
+        left open on the server after the repository disconnects
+    offline : bool
+        Whether to run without connecting to the server. Data is then read
+        from the manifest saved in the cache directory the last time
+        'find_data' was run online and the files that have been previously
+        downloaded into the cache. Items written to the repository are stored
+        in the cache and recorded in a journal, which can be uploaded later
+        using 'push_journal' on an online repository.
+    binary_array_length : int | None
+        The minimum length of integer and float array fields that are stored
+        in binary '.npy' files in a session resource instead of as custom
+        fields, so they don't need to be parsed from strings and are only
+        downloaded when accessed. If None (the default), all fields are
+        stored as custom fields
     """
 
     type = 'xnat'
@@ -73,12 +99,20 @@ class XnatRepo(Repository):
     DERIVED_FROM_FIELD = '__derived_from__'
     PROV_SCAN = '__prov__'
     PROV_RESOURCE = 'PROV'
+    FIELD_ARRAYS_RESOURCE = 'FIELD_ARRAYS'
+    BINARY_ARRAY_PREFIX = 'npy:'
+    SESSION_TOKEN_SUFFIX = '.jsession'
+    MANIFEST_FNAME = '__manifest__.json'
+    JOURNAL_FNAME = '__journal__.pkl'
     depth = 2
 
     def __init__(self, server, cache_dir, user=None,
                  password=None, check_md5=True, race_cond_delay=30,
-                 session_filter=None):
-        super().__init__()
+                 session_filter=None, share_session=False, offline=False,
+                 binary_array_length=None):
+        # Checksums are compared against the MD5 digests calculated by XNAT
+        super().__init__(checksum_algorithm='md5',
+                         binary_array_length=binary_array_length)
         if not isinstance(server, basestring):
             raise ArcanaUsageError(
                 "Invalid server url {}".format(server))
@@ -90,7 +124,12 @@ class XnatRepo(Repository):
         self._race_cond_delay = race_cond_delay
         self._check_md5 = check_md5
         self._session_filter = session_filter
+        self._share_session = share_session
+        self._offline = offline
         self._login = None
+        # Resolved project/subject/session objects, keyed by their labels,
+        # that are valid for the lifetime of the current connection
+        self._xobj_cache = {}
 
     def __hash__(self):
         return (hash(self.server)
@@ -114,15 +153,17 @@ class XnatRepo(Repository):
             return False  # For comparison with other types
         
     def __getstate__(self):
-        dct = self.__dict__.copy()
+        dct = super().__getstate__()
         del dct['_login']
         del dct['_connection_depth']
+        del dct['_xobj_cache']
         return dct
-    
+
     def __setstate__(self, state):
-        self.__dict__.update(state)
+        super().__setstate__(state)
         self._login = None
         self._connection_depth = 0
+        self._xobj_cache = {}
 
     @property
     def prov(self):
@@ -152,6 +193,10 @@ class XnatRepo(Repository):
     def check_md5(self):
         return self._check_md5
 
+    @property
+    def offline(self):
+        return self._offline
+
     @property
     def session_filter(self):
         return (re.compile(self._session_filter)
@@ -167,16 +212,87 @@ class XnatRepo(Repository):
             NoExitWrapper so the returned connection can be used
             in a "with" statement in the method.
         """
+        if self.offline:
+            return
         sess_kwargs = {}
         if self._user is not None:
             sess_kwargs['user'] = self._user
         if self._password is not None:
             sess_kwargs['password'] = self._password
-        self._login = xnat.connect(server=self._server, **sess_kwargs)
+        if not self._share_session:
+            self._login = xnat.connect(server=self._server, **sess_kwargs)
+        else:
+            token_path = self.session_token_path
+            # Lock the token file so that only one process performs a new
+            # login when the saved token has expired
+            with InterProcessLock(token_path + '.lock', logger=logger):
+                self._login = None
+                if op.exists(token_path):
+                    with open(token_path) as f:
+                        saved = f.read().split()
+                    # The user the session was logged in as is saved before
+                    # the token (tokens saved by earlier versions are alone)
+                    jsession = saved[-1] if saved else ''
+                    saved_user = saved[0] if len(saved) > 1 else None
+                    expected_user = (self._user if self._user is not None
+                                     else saved_user)
+                    try:
+                        # 'cli' flag stops the session being closed on the
+                        # server on disconnect so other processes can use it
+                        login = xnat.connect(
+                            server=self._server, jsession=jsession, cli=True)
+                    except XNATError:
+                        login = None
+                    # Expired sessions can also fall back to guest access,
+                    # which is rejected even when no user is specified (e.g.
+                    # netrc credentials) so private projects stay visible
+                    if login is not None and (
+                            login.logged_in_user not in (None, 'guest')
+                            and (expected_user is None
+                                 or login.logged_in_user == expected_user)):
+                        self._login = login
+                    else:
+                        if login is not None:
+                            login.disconnect()
+                        logger.info("Saved XNAT session for {} has expired, "
+                                    "logging in again".format(self.server))
+                if self._login is None:
+                    self._login = xnat.connect(server=self._server, cli=True,
+                                               **sess_kwargs)
+                    self._save_session_token(
+                        token_path, self._login.jsession,
+                        self._login.logged_in_user)
+        self._xobj_cache = {}
+
+    @property
+    def session_token_path(self):
+        """
+        Path to the file the shared session token for the server and user is
+        saved in
+        """
+        return op.join(self.cache_dir, '.' + special_char_re.sub(
+            '_', '{}_{}'.format(self.server, self._user))
+            + self.SESSION_TOKEN_SUFFIX)
+
+    @classmethod
+    def _save_session_token(cls, token_path, jsession, user=None):
+        # Write to a temporary file, only readable by the user, and move it
+        # into place so other processes never read a partial token
+        tmp_path = token_path + '.tmp'
+        fd = os.open(tmp_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC,
+                     stat.S_IRUSR | stat.S_IWUSR)
+        with os.fdopen(fd, 'w') as f:
+            if user is not None:
+                f.write(user + '\n')
+            f.write(jsession)
+        os.rename(tmp_path, token_path)
 
     def disconnect(self):
+        if self.offline:
+            return
         self._login.disconnect()
         self._login = None
+        self._xobj_cache = {}
 
     def dataset(self, name, **kwargs):
         """
@@ -219,6 +335,13 @@ class XnatRepo(Repository):
                 "Attempting to download {}, which has not been assigned a "
                 "file format (see Fileset.formatted)".format(fileset))
         self._check_repository(fileset)
+        if self.offline:
+            cache_path = self._cache_path(fileset)
+            if not op.exists(cache_path):
+                raise ArcanaError(
+                    "{} hasn't been downloaded to the cache ('{}') so it "
+                    "can't be accessed offline".format(fileset, cache_path))
+            return self._cached_paths(fileset, cache_path)
         with self:  # Connect to the XNAT repository if haven't already
             xsession = self.get_xsession(fileset)
             xscan = xsession.scans[fileset.name]
@@ -269,6 +392,13 @@ class XnatRepo(Repository):
                         tmp_dir, xresource, xscan, fileset,
                         xsession.label, cache_path)
                     shutil.rmtree(tmp_dir)
+        return self._cached_paths(fileset, cache_path)
+
+    def _cached_paths(self, fileset, cache_path):
+        """
+        Returns the primary and auxiliary paths of a fileset stored in the
+        cache
+        """
         if not fileset.format.directory:
             (primary_path, aux_paths) = fileset.format.assort_files(
                 op.join(cache_path, f) for f in os.listdir(cache_path))
@@ -279,9 +409,17 @@ class XnatRepo(Repository):
 
     def get_field(self, field):
         self._check_repository(field)
+        if self.offline:
+            return self._offline_field_value(field)
         with self:
             xsession = self.get_xsession(field)
             val = xsession.fields[field.name]
+            # Only list the files of the array resource for values that may
+            # reference them
+            if (val.startswith(self.BINARY_ARRAY_PREFIX)
+                    and self._binary_array_dtype(
+                        field.name, val, self._array_fnames(xsession))):
+                return self._download_binary_array(field, xsession)
             val = val.replace('&quot;', '"')
             val = parse_value(val)
         return val
@@ -292,55 +430,166 @@ class XnatRepo(Repository):
                 "Format of {} needs to be set before it is uploaded to {}"
                 .format(fileset, self))
         self._check_repository(fileset)
+        checksums = self._cache_fileset(fileset)
+        if self.offline:
+            self._journal(fileset.dataset, 'fileset', {
+                'name': fileset.name,
+                'format': fileset.format,
+                'frequency': fileset.frequency,
+                'subject_id': fileset.subject_id,
+                'visit_id': fileset.visit_id,
+                'from_analysis': fileset.from_analysis,
+                'id': fileset.id})
+        else:
+            self._upload_fileset(fileset, checksums)
+        return checksums
+
+    def _cache_fileset(self, fileset):
+        """
+        Copies the fileset into the cache directory and saves its checksums
+        alongside it
+
+        Returns
+        -------
+        checksums : dict[str, str]
+            The checksums of the files in the fileset
+        """
+        cache_path = self._cache_path(fileset)
+        # Make session cache dir
+        cache_path_dir = (op.dirname(cache_path)
+                          if fileset.format.directory else cache_path)
+        if os.path.exists(cache_path_dir):
+            shutil.rmtree(cache_path_dir)
+        os.makedirs(cache_path_dir, stat.S_IRWXU | stat.S_IRWXG)
+        # Checksums are calculated as the files are copied so they only need
+        # to be read once
+        checksums = fileset.transfer_to(
+            cache_path if fileset.format.directory
+            else op.join(cache_path, fileset.fname))
+        with open(cache_path + XnatRepo.MD5_SUFFIX, 'w',
+                  **JSON_ENCODING) as f:
+            json.dump(checksums, f, indent=2)
+        return checksums
+
+    def _upload_fileset(self, fileset, checksums):
+        """
+        Uploads the files of the fileset that differ from those stored on the
+        server (if any)
+        """
         # Open XNAT session
         with self:
             # Add session for derived scans if not present
             xsession = self.get_xsession(fileset)
-            cache_path = self._cache_path(fileset)
-            # Make session cache dir
-            cache_path_dir = (op.dirname(cache_path)
-                              if fileset.format.directory else cache_path)
-            if os.path.exists(cache_path_dir):
-                shutil.rmtree(cache_path_dir)
-            os.makedirs(cache_path_dir, stat.S_IRWXU | stat.S_IRWXG)
-            if fileset.format.directory:
-                shutil.copytree(fileset.path, cache_path)
-            else:
-                # Copy primary file
-                shutil.copyfile(fileset.path,
-                                op.join(cache_path, fileset.fname))
-                # Copy auxiliaries
-                for sc_fname, sc_path in fileset.aux_file_fnames_and_paths:
-                    shutil.copyfile(sc_path, op.join(cache_path, sc_fname))
-            with open(cache_path + XnatRepo.MD5_SUFFIX, 'w',
-                      **JSON_ENCODING) as f:
-                json.dump(fileset.calculate_checksums(), f, indent=2)
             # Upload to XNAT
             xscan = self._login.classes.MrScanData(
                 id=fileset.id, type=fileset.basename, parent=xsession)
             fileset.uri = xscan.uri
             # Select the first xnat_resource name to use to upload the data to
             resource_name = fileset.format.resource_names(self.type)[0]
+            if fileset.format.directory:
+                fnames_and_paths = [(f, op.join(fileset.path, f))
+                                    for f in sorted(os.listdir(fileset.path))]
+            else:
+                fnames_and_paths = [(fileset.fname, fileset.path)]
+                fnames_and_paths.extend(fileset.aux_file_fnames_and_paths)
             try:
                 xresource = xscan.resources[resource_name]
             except KeyError:
-                pass
+                xresource = None
+                to_upload, to_delete = fnames_and_paths, []
             else:
-                # Delete existing resource
-                # TODO: probably should have check to see if we want to
-                #       override it
-                xresource.delete()
-            xresource = xscan.create_resource(resource_name)
-            if fileset.format.directory:
-                for fname in os.listdir(fileset.path):
-                    xresource.upload(op.join(fileset.path, fname), fname)
-            else:
-                xresource.upload(fileset.path, fileset.fname)
-                for sc_fname, sc_path in fileset.aux_file_fnames_and_paths:
-                    xresource.upload(sc_path, sc_fname)
+                try:
+                    to_upload, to_delete = self._changed_files(
+                        xresource, fnames_and_paths, checksums,
+                        fileset.path)
+                except ArcanaError:
+                    # Resource can't be compared file-by-file so delete
+                    # it and upload the whole fileset again
+                    xresource.delete()
+                    xresource = None
+                    to_upload, to_delete = fnames_and_paths, []
+                else:
+                    if not to_upload and not to_delete:
+                        logger.info(
+                            "Skipping upload of {} as its contents match "
+                            "those already on the server".format(fileset))
+                        return
+            if xresource is None:
+                xresource = xscan.create_resource(resource_name)
+            for fname in to_delete:
+                xresource.files[fname].delete()
+            for fname, fpath in to_upload:
+                xresource.upload(fpath, fname, overwrite=True)
+
+    def _changed_files(self, xresource, fnames_and_paths, checksums,
+                       base_path):
+        """
+        Compares the local checksums of the files to upload with the digests
+        of the files already stored in the XNAT resource
+
+        Parameters
+        ----------
+        xresource : xnat.ResourceCatalog
+            The existing resource on the server
+        fnames_and_paths : list[tuple[str, str]]
+            The names the files are to be stored under in the resource and
+            their local paths
+        checksums : dict[str, str]
+            The local checksums of the fileset, as returned by
+            Fileset.calculate_checksums
+        base_path : str
+            The path of the fileset the keys of the checksums are relative to
+
+        Returns
+        -------
+        to_upload : list[tuple[str, str]]
+            The names and local paths of files that are missing on the server
+            or whose digests differ
+        to_delete : list[str]
+            The names of files in the resource that aren't in the fileset
+
+        Raises
+        ------
+        ArcanaError
+            If the local files can't be compared one-to-one with those in the
+            resource (e.g. nested sub-directories)
+        """
+        remote = {}
+        for r in self.login.get_json(xresource.uri + '/files')[
+                'ResultSet']['Result']:
+            if r['Name'] in remote:
+                raise ArcanaError(
+                    "Duplicate file name '{}' in {}".format(r['Name'],
+                                                             xresource))
+            remote[r['Name']] = r['digest']
+        to_upload = []
+        for fname, fpath in fnames_and_paths:
+            try:
+                local = checksums[op.relpath(fpath, base_path)]
+            except KeyError:
+                raise ArcanaError(
+                    "No checksum for '{}' (sub-directory?)".format(fpath))
+            if not remote.get(fname) or remote[fname] != local:
+                to_upload.append((fname, fpath))
+        to_delete = sorted(set(remote) - set(f for f, _ in fnames_and_paths))
+        return to_upload, to_delete
 
     def put_field(self, field):
         self._check_repository(field)
+        if self.offline:
+            self._journal(field.dataset, 'field', {
+                'name': field.name,
+                'value': field.value,
+                'dtype': field.dtype,
+                'array': field.array,
+                'frequency': field.frequency,
+                'subject_id': field.subject_id,
+                'visit_id': field.visit_id,
+                'from_analysis': field.from_analysis})
+            return
+        if self.stores_binary(field):
+            self._upload_binary_array(field)
+            return
         val = field.value
         if field.array:
             if field.dtype is str:
@@ -350,7 +599,107 @@ class XnatRepo(Repository):
             val = '"{}"'.format(val)
         with self:
             xsession = self.get_xsession(field)
+            previous = None
+            if field.array and field.dtype in BINARY_ARRAY_DTYPES.values():
+                try:
+                    previous = xsession.fields[field.name]
+                except KeyError:
+                    pass
             xsession.fields[field.name] = val
+            if previous is not None and previous.startswith(
+                    self.BINARY_ARRAY_PREFIX):
+                # The field was previously stored in binary
+                self._delete_binary_array(field, xsession)
+
+    def _field_array_path(self, field):
+        "The path the binary file of an array field is cached at"
+        return op.join(
+            self._cache_path(field, name=self.FIELD_ARRAYS_RESOURCE),
+            field.name + '.npy')
+
+    def _upload_binary_array(self, field):
+        """
+        Uploads the values of a large array field in a binary '.npy' file to
+        a session resource, and sets the custom field to reference it
+        """
+        array_path = self._field_array_path(field)
+        makedirs(op.dirname(array_path), exist_ok=True)
+        save_array(array_path, field.value, field.dtype)
+        with self:
+            xsession = self.get_xsession(field)
+            try:
+                xresource = xsession.resources[self.FIELD_ARRAYS_RESOURCE]
+            except KeyError:
+                xresource = xsession.create_resource(
+                    self.FIELD_ARRAYS_RESOURCE)
+            xresource.upload(array_path, op.basename(array_path),
+                             overwrite=True)
+            xsession.fields[field.name] = (self.BINARY_ARRAY_PREFIX
+                                           + field.dtype.__name__)
+
+    def _delete_binary_array(self, field, xsession):
+        """
+        Deletes the binary '.npy' file an array field was previously stored
+        in, along with its cached copy, so it isn't left behind once the
+        field is stored with the others
+        """
+        array_path = self._field_array_path(field)
+        if op.exists(array_path):
+            os.remove(array_path)
+        try:
+            xresource = xsession.resources[self.FIELD_ARRAYS_RESOURCE]
+        except KeyError:
+            return
+        fname = op.basename(array_path)
+        if fname in xresource.files:
+            xresource.files[fname].delete()
+
+    def _array_fnames(self, xsession):
+        "The names of the files in the binary array resource of a session"
+        try:
+            xresource = xsession.resources[self.FIELD_ARRAYS_RESOURCE]
+        except KeyError:
+            return []
+        return list(xresource.files.keys())
+
+    def _binary_array_dtype(self, name, value, array_fnames):
+        """
+        Returns the dtype of a field if its value references a binary '.npy'
+        file (see '_upload_binary_array') that exists in the session's
+        FIELD_ARRAYS resource, otherwise None. Checking for the file means
+        string values that happen to start with BINARY_ARRAY_PREFIX aren't
+        mistaken for references
+
+        Parameters
+        ----------
+        name : str
+            Name of the field
+        value : str
+            The value of the field stored in XNAT
+        array_fnames : list[str] | dict[str, str]
+            The names of the files in the FIELD_ARRAYS resource of the
+            session
+        """
+        if not value.startswith(self.BINARY_ARRAY_PREFIX):
+            return None
+        dtype = BINARY_ARRAY_DTYPES.get(value[len(self.BINARY_ARRAY_PREFIX):])
+        if dtype is None or name + '.npy' not in array_fnames:
+            return None
+        return dtype
+
+    def _download_binary_array(self, field, xsession):
+        """
+        Downloads the binary '.npy' file an array field is stored in into the
+        cache and loads its values
+        """
+        array_path = self._field_array_path(field)
+        makedirs(op.dirname(array_path), exist_ok=True)
+        tmp_path = '{}.{}.download'.format(array_path, os.getpid())
+        xresource = xsession.resources[self.FIELD_ARRAYS_RESOURCE]
+        xresource.files[op.basename(array_path)].download(tmp_path,
+                                                           verbose=False)
+        os.replace(tmp_path, array_path)
+        return load_array(array_path)
 
     def put_record(self, record, dataset):
         base_cache_path = self._cache_path(
@@ -364,6 +713,12 @@ class XnatRepo(Repository):
                     .format(base_cache_path))
         cache_path = op.join(base_cache_path, record.pipeline_name + '.json')
         record.save(cache_path)
+        if self.offline:
+            self._journal(dataset, 'record', record)
+            return
+        self._upload_record(record, dataset, cache_path)
+
+    def _upload_record(self, record, dataset, cache_path):
         # TODO: Should also save digest of prov.json to check to see if it
         #       has been altered remotely
         xsession = self.get_xsession(record, dataset=dataset)
@@ -396,6 +751,17 @@ class XnatRepo(Repository):
             corresponding key in the checksums dictionary to '.' to match
             the way it is generated locally by Arcana.
         """
+        if self.offline:
+            # Filesets written offline don't have a URI until they are pushed
+            md5_path = self._cache_path(fileset) + self.MD5_SUFFIX
+            try:
+                with open(md5_path, **JSON_ENCODING) as f:
+                    return json.load(f)
+            except IOError:
+                raise ArcanaError(
+                    "Checksums of {} haven't been saved in the cache ('{}') "
+                    "so they can't be accessed offline".format(fileset,
+                                                               md5_path))
         if fileset.uri is None:
             raise ArcanaUsageError(
                 "Can't retrieve checksums as URI has not been set for {}"
@@ -434,6 +800,9 @@ class XnatRepo(Repository):
             The provenance records found in the repository
         """
         subject_ids = self.convert_subject_ids(subject_ids)
+        if self.offline:
+            return self._find_data_in_manifest(dataset, subject_ids,
+                                               visit_ids, **kwargs)
         # Add derived visit IDs to list of visit ids to filter
         all_filesets = []
         all_fields = []
@@ -457,140 +826,513 @@ class XnatRepo(Repository):
             for session_xid in tqdm(session_xids,
                                     "Scanning sessions in '{}' project"
                                     .format(project_id)):
-                session_json = self._login.get_json(
-                    '/data/projects/{}/experiments/{}'.format(
-                        project_id, session_xid))['items'][0]
-                subject_xid = session_json['data_fields']['subject_ID']
-                subject_id = subject_xids_to_labels[subject_xid]
-                session_label = session_json['data_fields']['label']
-                session_uri = (
-                    '/data/archive/projects/{}/subjects/{}/experiments/{}'
-                    .format(project_id, subject_xid, session_xid))
-                # Get field values. We do this first so we can check for the
-                # DERIVED_FROM_FIELD to determine the correct session label and
-                # analysis name
-                field_values = {}
+                self._find_session_data(
+                    dataset, project_id, session_xid, subject_xids_to_labels,
+                    subject_ids, visit_ids, all_filesets, all_fields,
+                    all_records, **kwargs)
+        self._save_manifest(dataset, all_filesets, all_fields, all_records)
+        return all_filesets, all_fields, all_records
+
+    def find_session_ids(self, dataset, subject_ids=None, visit_ids=None):
+        """
+        Lists the sessions in the project from the labels of its subjects and
+        experiments, without requesting the contents of each session (see
+        _index_sessions)
+        """
+        if self.offline:
+            return super().find_session_ids(dataset, subject_ids=subject_ids,
+                                            visit_ids=visit_ids)
+        subject_ids = self.convert_subject_ids(subject_ids)
+        _, node_xids = self._index_sessions(dataset)
+        return sorted(
+            (subj_id, visit_id) for subj_id, visit_id in node_xids
+            if None not in (subj_id, visit_id)
+            and (subject_ids is None or subj_id in subject_ids)
+            and (visit_ids is None or visit_id in visit_ids))
+
+    def find_node_data(self, dataset, subject_id=None, visit_id=None,
+                       **kwargs):
+        """
+        Only requests the contents of the XNAT sessions (acquired and
+        derived) whose labels indicate they belong to the node
+        """
+        if self.offline:
+            return super().find_node_data(dataset, subject_id=subject_id,
+                                          visit_id=visit_id, **kwargs)
+        subject_id = dataset.inv_map_subject_id(subject_id)
+        visit_id = dataset.inv_map_visit_id(visit_id)
+        filesets = []
+        fields = []
+        records = []
+        with self:
+            subject_xids_to_labels, node_xids = self._index_sessions(dataset)
+            for session_xid in node_xids.get((subject_id, visit_id), []):
+                self._find_session_data(
+                    dataset, dataset.name, session_xid,
+                    subject_xids_to_labels,
+                    None if subject_id is None else [subject_id],
+                    None if visit_id is None else [visit_id],
+                    filesets, fields, records, **kwargs)
+        # Sessions in subject/visit summaries are included by the filters so
+        # need to be removed
+        return tuple(
+            [i for i in items
+             if (i.subject_id, i.visit_id) == (subject_id, visit_id)]
+            for items in (filesets, fields, records))
+
+    def _index_sessions(self, dataset):
+        """
+        Groups the XNAT sessions in a project by the subject and visit IDs
+        of the node they belong to, as determined from their labels alone.
+        Relies on the '<subject-label>_<visit-id>' labelling of sessions
+        created by Arcana, where derived sessions are labelled
+        '<session-label>_<analysis>'. Any session labelled
+        '<visit-id>_<suffix>' is assumed to be derived from the session of
+        the visit if it exists (and is listed under each of the sessions it
+        could be derived from if ambiguous), so visit IDs shouldn't extend
+        other visit IDs of the same subject. The actual IDs of each session
+        are checked when its contents are loaded.
+
+        Parameters
+        ----------
+        dataset : Dataset
+            The dataset to index the sessions of
+
+        Returns
+        -------
+        subject_xids_to_labels : dict[str, str]
+            Maps the internal XNAT IDs of the subjects onto their labels
+        node_xids : dict[tuple[str, str], list[str]]
+            The internal XNAT IDs of the sessions belonging to each node,
+            keyed by its subject and visit IDs (None for summaries)
+        """
+        project_id = dataset.name
+        with self:
+            subject_xids_to_labels = {
+                s['ID']: s['label'] for s in self._login.get_json(
+                    '/data/projects/{}/subjects'.format(project_id))[
+                        'ResultSet']['Result']}
+            sessions = [
+                (s['ID'], s['label']) for s in self._login.get_json(
+                    '/data/projects/{}/experiments'.format(project_id))[
+                        'ResultSet']['Result']
+                if (self.session_filter is None
+                    or self.session_filter.match(s['label']))]
+        subject_labels = set(subject_xids_to_labels.values())
+        # Split the session labels into their subject label and remainder,
+        # matching the longest subject label the session label is prefixed by
+        split_labels = []
+        for session_xid, label in sessions:
+            subj_label = None
+            for i in reversed([i for i, c in enumerate(label) if c == '_']):
+                if label[:i] in subject_labels:
+                    subj_label = label[:i]
+                    break
+            if subj_label is None:
+                logger.warning(
+                    "Could not match session '{}' in '{}' project to a "
+                    "subject from its label".format(label, project_id))
+                continue
+            split_labels.append((session_xid, subj_label,
+                                 label[len(subj_label) + 1:]))
+        remainders = set((s, r) for _, s, r in split_labels)
+        node_xids = defaultdict(list)
+        for session_xid, subj_label, remainder in split_labels:
+            # Strip project ID from subject ID if required
+            if subj_label.startswith(project_id + '_'):
+                subject_id = subj_label[len(project_id) + 1:]
+            else:
+                subject_id = subj_label
+            if subject_id == self.SUMMARY_NAME:
+                subject_id = None
+            # Sessions labelled '<visit-id>_<analysis>', where a session for
+            # the visit exists, are assumed to be derived from it
+            derived_from = [
+                remainder[:i] for i, c in enumerate(remainder)
+                if c == '_' and (subj_label, remainder[:i]) in remainders]
+            for visit_id in (derived_from if derived_from else [remainder]):
+                if visit_id == self.SUMMARY_NAME:
+                    visit_id = None
+                node_xids[(subject_id, visit_id)].append(session_xid)
+        return subject_xids_to_labels, node_xids
+
+    def _find_session_data(self, dataset, project_id, session_xid,
+                           subject_xids_to_labels, subject_ids, visit_ids,
+                           all_filesets, all_fields, all_records, **kwargs):
+        """
+        Appends the filesets, fields and records found in an XNAT session to
+        the provided lists, unless the session is filtered out by the
+        subject and visit IDs
+        """
+        session_json = self._login.get_json(
+            '/data/projects/{}/experiments/{}'.format(
+                project_id, session_xid))['items'][0]
+        subject_xid = session_json['data_fields']['subject_ID']
+        subject_id = subject_xids_to_labels[subject_xid]
+        session_label = session_json['data_fields']['label']
+        session_uri = (
+            '/data/archive/projects/{}/subjects/{}/experiments/{}'
+            .format(project_id, subject_xid, session_xid))
+        # Get field values. We do this first so we can check for the
+        # DERIVED_FROM_FIELD to determine the correct session label and
+        # analysis name
+        field_values = {}
+        try:
+            fields_json = next(
+                c['items'] for c in session_json['children']
+                if c['field'] == 'fields/field')
+        except StopIteration:
+            pass
+        else:
+            for js in fields_json:
                 try:
-                    fields_json = next(
-                        c['items'] for c in session_json['children']
-                        if c['field'] == 'fields/field')
-                except StopIteration:
+                    value = js['data_fields']['field']
+                except KeyError:
                     pass
                 else:
-                    for js in fields_json:
-                        try:
-                            value = js['data_fields']['field']
-                        except KeyError:
-                            pass
-                        else:
-                            field_values[js['data_fields']['name']] = value
-                # Extract analysis name and derived-from session
-                if self.DERIVED_FROM_FIELD in field_values:
-                    df_sess_label = field_values.pop(self.DERIVED_FROM_FIELD)
-                    from_analysis = session_label[len(df_sess_label) + 1:]
-                    session_label = df_sess_label
-                else:
-                    from_analysis = None
-                # Strip subject ID from session label if required
-                if session_label.startswith(subject_id + '_'):
-                    visit_id = session_label[len(subject_id) + 1:]
-                else:
-                    visit_id = session_label
-                # Strip project ID from subject ID if required
-                if subject_id.startswith(project_id + '_'):
-                    subject_id = subject_id[len(project_id) + 1:]
-                # Check subject is summary or not and whether it is to be
-                # filtered
-                if subject_id == XnatRepo.SUMMARY_NAME:
-                    subject_id = None
-                elif not (subject_ids is None or subject_id in subject_ids):
-                    continue
-                # Check visit is summary or not and whether it is to be
-                # filtered
-                if visit_id == XnatRepo.SUMMARY_NAME:
-                    visit_id = None
-                elif not (visit_ids is None or visit_id in visit_ids):
-                    continue
-                # Determine frequency
-                if (subject_id, visit_id) == (None, None):
-                    frequency = 'per_dataset'
-                elif visit_id is None:
-                    frequency = 'per_subject'
-                elif subject_id is None:
-                    frequency = 'per_visit'
-                else:
-                    frequency = 'per_session'
-                # Append fields
-                for name, value in field_values.items():
-                    value = value.replace('&quot;', '"')
-                    all_fields.append(Field(
-                        name=name, value=value,
-                        dataset=dataset,
-                        frequency=frequency,
-                        subject_id=subject_id,
-                        visit_id=visit_id,
+                    field_values[js['data_fields']['name']] = value
+        # Extract analysis name and derived-from session
+        if self.DERIVED_FROM_FIELD in field_values:
+            df_sess_label = field_values.pop(self.DERIVED_FROM_FIELD)
+            from_analysis = session_label[len(df_sess_label) + 1:]
+            session_label = df_sess_label
+        else:
+            from_analysis = None
+        # Strip subject ID from session label if required
+        if session_label.startswith(subject_id + '_'):
+            visit_id = session_label[len(subject_id) + 1:]
+        else:
+            visit_id = session_label
+        # Strip project ID from subject ID if required
+        if subject_id.startswith(project_id + '_'):
+            subject_id = subject_id[len(project_id) + 1:]
+        # Check subject is summary or not and whether it is to be
+        # filtered
+        if subject_id == XnatRepo.SUMMARY_NAME:
+            subject_id = None
+        elif not (subject_ids is None or subject_id in subject_ids):
+            return
+        # Check visit is summary or not and whether it is to be
+        # filtered
+        if visit_id == XnatRepo.SUMMARY_NAME:
+            visit_id = None
+        elif not (visit_ids is None or visit_id in visit_ids):
+            return
+        # Determine frequency
+        if (subject_id, visit_id) == (None, None):
+            frequency = 'per_dataset'
+        elif visit_id is None:
+            frequency = 'per_subject'
+        elif subject_id is None:
+            frequency = 'per_visit'
+        else:
+            frequency = 'per_session'
+        # Get the names and digests of the files binary arrays are stored
+        # in, if any field values reference them
+        array_fnames = {}
+        if any(v.startswith(self.BINARY_ARRAY_PREFIX)
+               for v in field_values.values()):
+            session_resources = next(
+                (c['items'] for c in session_json['children']
+                 if c['field'] == 'resources/resource'), [])
+            if any(js['data_fields'].get('label')
+                   == self.FIELD_ARRAYS_RESOURCE
+                   for js in session_resources):
+                array_fnames = {
+                    r['Name']: r.get('digest') for r in self._login.get_json(
+                        '{}/resources/{}/files'.format(
+                            session_uri, self.FIELD_ARRAYS_RESOURCE))[
+                                'ResultSet']['Result']}
+        # Append fields
+        for name, value in field_values.items():
+            dtype = self._binary_array_dtype(name, value, array_fnames)
+            if dtype is not None:
+                # Binary arrays are only downloaded when accessed
+                value_kwargs = {'dtype': dtype, 'array': True,
+                                'modified': array_fnames[name + '.npy']}
+            else:
+                value_kwargs = {'value': value.replace('&quot;', '"')}
+            all_fields.append(Field(
+                name=name, **value_kwargs,
+                dataset=dataset,
+                frequency=frequency,
+                subject_id=subject_id,
+                visit_id=visit_id,
+                from_analysis=from_analysis,
+                **kwargs))
+        # Extract part of JSON relating to files
+        try:
+            scans_json = next(
+                c['items'] for c in session_json['children']
+                if c['field'] == 'scans/scan')
+        except StopIteration:
+            scans_json = []
+        for scan_json in scans_json:
+            scan_id = scan_json['data_fields']['ID']
+            scan_type = scan_json['data_fields'].get('type', '')
+            scan_quality = scan_json['data_fields'].get('quality',
+                                                        None)
+            scan_uri = '{}/scans/{}'.format(session_uri, scan_id)
+            try:
+                resources_json = next(
+                    c['items'] for c in scan_json['children']
+                    if c['field'] == 'file')
+            except StopIteration:
+                resources = {}
+            else:
+                resources = {js['data_fields']['label']: js
+                             for js in resources_json}
+            # Remove auto-generated snapshots directory
+            resources.pop('SNAPSHOTS', None)
+            if scan_type == self.PROV_SCAN:
+                # Download provenance JSON files and parse into
+                # records
+                temp_dir = tempfile.mkdtemp()
+                try:
+                    with tempfile.TemporaryFile() as temp_zip:
+                        self._login.download_stream(
+                            scan_uri + '/files', temp_zip,
+                            format='zip')
+                        with ZipFile(temp_zip) as zip_file:
+                            zip_file.extractall(temp_dir)
+                    for base_dir, _, fnames in os.walk(temp_dir):
+                        for fname in fnames:
+                            if fname.endswith('.json'):
+                                pipeline_name = fname[:-len('.json')]
+                                json_path = op.join(base_dir, fname)
+                                all_records.append(
+                                    Record.load(
+                                        pipeline_name, frequency,
+                                        subject_id, visit_id,
+                                        from_analysis, json_path))
+                finally:
+                    shutil.rmtree(temp_dir, ignore_errors=True)
+            else:
+                for resource, resource_json in resources.items():
+                    all_filesets.append(Fileset(
+                        scan_type, id=scan_id, uri=scan_uri,
+                        dataset=dataset, frequency=frequency,
+                        subject_id=subject_id, visit_id=visit_id,
                         from_analysis=from_analysis,
+                        quality=scan_quality,
+                        resource_name=resource,
+                        modified=self._resource_modified(resource_json),
                         **kwargs))
-                # Extract part of JSON relating to files
-                try:
-                    scans_json = next(
-                        c['items'] for c in session_json['children']
-                        if c['field'] == 'scans/scan')
-                except StopIteration:
-                    scans_json = []
-                for scan_json in scans_json:
-                    scan_id = scan_json['data_fields']['ID']
-                    scan_type = scan_json['data_fields'].get('type', '')
-                    scan_quality = scan_json['data_fields'].get('quality',
-                                                                None)
-                    scan_uri = '{}/scans/{}'.format(session_uri, scan_id)
-                    try:
-                        resources_json = next(
-                            c['items'] for c in scan_json['children']
-                            if c['field'] == 'file')
-                    except StopIteration:
-                        resources = {}
-                    else:
-                        resources = {js['data_fields']['label']:
-                                     js['data_fields'].get('format', None)
-                                     for js in resources_json}
-                    # Remove auto-generated snapshots directory
-                    resources.pop('SNAPSHOTS', None)
-                    if scan_type == self.PROV_SCAN:
-                        # Download provenance JSON files and parse into
-                        # records
-                        temp_dir = tempfile.mkdtemp()
-                        try:
-                            with tempfile.TemporaryFile() as temp_zip:
-                                self._login.download_stream(
-                                    scan_uri + '/files', temp_zip,
-                                    format='zip')
-                                with ZipFile(temp_zip) as zip_file:
-                                    zip_file.extractall(temp_dir)
-                            for base_dir, _, fnames in os.walk(temp_dir):
-                                for fname in fnames:
-                                    if fname.endswith('.json'):
-                                        pipeline_name = fname[:-len('.json')]
-                                        json_path = op.join(base_dir, fname)
-                                        all_records.append(
-                                            Record.load(
-                                                pipeline_name, frequency,
-                                                subject_id, visit_id,
-                                                from_analysis, json_path))
-                        finally:
-                            shutil.rmtree(temp_dir, ignore_errors=True)
+        logger.debug("Found node {}:{} on {}:{}".format(
+            subject_id, visit_id, self.server, project_id))
+
+    @classmethod
+    def _resource_modified(cls, resource_json):
+        """
+        Returns a stamp of the state of a resource from the fields XNAT lists
+        for it, which changes when its files are added to, removed or
+        replaced, so the fileset can be fingerprinted (see Tree.fingerprint)
+        without requesting the digests of its files
+        """
+        data_fields = resource_json.get('data_fields', {})
+        stamp = [data_fields.get('file_count'), data_fields.get('file_size'),
+                 resource_json.get('meta', {}).get('last_modified')]
+        if not any(s is not None for s in stamp):
+            return None
+        return json.dumps(stamp)
+
+    def push_journal(self, dataset):
+        """
+        Uploads the items that were written to the cache of the dataset while
+        the repository was offline
+
+        Parameters
+        ----------
+        dataset : Dataset
+            The dataset to upload the journaled items of
+        """
+        if self.offline:
+            raise ArcanaUsageError(
+                "Can't push journal of {} from an offline repository"
+                .format(dataset))
+        journal_path = self._journal_path(dataset)
+        if not op.exists(journal_path):
+            return
+        with InterProcessLock(journal_path + '.lock', logger=logger):
+            entries = self._read_journal(journal_path)
+            with self:
+                for item_type, item in tqdm(
+                        entries, "Pushing journal of {}".format(dataset)):
+                    if item_type == 'fileset':
+                        fileset = Fileset(dataset=dataset, **item)
+                        cache_path = self._cache_path(fileset)
+                        fileset._path, aux_files = self._cached_paths(
+                            fileset, cache_path)
+                        fileset._aux_files = (aux_files
+                                              if aux_files is not None
+                                              else {})
+                        with open(cache_path + self.MD5_SUFFIX,
+                                  **JSON_ENCODING) as f:
+                            checksums = json.load(f)
+                        self._upload_fileset(fileset, checksums)
+                    elif item_type == 'field':
+                        self.put_field(Field(dataset=dataset, **item))
+                    elif item_type == 'record':
+                        self._upload_record(item, dataset, op.join(
+                            self._cache_path(item, name=self.PROV_SCAN,
+                                             dataset=dataset),
+                            item.pipeline_name + '.json'))
                     else:
-                        for resource in resources:
-                            all_filesets.append(Fileset(
-                                scan_type, id=scan_id, uri=scan_uri,
-                                dataset=dataset, frequency=frequency,
-                                subject_id=subject_id, visit_id=visit_id,
-                                from_analysis=from_analysis,
-                                quality=scan_quality,
-                                resource_name=resource, **kwargs))
-                logger.debug("Found node {}:{} on {}:{}".format(
-                    subject_id, visit_id, self.server, project_id))
-        return all_filesets, all_fields, all_records
+                        assert False
+            os.remove(journal_path)
+        dataset.clear_cache()
+
+    def _journal(self, dataset, item_type, item):
+        """
+        Appends an item written while offline to the journal of the dataset
+        """
+        journal_path = self._journal_path(dataset)
+        makedirs(op.dirname(journal_path), exist_ok=True)
+        with InterProcessLock(journal_path + '.lock', logger=logger):
+            with open(journal_path, 'ab') as f:
+                pkl.dump((item_type, item), f)
+
+    def _load_journal(self, dataset):
+        """
+        Returns the (item type, item) entries of the journal of items written
+        to the dataset while offline, in the order they were written
+        """
+        journal_path = self._journal_path(dataset)
+        if not op.exists(journal_path):
+            return []
+        with InterProcessLock(journal_path + '.lock', logger=logger):
+            return self._read_journal(journal_path)
+
+    @classmethod
+    def _read_journal(cls, journal_path):
+        entries = []
+        with open(journal_path, 'rb') as f:
+            while True:
+                try:
+                    entries.append(pkl.load(f))
+                except EOFError:
+                    break
+        return entries
+
+    def _journal_path(self, dataset):
+        return op.join(self.dataset_cache_dir(dataset.name),
+                       self.JOURNAL_FNAME)
+
+    def _manifest_path(self, dataset):
+        return op.join(self.dataset_cache_dir(dataset.name),
+                       self.MANIFEST_FNAME)
+
+    def _save_manifest(self, dataset, filesets, fields, records):
+        """
+        Saves the data found in the dataset so it can be accessed offline
+        """
+        def ids(item):
+            return {'frequency': item.frequency,
+                    'subject_id': item.subject_id,
+                    'visit_id': item.visit_id,
+                    'from_analysis': item.from_analysis}
+        manifest = {
+            'filesets': [dict(name=f.name, id=f.id, uri=f.uri,
+                              quality=f.quality, modified=f.modified,
+                              resource_name=f._resource_name, **ids(f))
+                         for f in filesets],
+            # The values of binary arrays that haven't been downloaded are
+            # loaded from the cache when offline
+            'fields': [dict(name=f.name, value=f._value, **ids(f),
+                            **({'dtype': f.dtype.__name__, 'array': True,
+                                'modified': f.modified}
+                               if f._value is None else {}))
+                       for f in fields],
+            'records': [dict(pipeline_name=r.pipeline_name, prov=r.prov,
+                             **ids(r))
+                        for r in records]}
+        manifest_path = self._manifest_path(dataset)
+        makedirs(op.dirname(manifest_path), exist_ok=True)
+        tmp_path = manifest_path + '.tmp'
+        with open(tmp_path, 'w', **JSON_ENCODING) as f:
+            json.dump(manifest, f)
+        os.rename(tmp_path, manifest_path)
+
+    def _load_manifest(self, dataset):
+        manifest_path = self._manifest_path(dataset)
+        try:
+            with open(manifest_path, **JSON_ENCODING) as f:
+                return json.load(f)
+        except IOError:
+            raise ArcanaError(
+                "No manifest of {} has been saved in the cache ('{}'), the "
+                "repository needs to be accessed online first"
+                .format(dataset, manifest_path))
+
+    def _find_data_in_manifest(self, dataset, subject_ids=None,
+                               visit_ids=None, **kwargs):
+        """
+        Reconstructs the filesets, fields and records saved in the manifest
+        of the dataset, along with any items written while offline (see
+        '_journal'), which replace the items they overwrite
+        """
+        manifest = self._load_manifest(dataset)
+
+        def included(dct):
+            return ((dct['subject_id'] is None or subject_ids is None
+                     or dct['subject_id'] in subject_ids)
+                    and (dct['visit_id'] is None or visit_ids is None
+                         or dct['visit_id'] in visit_ids))
+
+        def key(dct, name_key='name'):
+            return (dct[name_key], dct['frequency'], dct['subject_id'],
+                    dct['visit_id'], dct['from_analysis'])
+        for dct in manifest['fields']:
+            if 'dtype' in dct:
+                dct['dtype'] = BINARY_ARRAY_DTYPES[dct['dtype']]
+        fileset_dcts = OrderedDict((key(d), d) for d in manifest['filesets'])
+        field_dcts = OrderedDict((key(d), d) for d in manifest['fields'])
+        record_dcts = OrderedDict((key(d, 'pipeline_name'), d)
+                                  for d in manifest['records'])
+        for item_type, item in self._load_journal(dataset):
+            if item_type == 'fileset':
+                fileset_dcts[key(item)] = item
+            elif item_type == 'field':
+                field_dcts[key(item)] = item
+            elif item_type == 'record':
+                dct = dict(pipeline_name=item.pipeline_name, prov=item.prov,
+                           frequency=item.frequency,
+                           subject_id=item.subject_id,
+                           visit_id=item.visit_id,
+                           from_analysis=item.from_analysis)
+                record_dcts[key(dct, 'pipeline_name')] = dct
+        filesets = [Fileset(dataset=dataset, **d, **kwargs)
+                    for d in fileset_dcts.values() if included(d)]
+        fields = [Field(dataset=dataset, **d, **kwargs)
+                  for d in field_dcts.values() if included(d)]
+        records = [Record(**d) for d in record_dcts.values() if included(d)]
+        return filesets, fields, records
+
+    def _offline_field_value(self, field):
+        """
+        Looks up the value of a field in the journal of items written offline
+        and then the manifest
+        """
+        key = (field.name, field.frequency, field.subject_id, field.visit_id,
+               field.from_analysis)
+        value = None
+        for item_type, item in self._load_journal(field.dataset):
+            if item_type == 'field' and key == (
+                    item['name'], item['frequency'], item['subject_id'],
+                    item['visit_id'], item['from_analysis']):
+                value = item['value']
+        if value is None:
+            for dct in self._load_manifest(field.dataset)['fields']:
+                if key == (dct['name'], dct['frequency'], dct['subject_id'],
+                           dct['visit_id'], dct['from_analysis']):
+                    value = dct['value']
+        if value is None and op.exists(self._field_array_path(field)):
+            value = load_array(self._field_array_path(field))
+        if value is None:
+            raise ArcanaError(
+                "No value for {} saved in the cache of {}"
+                .format(field, field.dataset))
+        return value
 
     def convert_subject_ids(self, subject_ids):
         """
@@ -642,6 +1384,9 @@ class XnatRepo(Repository):
         # Download resource to zip file
         zip_path = op.join(tmp_dir, 'download.zip')
         with open(zip_path, 'wb') as f:
+            if self._bandwidth_limiter is not None:
+                # Throttle each chunk as it is downloaded
+                f = self._bandwidth_limiter.writer(f)
             xresource.xnat_session.download_stream(
                 xresource.uri + '/files', f, format='zip', verbose=True)
         checksums = self.get_checksums(fileset)
@@ -703,18 +1448,35 @@ class XnatRepo(Repository):
     def get_xsession(self, item, dataset=None):
         """
         Returns the XNAT session and cache dir corresponding to the
-        item.
+        item. Resolved project, subject and session objects are cached for
+        the lifetime of the connection so repeated calls for the same session
+        don't require additional requests to the server.
         """
         if dataset is None:
             dataset = item.dataset
         subj_label, sess_label = self._get_item_labels(item, dataset=dataset)
         with self:
-            xproject = self._login.projects[dataset.name]
             try:
-                xsubject = xproject.subjects[subj_label]
+                return self._xobj_cache[(dataset.name, subj_label,
+                                         sess_label)]
             except KeyError:
-                xsubject = self._login.classes.SubjectData(
-                    label=subj_label, parent=xproject)
+                pass
+            try:
+                xproject = self._xobj_cache[(dataset.name,)]
+            except KeyError:
+                xproject = self._xobj_cache[(dataset.name,)] = (
+                    self._login.projects[dataset.name])
+            try:
+                xsubject = self._xobj_cache[(dataset.name, subj_label)]
+            except KeyError:
+                try:
+                    xsubject = xproject.subjects[subj_label]
+                except KeyError:
+                    xsubject = self._login.classes.SubjectData(
+                        label=subj_label, parent=xproject)
+                    # Reload the project's listing of subjects next time
+                    del self._xobj_cache[(dataset.name,)]
+                self._xobj_cache[(dataset.name, subj_label)] = xsubject
             try:
                 xsession = xsubject.experiments[sess_label]
             except KeyError:
@@ -724,6 +1486,10 @@ class XnatRepo(Repository):
                     xsession.fields[
                         self.DERIVED_FROM_FIELD] = self._get_item_labels(
                             item, dataset=dataset, no_from_analysis=True)[1]
+                # The subject's listing of experiments is now stale so it
+                # will need to be reloaded when other sessions are looked up
+                del self._xobj_cache[(dataset.name, subj_label)]
+            self._xobj_cache[(dataset.name, subj_label, sess_label)] = xsession
         return xsession
 
     def _get_item_labels(self, item, no_from_analysis=False, dataset=None):
@@ -2,10 +2,11 @@ import os
 import os.path as op
 import errno
 from itertools import chain
+from collections import defaultdict
 import stat
-import shutil
 import logging
 import json
+from threading import get_ident
 from fasteners import InterProcessLock
 from arcana.data import Fileset, Field
 from arcana.pipeline.provenance import Record
@@ -14,7 +15,9 @@ from arcana.exceptions import (
     ArcanaRepositoryError,
     ArcanaMissingDataException,
     ArcanaInsufficientRepoDepthError)
-from arcana.utils import get_class_info, HOSTNAME, split_extension
+from arcana.utils import (
+    get_class_info, HOSTNAME, split_extension, BINARY_ARRAY_DTYPES,
+    save_array, load_array, array_stamp)
 from .local import LocalFileSystemRepo
 
 
@@ -49,6 +52,7 @@ class XnatCSRepo(LocalFileSystemRepo):
     FIELDS_FNAME = 'fields.json'
     PROV_DIR = '__prov__'
     LOCK_SUFFIX = '.lock'
+    FIELD_ARRAYS_DIR = '.field-arrays'
     DEFAULT_SUBJECT_ID = 'SUBJECT'
     DEFAULT_VISIT_ID = 'VISIT'
     MAX_DEPTH = 2
@@ -101,16 +105,16 @@ class XnatCSRepo(LocalFileSystemRepo):
         """
         Update the value of the field from the repository
         """
-        # Load fields JSON, locking to prevent read/write conflicts
-        # Would be better if only checked if locked to allow
-        # concurrent reads but not possible with multi-process
-        # locks (in my understanding at least).
+        # The fields JSON is replaced atomically when it is written (see
+        # 'put_fields'), so it can be read without locking
         fpath = self.fields_json_path(field)
         try:
-            with InterProcessLock(fpath + self.LOCK_SUFFIX,
-                                  logger=logger), open(fpath, 'r') as f:
+            with open(fpath, 'r') as f:
                 dct = json.load(f)
             val = dct[field.name]
+            if isinstance(val, dict):
+                # Stored in a binary array file (see 'put_fields')
+                val = load_array(op.join(op.dirname(fpath), val['npy']))
             if field.array:
                 val = [field.dtype(v) for v in val]
             else:
@@ -132,42 +136,69 @@ class XnatCSRepo(LocalFileSystemRepo):
         """
         Inserts or updates a fileset in the repository
         """
-        target_path = self.fileset_path(fileset)
-        if op.isfile(fileset.path):
-            shutil.copyfile(fileset.path, target_path)
-            # Copy side car files into repository
-            for aux_name, aux_path in fileset.format.default_aux_file_paths(
-                    target_path).items():
-                shutil.copyfile(fileset.format.aux_files[aux_name], aux_path)
-        elif op.isdir(fileset.path):
-            if op.exists(target_path):
-                shutil.rmtree(target_path)
-            shutil.copytree(fileset.path, target_path)
-        else:
-            assert False
+        # Checksums are calculated as the files are copied so they only need
+        # to be read once
+        return fileset.transfer_to(self.fileset_path(fileset),
+                                   method=self.transfer_method(fileset))
 
     def put_field(self, field):
         """
         Inserts or updates a field in the repository
         """
-        fpath = self.fields_json_path(field)
-        # Open fields JSON, locking to prevent other processes
-        # reading or writing
-        with InterProcessLock(fpath + self.LOCK_SUFFIX, logger=logger):
-            try:
-                with open(fpath, 'r') as f:
-                    dct = json.load(f)
-            except IOError as e:
-                if e.errno == errno.ENOENT:
-                    dct = {}
-                else:
-                    raise
-            if field.array:
-                dct[field.name] = list(field.value)
-            else:
-                dct[field.name] = field.value
-            with open(fpath, 'w') as f:
-                json.dump(dct, f, indent=2)
+        self.put_fields([field])
+
+    def put_fields(self, fields):
+        """
+        Inserts or updates fields in the repository. The fields stored in
+        each fields JSON are updated together, with a single write that
+        replaces the file atomically. Large numeric arrays are saved in '.npy'
+        files in a hidden sub-directory and referenced from the JSON (see
+        'binary_array_length')
+        """
+        by_path = defaultdict(list)
+        for field in fields:
+            by_path[self.fields_json_path(field)].append(field)
+        for fpath, path_fields in by_path.items():
+            # Lock the fields JSON to prevent other processes writing to it
+            # between it being read and replaced
+            with InterProcessLock(fpath + self.LOCK_SUFFIX, logger=logger):
+                try:
+                    with open(fpath, 'r') as f:
+                        dct = json.load(f)
+                except IOError as e:
+                    if e.errno == errno.ENOENT:
+                        dct = {}
+                    else:
+                        raise
+                stale_arrays = []
+                for field in path_fields:
+                    if self.stores_binary(field):
+                        array_path = op.join(op.dirname(fpath),
+                                             self.FIELD_ARRAYS_DIR,
+                                             field.name + '.npy')
+                        os.makedirs(op.dirname(array_path), exist_ok=True)
+                        save_array(array_path, field.value, field.dtype)
+                        dct[field.name] = {
+                            'npy': op.relpath(array_path, op.dirname(fpath)),
+                            'dtype': field.dtype.__name__}
+                        continue
+                    prev = dct.get(field.name)
+                    if isinstance(prev, dict):
+                        stale_arrays.append(
+                            op.join(op.dirname(fpath), prev['npy']))
+                    if field.array:
+                        dct[field.name] = list(field.value)
+                    else:
+                        dct[field.name] = field.value
+                tmp_path = '{}.{}-{}.tmp'.format(fpath, os.getpid(),
+                                                get_ident())
+                with open(tmp_path, 'w') as f:
+                    json.dump(dct, f, indent=2)
+                os.replace(tmp_path, fpath)
+                # Binary files of arrays that are now stored in the JSON are
+                # removed once it no longer references them
+                for array_path in stale_arrays:
+                    os.remove(array_path)
 
     def put_record(self, record, dataset):
         fpath = self.prov_json_path(record, dataset)
@@ -276,12 +307,21 @@ class XnatCSRepo(LocalFileSystemRepo):
                 with open(op.join(session_path,
                                   self.FIELDS_FNAME), 'r') as f:
                     dct = json.load(f)
-                all_fields.extend(
-                    Field(name=k, value=v, frequency=frequency,
-                          subject_id=subj_id, visit_id=visit_id,
-                          dataset=dataset, from_analysis=from_analysis,
-                          **kwargs)
-                    for k, v in list(dct.items()))
+                for name, value in dct.items():
+                    if isinstance(value, dict):
+                        # Binary arrays are only loaded when accessed
+                        value_kwargs = {
+                            'dtype': BINARY_ARRAY_DTYPES[value['dtype']],
+                            'array': True,
+                            'modified': array_stamp(
+                                op.join(session_path, value['npy']))}
+                    else:
+                        value_kwargs = {'value': value}
+                    all_fields.append(
+                        Field(name=name, frequency=frequency,
+                              subject_id=subj_id, visit_id=visit_id,
+                              dataset=dataset, from_analysis=from_analysis,
+                              **value_kwargs, **kwargs))
             if self.PROV_DIR in dirs:
                 if from_analysis is None:
                     raise ArcanaRepositoryError(
@@ -2,4 +2,9 @@ from .base import (
     split_extension, classproperty, lower, JSON_ENCODING, parse_value,
     run_matlab_cmd, find_mismatch, package_dir, dir_modtime,
     PATH_SUFFIX, FIELD_SUFFIX, CHECKSUM_SUFFIX, ExitStack, makedirs,
-    get_class_info, HOSTNAME, extract_package_version, wrap_text)
+    get_class_info, HOSTNAME, extract_package_version, wrap_text,
+    BandwidthLimiter, intern, DEFAULT_CHECKSUM_ALGORITHM, CHECKSUM_ALGORITHMS,
+    checksum_hasher, format_checksum, checksum_algorithm, FileHasher,
+    HASH_CHUNK_SIZE, staging_dir, swap_in, wait_for_swap,
+    remove_in_background, BINARY_ARRAY_DTYPES, save_array, load_array,
+    array_stamp, CACHE_ENTRY_FNAME, in_cache_entry)
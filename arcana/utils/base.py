@@ -1,16 +1,36 @@
 from past.builtins import basestring
 from future.utils import PY3, PY2
+import sys
 import subprocess as sp
 import importlib
+import hashlib
+import mmap
 from itertools import zip_longest
+import os
 import os.path
 import errno
+import time
+import threading
 from nipype.interfaces.matlab import MatlabCommand
 import shutil
 import tempfile
 from arcana.exceptions import ArcanaUsageError
 from contextlib import ExitStack
 from collections.abc import Iterable
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+try:
+    import xxhash
+except ImportError:
+    xxhash = None
+try:
+    import fcntl
+except ImportError:
+    fcntl = None  # Not available on Windows
+try:
+    import ctypes
+except ImportError:
+    ctypes = None
 
 
 PATH_SUFFIX = '_path'
@@ -81,6 +101,535 @@ def lower(s):
     return s.lower()
 
 
+def intern(s):
+    """
+    Interns a string so that the many copies of the same names and IDs in a
+    large data tree share a single object. Values that can't be interned
+    (e.g. None, integer IDs and str subclasses) are returned unchanged
+    """
+    if type(s) is str:
+        return sys.intern(s)
+    return s
+
+
+# The algorithm used to calculate the checksums of filesets unless another is
+# set for the repository they are stored in. Checksums calculated with other
+# algorithms are prefixed with the name of the algorithm, e.g.
+# 'blake2b:<hex-digest>', so provenance records saved with MD5 checksums
+# remain valid
+DEFAULT_CHECKSUM_ALGORITHM = 'md5'
+
+CHECKSUM_ALGORITHMS = {
+    'md5': hashlib.md5,
+    'sha1': hashlib.sha1,
+    'sha256': hashlib.sha256}
+if hasattr(hashlib, 'blake2b'):  # Python >= 3.6
+    CHECKSUM_ALGORITHMS['blake2b'] = hashlib.blake2b
+if xxhash is not None:
+    CHECKSUM_ALGORITHMS['xxh3'] = xxhash.xxh3_128
+
+
+def checksum_hasher(algorithm):
+    """
+    Returns a new hash object for the given checksum algorithm (see
+    CHECKSUM_ALGORITHMS)
+    """
+    try:
+        return CHECKSUM_ALGORITHMS[algorithm]()
+    except KeyError:
+        raise ArcanaUsageError(
+            "Unrecognised checksum algorithm '{}' (available: '{}'){}".format(
+                algorithm, "', '".join(sorted(CHECKSUM_ALGORITHMS)),
+                (". The 'xxhash' package needs to be installed to use 'xxh3'"
+                 if algorithm == 'xxh3' else
+                 ". Python >= 3.6 is required to use 'blake2b'"
+                 if algorithm == 'blake2b' else '')))
+
+
+def format_checksum(digest, algorithm):
+    """
+    Prefixes the hex digest of a file with the algorithm used to calculate it,
+    unless it is the default algorithm
+    """
+    if algorithm == DEFAULT_CHECKSUM_ALGORITHM:
+        return digest
+    return '{}:{}'.format(algorithm, digest)
+
+
+def checksum_algorithm(checksums):
+    """
+    Returns the algorithm used to calculate a dictionary of fileset checksums
+    (or the first of a list of them as saved in provenance records), or None
+    if it can't be determined (e.g. for field values or empty dictionaries)
+    """
+    while isinstance(checksums, list) and checksums:
+        checksums = checksums[0]
+    if not isinstance(checksums, dict) or not checksums:
+        return None
+    digest = next(iter(checksums.values()))
+    if not isinstance(digest, basestring):
+        return None
+    prefix, sep, _ = digest.partition(':')
+    return prefix if sep else DEFAULT_CHECKSUM_ALGORITHM
+
+
+HASH_CHUNK_SIZE = 2 ** 20  # 1MB
+
+
+class FileHasher(object):
+    """
+    Calculates the digests of files, spreading the files of multi-file
+    filesets (e.g. DICOM series) over a shared pool of threads (hashlib and
+    file reads release the GIL so the files are hashed concurrently). Files
+    larger than 'mmap_threshold' are memory-mapped and hashed in a single
+    call rather than read in chunks. The digests are identical to those
+    calculated serially.
+
+    The number of threads is set globally with 'set_num_threads', e.g.
+
+        >>> FileHasher.set_num_threads(1)  # Hash files serially
+    """
+
+    num_threads = min(8, os.cpu_count() or 1)
+    mmap_threshold = 2 ** 26  # 64MB
+
+    TRANSFER_METHODS = ('copy', 'reflink', 'hardlink', 'move')
+
+    _executor = None
+    _executor_lock = threading.Lock()
+
+    @classmethod
+    def set_num_threads(cls, num_threads):
+        """
+        Sets the number of threads used to hash the files of a fileset.
+        A new pool is swapped in for subsequent calls, while the old pool is
+        not shut down so that calls that have already fetched it can still
+        submit to it. Its threads exit once it has drained and is no longer
+        referenced.
+        """
+        if num_threads < 1:
+            raise ArcanaUsageError(
+                "The number of hashing threads must be at least 1 ({})"
+                .format(num_threads))
+        with cls._executor_lock:
+            cls.num_threads = num_threads
+            cls._executor = cls._new_executor()
+
+    @classmethod
+    def hash_file(cls, path, algorithm):
+        """
+        Returns the hex digest of a file
+
+        Parameters
+        ----------
+        path : str
+            Path of the file to hash
+        algorithm : str
+            The checksum algorithm (see CHECKSUM_ALGORITHMS)
+        """
+        fhash = checksum_hasher(algorithm)
+        with open(path, 'rb') as f:
+            if os.fstat(f.fileno()).st_size >= cls.mmap_threshold:
+                with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as m:
+                    fhash.update(m)
+            else:
+                # Calculate hash in chunks so we don't run out of memory for
+                # large files.
+                for chunk in iter(lambda: f.read(HASH_CHUNK_SIZE), b''):
+                    fhash.update(chunk)
+        return fhash.hexdigest()
+
+    @classmethod
+    def hash_files(cls, paths, algorithm):
+        """
+        Returns the hex digests of a list of files, hashed concurrently if
+        there is more than one file and more than one thread
+
+        Parameters
+        ----------
+        paths : list[str]
+            Paths of the files to hash
+        algorithm : str
+            The checksum algorithm (see CHECKSUM_ALGORITHMS)
+
+        Returns
+        -------
+        digests : list[str]
+            The digests of the files in the same order as the paths
+        """
+        paths = list(paths)
+        checksum_hasher(algorithm)  # Check algorithm before spawning threads
+        if len(paths) < 2 or cls.num_threads < 2:
+            return [cls.hash_file(p, algorithm) for p in paths]
+        return list(cls._get_executor().map(
+            lambda p: cls.hash_file(p, algorithm), paths))
+
+    @classmethod
+    def copy_file(cls, src_path, dst_path, algorithm):
+        """
+        Copies a file (and its permissions), calculating its digest from the
+        data as it is copied so the file only needs to be read once
+
+        Parameters
+        ----------
+        src_path : str
+            Path of the file to copy
+        dst_path : str
+            Path to copy the file to
+        algorithm : str
+            The checksum algorithm (see CHECKSUM_ALGORITHMS)
+
+        Returns
+        -------
+        digest : str
+            The hex digest of the file
+        """
+        fhash = checksum_hasher(algorithm)
+        with open(src_path, 'rb') as fsrc, open(dst_path, 'wb') as fdst:
+            for chunk in iter(lambda: fsrc.read(HASH_CHUNK_SIZE), b''):
+                fhash.update(chunk)
+                fdst.write(chunk)
+        shutil.copymode(src_path, dst_path)
+        return fhash.hexdigest()
+
+    @classmethod
+    def transfer_file(cls, src_path, dst_path, algorithm, method='copy'):
+        """
+        Transfers a file to a new location and returns its digest. Files that
+        are copied are hashed as they are copied (see 'copy_file'), otherwise
+        the transferred file is hashed. Methods that aren't possible for the
+        file (e.g. hard-linking or renaming across filesystems, or cloning
+        on a filesystem without copy-on-write support) fall back to copying
+
+        Parameters
+        ----------
+        src_path : str
+            Path of the file to transfer
+        dst_path : str
+            Path to transfer the file to
+        algorithm : str
+            The checksum algorithm (see CHECKSUM_ALGORITHMS)
+        method : str
+            How the file is transferred, one of TRANSFER_METHODS:
+            'copy', 'reflink' (a copy-on-write clone), 'hardlink' or 'move'
+
+        Returns
+        -------
+        digest : str
+            The hex digest of the file
+        """
+        if method == 'copy':
+            return cls.copy_file(src_path, dst_path, algorithm)
+        elif method == 'reflink':
+            transferred = _reflink(src_path, dst_path)
+        elif method in ('hardlink', 'move'):
+            if os.path.lexists(dst_path):
+                os.remove(dst_path)
+            try:
+                if method == 'move':
+                    os.replace(src_path, dst_path)
+                else:
+                    os.link(src_path, dst_path)
+            except OSError as e:
+                if e.errno not in (errno.EXDEV, errno.EPERM, errno.EMLINK,
+                                   errno.ENOTSUP):
+                    raise
+                transferred = False
+            else:
+                transferred = True
+        else:
+            raise ArcanaUsageError(
+                "Unrecognised transfer method '{}' (available '{}')".format(
+                    method, "', '".join(cls.TRANSFER_METHODS)))
+        if not transferred:
+            digest = cls.copy_file(src_path, dst_path, algorithm)
+            if method == 'move':
+                os.remove(src_path)
+            return digest
+        return cls.hash_file(dst_path, algorithm)
+
+    @classmethod
+    def transfer_files(cls, src_and_dst_paths, algorithm, method='copy'):
+        """
+        Transfers a list of files, returning their digests (see
+        'transfer_file'). Multiple files are transferred concurrently
+
+        Parameters
+        ----------
+        src_and_dst_paths : list[tuple[str, str]]
+            Paths of the files to transfer and the paths to transfer them to
+        algorithm : str
+            The checksum algorithm (see CHECKSUM_ALGORITHMS)
+        method : str
+            How the files are transferred (see 'transfer_file')
+
+        Returns
+        -------
+        digests : list[str]
+            The digests of the files in the same order as the paths
+        """
+        src_and_dst_paths = list(src_and_dst_paths)
+        checksum_hasher(algorithm)  # Check algorithm before spawning threads
+        if len(src_and_dst_paths) < 2 or cls.num_threads < 2:
+            return [cls.transfer_file(s, d, algorithm, method)
+                    for s, d in src_and_dst_paths]
+        return list(cls._get_executor().map(
+            lambda p: cls.transfer_file(p[0], p[1], algorithm, method),
+            src_and_dst_paths))
+
+    @classmethod
+    def _get_executor(cls):
+        with cls._executor_lock:
+            if cls._executor is None:
+                cls._executor = cls._new_executor()
+            return cls._executor
+
+    @classmethod
+    def _new_executor(cls):
+        return thread_pool(cls.num_threads, 'arcana-hashing')
+
+
+def thread_pool(max_workers, name_prefix):
+    """
+    Creates a ThreadPoolExecutor, naming its threads with the given prefix
+    where supported (Python >= 3.6)
+    """
+    if sys.version_info >= (3, 6):
+        return ThreadPoolExecutor(max_workers=max_workers,
+                                  thread_name_prefix=name_prefix)
+    return ThreadPoolExecutor(max_workers=max_workers)
+
+
+# The ioctl request to clone a file on Linux filesystems that support
+# copy-on-write (e.g. Btrfs and XFS)
+FICLONE = 0x40049409
+
+
+def _reflink(src_path, dst_path):
+    """
+    Clones a file using copy-on-write where supported by the filesystem,
+    returning whether it was successful
+    """
+    if fcntl is None:
+        return False
+    with open(src_path, 'rb') as fsrc, open(dst_path, 'wb') as fdst:
+        try:
+            fcntl.ioctl(fdst.fileno(), FICLONE, fsrc.fileno())
+        except OSError:
+            return False
+    shutil.copymode(src_path, dst_path)
+    return True
+
+
+def staging_dir(path):
+    """
+    Creates a hidden temporary directory alongside 'path' (i.e. on the same
+    filesystem) that a replacement for 'path' can be written into before it
+    is swapped in with 'swap_in'
+    """
+    dpath, name = os.path.split(os.path.abspath(path))
+    os.makedirs(dpath, exist_ok=True)
+    return tempfile.mkdtemp(prefix='.{}.'.format(name), suffix='.tmp',
+                            dir=dpath)
+
+
+# The arguments to renameat2 to atomically exchange two paths on Linux
+AT_FDCWD = -100
+RENAME_EXCHANGE = 2
+
+# How long (in seconds) readers wait for a path that is being swapped in by
+# two renames to reappear (see 'wait_for_swap')
+SWAP_WAIT = 5.0
+
+
+def _renameat2():
+    """
+    Returns the renameat2 function from the C library if it is available
+    (Linux with glibc >= 2.28), otherwise None
+    """
+    if ctypes is None or not sys.platform.startswith('linux'):
+        return None
+    try:
+        libc = ctypes.CDLL(None, use_errno=True)
+        func = libc.renameat2
+    except (OSError, AttributeError):
+        return None
+    func.argtypes = [ctypes.c_int, ctypes.c_char_p, ctypes.c_int,
+                     ctypes.c_char_p, ctypes.c_uint]
+    func.restype = ctypes.c_int
+    return func
+
+
+renameat2 = _renameat2()
+
+
+def _exchange(path1, path2):
+    """
+    Atomically exchanges two paths, returning whether it was successful
+    (i.e. whether the platform and filesystem support it)
+    """
+    if renameat2 is None:
+        return False
+    if renameat2(AT_FDCWD, os.fsencode(path1), AT_FDCWD,
+                 os.fsencode(path2), RENAME_EXCHANGE) == 0:
+        return True
+    err = ctypes.get_errno()
+    if err in (errno.EINVAL, errno.ENOSYS, errno.EOPNOTSUPP):
+        return False  # Not supported by the kernel or filesystem
+    raise OSError(err, os.strerror(err), path1, None, path2)
+
+
+def swap_in(new_path, path, staging):
+    """
+    Replaces 'path' with 'new_path', so readers either see the old or the
+    new contents and never a partially written directory. Where supported
+    (Linux >= 3.15 on most local filesystems) the two paths are exchanged
+    atomically with renameat2. Otherwise the existing file or directory is
+    renamed into the staging directory before 'new_path' is renamed into
+    its place, leaving a brief window in which 'path' doesn't exist, which
+    readers bridge with 'wait_for_swap'. The staging directory, along with
+    the previous contents, is then deleted in a background thread so large
+    directories don't hold up the caller
+
+    Parameters
+    ----------
+    new_path : str
+        Path of the replacement, within the staging directory
+    path : str
+        The path to replace
+    staging : str
+        The staging directory created by 'staging_dir'
+
+    Returns
+    -------
+    thread : threading.Thread
+        The thread the staging directory is deleted in
+    """
+    if not (os.path.lexists(path) and _exchange(new_path, path)):
+        if os.path.lexists(path):
+            os.rename(path, os.path.join(staging, 'previous'))
+        os.rename(new_path, path)
+    return remove_in_background(staging)
+
+
+def wait_for_swap(path, timeout=SWAP_WAIT):
+    """
+    Waits for a missing path to reappear if it is being replaced by
+    'swap_in' (i.e. a staging directory exists alongside it) on a platform
+    that can't exchange paths atomically
+
+    Parameters
+    ----------
+    path : str
+        The path to wait for
+    timeout : float
+        The maximum number of seconds to wait
+
+    Returns
+    -------
+    exists : bool
+        Whether the path exists
+    """
+    dpath, name = os.path.split(os.path.abspath(path))
+    prefix = '.{}.'.format(name)
+    deadline = time.time() + timeout
+    while not os.path.lexists(path):
+        try:
+            swapping = any(n.startswith(prefix) and n.endswith('.tmp')
+                           for n in os.listdir(dpath))
+        except OSError:
+            return False
+        if not swapping or time.time() > deadline:
+            return False
+        time.sleep(0.01)
+    return True
+
+
+def remove_in_background(path):
+    """
+    Deletes a directory in a background thread. The thread isn't a daemon so
+    the deletion is completed before the interpreter exits
+
+    Returns
+    -------
+    thread : threading.Thread
+        The thread the directory is deleted in
+    """
+    thread = threading.Thread(target=shutil.rmtree, args=(path,),
+                              kwargs={'ignore_errors': True},
+                              name='arcana-remove')
+    thread.start()
+    return thread
+
+
+# The file that marks the root of an entry in a cache of conversion outputs
+# (see CachedInterface in arcana.utils.interfaces)
+CACHE_ENTRY_FNAME = '__outputs__.json'
+
+
+def in_cache_entry(path):
+    """
+    Whether a path is within an entry of a cache of conversion outputs (see
+    CachedInterface), which are shared between pipelines and runs so
+    mustn't be moved or hard-linked from
+    """
+    dpath = os.path.abspath(path)
+    while True:
+        if os.path.exists(os.path.join(dpath, CACHE_ENTRY_FNAME)):
+            return True
+        parent = os.path.dirname(dpath)
+        if parent == dpath:
+            return False
+        dpath = parent
+
+
+# The dtypes of array fields that can be stored in binary '.npy' files,
+# keyed by the names they are referenced by in the repository
+BINARY_ARRAY_DTYPES = {'int': int, 'float': float}
+
+
+def save_array(path, values, dtype):
+    """
+    Saves the values of an array field to a binary '.npy' file. The array is
+    written to a temporary file first and renamed into place, so readers
+    never see a partially written array
+
+    Parameters
+    ----------
+    path : str
+        Path of the '.npy' file to save
+    values : list[int] | list[float]
+        The values of the field
+    dtype : type
+        The dtype of the field, one of BINARY_ARRAY_DTYPES
+    """
+    tmp_path = '{}.{}-{}.tmp'.format(path, os.getpid(), threading.get_ident())
+    with open(tmp_path, 'wb') as f:
+        np.save(f, np.asarray(values, dtype=dtype))
+    os.replace(tmp_path, path)
+
+
+def load_array(path):
+    """
+    Loads the values of an array field saved by 'save_array'. The values are
+    read straight from the binary data into a list without being parsed
+    """
+    return np.load(path).tolist()
+
+
+def array_stamp(path):
+    """
+    Returns a stamp of the modification time and size of a file saved by
+    'save_array', which changes when the array is rewritten, or None if the
+    file doesn't exist
+    """
+    try:
+        st = os.stat(path)
+    except OSError:
+        return None
+    return '{}:{}:{}'.format(path, st.st_mtime_ns, st.st_size)
+
+
 if PY3:
     JSON_ENCODING = {'encoding': 'utf-8'}
     from os import makedirs  # @UnusedImport
@@ -294,3 +843,73 @@ def wrap_text(text, line_length, indent, prefix_indent=False):
     if prefix_indent:
         wrapped = ' ' * indent + wrapped
     return wrapped
+
+
+class BandwidthLimiter(object):
+    """
+    Limits the average rate of data transfers shared between multiple
+    threads by delaying the caller after each transfer until the total
+    amount transferred is within the allowed rate
+
+    Parameters
+    ----------
+    max_rate : float
+        The maximum average transfer rate in bytes per second
+    """
+
+    def __init__(self, max_rate):
+        if max_rate <= 0:
+            raise ArcanaUsageError(
+                "Maximum transfer rate must be positive ({})"
+                .format(max_rate))
+        self.max_rate = max_rate
+        self._lock = threading.Lock()
+        self._start = None
+        self._total = 0
+
+    def throttle(self, nbytes):
+        """
+        Records a transfer of 'nbytes' and sleeps until the average rate
+        since the first transfer is below the maximum rate
+        """
+        with self._lock:
+            now = time.time()
+            if self._start is None:
+                self._start = now
+            self._total += nbytes
+            delay = self._start + self._total / self.max_rate - now
+        if delay > 0:
+            time.sleep(delay)
+
+    def writer(self, stream):
+        """
+        Wraps a writable stream so that each write to it is throttled, for
+        limiting the rate of downloads that are streamed to a file in chunks
+        """
+        return ThrottledWriter(stream, self)
+
+
+class ThrottledWriter(object):
+    """
+    A writable stream that records the size of each chunk written to it with
+    a BandwidthLimiter, delaying the caller as required
+
+    Parameters
+    ----------
+    stream : file-like
+        The stream to write to
+    limiter : BandwidthLimiter
+        The limiter to throttle the writes with
+    """
+
+    def __init__(self, stream, limiter):
+        self._stream = stream
+        self._limiter = limiter
+
+    def write(self, data):
+        nbytes = self._stream.write(data)
+        self._limiter.throttle(len(data))
+        return nbytes
+
+    def __getattr__(self, name):
+        return getattr(self._stream, name)
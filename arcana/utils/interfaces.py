@@ -5,7 +5,17 @@ import os
 import math
 import os.path as op
 import re
+import sys
 import shutil
+import json
+import stat
+import hashlib
+import logging
+import threading
+import gzip
+import tarfile
+import zipfile
+from collections import deque
 from nipype.interfaces.base import (
     TraitedSpec, traits, BaseInterface, File,
     Directory, CommandLineInputSpec, CommandLine, DynamicTraitedSpec,
@@ -19,7 +29,12 @@ from nipype.utils.filemanip import filename_to_list
 from nipype.interfaces.base import OutputMultiPath, InputMultiPath
 import numpy as np
 from arcana.exceptions import ArcanaError, ArcanaDesignError
-from .base import split_extension
+from .base import (
+    split_extension, FileHasher, staging_dir, thread_pool, remove_in_background,
+    CACHE_ENTRY_FNAME)
+
+
+logger = logging.getLogger('arcana')
 
 
 bash_resources = op.abspath(op.join(op.dirname(__file__), 'resources', 'bash'))
@@ -568,6 +583,465 @@ class UnTarGzDir(CommandLine):
         return outputs
 
 
+# Extract archives with the 'data' filter where available (Python >= 3.8.17,
+# 3.9.17, 3.10.12 and 3.11.4), which rejects members that would be written
+# outside of the destination directory
+TAR_EXTRACT_KWARGS = ({'filter': 'data'} if hasattr(tarfile, 'data_filter')
+                      else {})
+
+
+def archived_dir_name(names):
+    """
+    Returns the name of the single top-level directory of an archive (as
+    created by ZipDir, TarGzDir and their native equivalents) from the names
+    of its members
+    """
+    top_level = sorted(set(n.lstrip('/').split('/')[0] for n in names) - {''})
+    if len(top_level) > 1:
+        raise ArcanaUsageError(
+            "Zip repositorys can only contain a single directory, found "
+            "'{}'".format("', '".join(top_level)))
+    if not top_level:
+        raise ArcanaUsageError(
+            "No files or directories found in unzipped directory")
+    return top_level[0]
+
+
+class ParallelGzipWriter(object):
+    """
+    A writable file object that gzips the data written to it in blocks,
+    which are compressed concurrently in a pool of threads (zlib releases the
+    GIL while compressing). Each block is written as a separate gzip member,
+    which gzip readers (e.g. 'gzip.open', 'tar -z' and 'tarfile' except in
+    its streaming modes) decompress as a single stream
+
+    Parameters
+    ----------
+    path : str
+        Path of the gzip file to write
+    num_threads : int
+        The number of threads to compress the blocks with
+    compresslevel : int
+        The gzip compression level (1-9)
+    block_size : int
+        The number of uncompressed bytes in each block
+    """
+
+    BLOCK_SIZE = 2 ** 20  # 1MB
+
+    def __init__(self, path, num_threads, compresslevel=6,
+                 block_size=BLOCK_SIZE):
+        self._num_threads = num_threads
+        self._compresslevel = compresslevel
+        self._block_size = block_size
+        self._buffer = bytearray()
+        self._pending = deque()
+        self._num_blocks = 0
+        self._file = open(path, 'wb')
+        self._executor = thread_pool(num_threads, 'arcana-gzip')
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    @property
+    def closed(self):
+        return self._file.closed
+
+    def write(self, data):
+        self._buffer += data
+        while len(self._buffer) >= self._block_size:
+            self._submit(bytes(self._buffer[:self._block_size]))
+            del self._buffer[:self._block_size]
+        return len(data)
+
+    def close(self):
+        if self._file.closed:
+            return
+        try:
+            if self._buffer or not self._num_blocks:
+                self._submit(bytes(self._buffer))
+                self._buffer = bytearray()
+            while self._pending:
+                self._file.write(self._pending.popleft().result())
+        finally:
+            self._executor.shutdown()
+            self._file.close()
+
+    def _submit(self, block):
+        self._pending.append(self._executor.submit(
+            gzip.compress, block, self._compresslevel))
+        self._num_blocks += 1
+        # Write completed blocks in order, limiting the number of blocks
+        # held in memory
+        while len(self._pending) > 2 * self._num_threads:
+            self._file.write(self._pending.popleft().result())
+
+
+class NativeZipDirInputSpec(BaseInterfaceInputSpec):
+    dirname = Directory(exists=True, mandatory=True, desc='directory name')
+    zipped = File(genfile=True, desc=("The zipped zip file"))
+    ext_prefix = traits.Str(
+        mandatory=False, default='', usedefault=True,
+        desc=("Extra extension to prepend before .zip is appended to "
+              "file name"))
+    compresslevel = traits.Range(
+        low=0, high=9, value=6, usedefault=True,
+        desc=("The deflate compression level (0-9). Requires Python >= 3.7, "
+              "otherwise zlib's default level is used"))
+
+
+class NativeZipDir(BaseInterface):
+    """
+    Creates a zip repository from a given folder in-process using 'zipfile',
+    storing paths relative to the parent of the folder as ZipDir does
+    """
+
+    input_spec = NativeZipDirInputSpec
+    output_spec = ZipDirOutputSpec
+    zip_ext = '.zip'
+
+    def _run_interface(self, runtime):
+        dirname = op.abspath(self.inputs.dirname)
+        base_dir = op.dirname(dirname)
+        kwargs = {}
+        if sys.version_info >= (3, 7):
+            kwargs['compresslevel'] = self.inputs.compresslevel
+        with zipfile.ZipFile(
+                op.abspath(self._gen_filename('zipped')), 'w',
+                compression=zipfile.ZIP_DEFLATED, **kwargs) as zip_file:
+            for root, dirs, files in os.walk(dirname):
+                dirs.sort()
+                zip_file.write(root, op.relpath(root, base_dir))
+                for fname in sorted(files):
+                    fpath = op.join(root, fname)
+                    zip_file.write(fpath, op.relpath(fpath, base_dir))
+        return runtime
+
+    def _list_outputs(self):
+        outputs = self._outputs().get()
+        outputs['zipped'] = op.abspath(
+            self._gen_filename('zipped'))
+        return outputs
+
+    def _gen_filename(self, name):
+        if name == 'zipped':
+            if isdefined(self.inputs.zipped):
+                fname = self.inputs.zipped
+            else:
+                fname = (op.basename(self.inputs.dirname) +
+                         self.inputs.ext_prefix + self.zip_ext)
+        else:
+            assert False
+        return fname
+
+
+class NativeUnzipDirInputSpec(BaseInterfaceInputSpec):
+    zipped = File(exists=True, mandatory=True, desc='zipped file name')
+
+
+class NativeUnzipDir(BaseInterface):
+    """
+    Unzips a folder that was zipped by ZipDir in-process using 'zipfile'.
+    The unzipped folder is determined from the contents of the archive
+    """
+
+    input_spec = NativeUnzipDirInputSpec
+    output_spec = UnzipDirOutputSpec
+
+    def _run_interface(self, runtime):
+        with zipfile.ZipFile(self.inputs.zipped) as zip_file:
+            self.unzipped = archived_dir_name(zip_file.namelist())
+            zip_file.extractall(os.getcwd())
+        return runtime
+
+    def _list_outputs(self):
+        outputs = self._outputs().get()
+        outputs['unzipped'] = op.join(os.getcwd(), self.unzipped)
+        return outputs
+
+
+class NativeTarGzDirInputSpec(BaseInterfaceInputSpec):
+    dirname = Directory(exists=True, mandatory=True, desc='directory name')
+    zipped = File(genfile=True, desc=("The tar_gz file"))
+    compresslevel = traits.Range(
+        low=1, high=9, value=6, usedefault=True,
+        desc="The gzip compression level (1-9)")
+    num_threads = traits.Int(
+        1, usedefault=True,
+        desc=("The number of threads to compress the archive with. If "
+              "greater than 1, the archive is compressed in blocks in "
+              "parallel (see ParallelGzipWriter)"))
+
+
+class NativeTarGzDir(BaseInterface):
+    """
+    Creates a tar_gzip repository from a given folder in-process using
+    'tarfile', storing paths relative to the parent of the folder as TarGzDir
+    does. The archive can be compressed by multiple threads
+    """
+
+    input_spec = NativeTarGzDirInputSpec
+    output_spec = TarGzDirOutputSpec
+    targz_ext = '.tar.gz'
+
+    def _run_interface(self, runtime):
+        dirname = op.abspath(self.inputs.dirname)
+        zipped = op.abspath(self._gen_filename('zipped'))
+        if self.inputs.num_threads > 1:
+            with ParallelGzipWriter(
+                    zipped, self.inputs.num_threads,
+                    compresslevel=self.inputs.compresslevel) as gz_file:
+                with tarfile.open(fileobj=gz_file, mode='w|') as tar_file:
+                    tar_file.add(dirname, arcname=op.basename(dirname))
+        else:
+            with tarfile.open(
+                    zipped, mode='w:gz',
+                    compresslevel=self.inputs.compresslevel) as tar_file:
+                tar_file.add(dirname, arcname=op.basename(dirname))
+        return runtime
+
+    def _list_outputs(self):
+        outputs = self._outputs().get()
+        outputs['zipped'] = op.abspath(self._gen_filename('zipped'))
+        return outputs
+
+    def _gen_filename(self, name):
+        if name == 'zipped':
+            if isdefined(self.inputs.zipped):
+                fname = self.inputs.zipped
+            else:
+                fname = op.basename(self.inputs.dirname) + self.targz_ext
+        else:
+            assert False
+        return fname
+
+
+class NativeUnTarGzDirInputSpec(BaseInterfaceInputSpec):
+    gzipped = File(exists=True, mandatory=True, desc=("The tar_gz file"))
+
+
+class NativeUnTarGzDir(BaseInterface):
+    """
+    Unzip a folder created using TarGz in-process using 'tarfile', streaming
+    the members of the archive as they are decompressed
+    """
+
+    input_spec = NativeUnTarGzDirInputSpec
+    output_spec = UnTarGzDirOutputSpec
+
+    def _run_interface(self, runtime):
+        names = []
+        # The archive is decompressed with 'gzip' instead of 'tarfile' as it
+        # supports the multiple gzip members written by ParallelGzipWriter
+        with gzip.open(self.inputs.gzipped) as gz_file, tarfile.open(
+                fileobj=gz_file, mode='r|') as tar_file:
+            for member in tar_file:
+                names.append(member.name)
+                tar_file.extract(member, os.getcwd(), **TAR_EXTRACT_KWARGS)
+        self.gunzipped = archived_dir_name(names)
+        return runtime
+
+    def _list_outputs(self):
+        outputs = self._outputs().get()
+        outputs['gunzipped'] = op.join(os.getcwd(), self.gunzipped)
+        return outputs
+
+
+def default_dir_mode(parent):
+    """
+    Returns the permissions a new directory in 'parent' is created with,
+    i.e. those allowed by the umask of the process
+    """
+    probe = op.join(parent, '.mode-probe.{}-{}.tmp'.format(
+        os.getpid(), threading.get_ident()))
+    os.mkdir(probe)
+    try:
+        return stat.S_IMODE(os.stat(probe).st_mode)
+    finally:
+        os.rmdir(probe)
+
+
+class CachedInterface(BaseInterface):
+    """
+    Wraps an interface (e.g. a format converter) so that its outputs are
+    saved in a cache directory keyed by the contents of its input file or
+    directory, the values of its other inputs and any additional key
+    provided. If the outputs have already been cached (e.g. by another
+    pipeline or a previous run) they are returned from the cache instead of
+    running the wrapped interface again.
+
+    The inputs and outputs of the wrapper are those of the wrapped interface
+    (the input spec object is shared), so it can be used in place of it.
+    Cached outputs shouldn't be modified by downstream nodes.
+
+    Parameters
+    ----------
+    interface : nipype.BaseInterface
+        The interface to wrap
+    input_name : str
+        The name of the input file or directory to key the cache by
+    cache_dir : str
+        The directory to cache the outputs in. Can be shared between
+        processes (and users), with concurrently cached entries resolved by
+        the first to be renamed into place. Entries that are missing any of
+        their cached files (e.g. removed by hand) are rebuilt
+    key : dict
+        Additional (JSON serialisable) values to key the cache by, e.g. the
+        class of the converter the interface belongs to
+    """
+
+    OUTPUTS_FNAME = CACHE_ENTRY_FNAME
+
+    def __init__(self, interface, input_name, cache_dir, key=None):
+        self.input_spec = interface.input_spec
+        self.output_spec = interface.output_spec
+        super(CachedInterface, self).__init__()
+        self.inputs = interface.inputs
+        self._interface = interface
+        self._input_name = input_name
+        self._cache_dir = cache_dir
+        self._key = key if key is not None else {}
+        self._cached_outputs = None
+
+    @property
+    def wrapped_interface(self):
+        return self._interface
+
+    @property
+    def cache_dir(self):
+        return self._cache_dir
+
+    def cache_key(self):
+        """
+        Returns the key the outputs are cached under, a hex digest of the
+        contents of the input, the values of the other inputs and the
+        additional key values
+        """
+        input_path = getattr(self.inputs, self._input_name)
+        if op.isdir(input_path):
+            fpaths = sorted(op.join(root, f)
+                            for root, _, files in os.walk(input_path)
+                            for f in files)
+            base_dir = input_path
+        else:
+            # Include auxiliary files that are stored alongside the input
+            base_dir, fname = op.split(input_path)
+            stem = split_extension(fname)[0]
+            fpaths = sorted(
+                op.join(base_dir, f) for f in os.listdir(base_dir)
+                if (f == fname or split_extension(f)[0] == stem)
+                and op.isfile(op.join(base_dir, f)))
+        checksums = {
+            op.relpath(p, base_dir): d for p, d in zip(
+                fpaths, FileHasher.hash_files(fpaths, 'md5'))}
+        inputs = {k: v for k, v in self.inputs.get().items()
+                  if k != self._input_name and isdefined(v)}
+        key = json.dumps(
+            {'interface': '{}.{}'.format(type(self._interface).__module__,
+                                         type(self._interface).__name__),
+             'input': checksums, 'inputs': inputs, 'key': self._key},
+            sort_keys=True, default=repr)
+        return hashlib.sha1(key.encode()).hexdigest()
+
+    def _run_interface(self, runtime):
+        entry_dir = op.join(self._cache_dir, self.cache_key())
+        cached = self._load_entry(entry_dir)
+        if cached is not None:
+            logger.info("Using outputs of %s cached in '%s'",
+                        type(self._interface).__name__, entry_dir)
+        else:
+            cached = self._cache_outputs(entry_dir)
+        outputs, paths = cached
+        paths = set(paths)
+        self._cached_outputs = self._map_paths(
+            outputs, lambda p: op.join(entry_dir, p) if p in paths else p)
+        return runtime
+
+    def _load_entry(self, entry_dir):
+        """
+        Loads the outputs saved in a cache entry and the paths of the outputs
+        (relative to the entry) stored in it, or returns None if the entry
+        doesn't exist or is missing any of its files
+        """
+        try:
+            with open(op.join(entry_dir, self.OUTPUTS_FNAME)) as f:
+                cached = json.load(f)
+        except (IOError, OSError, ValueError):
+            return None
+        if not isinstance(cached, dict) or 'files' not in cached:
+            return None  # Saved in an older format
+        if not all(op.exists(op.join(entry_dir, p))
+                   for p in chain(cached['paths'], cached['files'])):
+            return None
+        return cached['outputs'], cached['paths']
+
+    def _cache_outputs(self, entry_dir):
+        """
+        Runs the wrapped interface in a staging directory, which is renamed
+        into place as the cache entry, replacing any incomplete entry
+        """
+        staging = staging_dir(entry_dir)
+        try:
+            outputs = self._interface.run(cwd=staging).outputs.get()
+            # Save output paths relative to the cache entry
+            paths = []
+
+            def relative(path):
+                if not path.startswith(staging + os.sep):
+                    return path
+                paths.append(op.relpath(path, staging))
+                return paths[-1]
+            outputs = self._map_paths(outputs, relative)
+            files = sorted(
+                op.relpath(op.join(root, f), staging)
+                for root, _, fnames in os.walk(staging) for f in fnames)
+            with open(op.join(staging, self.OUTPUTS_FNAME), 'w') as f:
+                json.dump({'outputs': outputs, 'paths': paths,
+                           'files': files}, f)
+            # Temporary directories are only accessible by their owner, so
+            # the permissions of a new directory are applied instead
+            os.chmod(staging, default_dir_mode(staging))
+            if op.exists(entry_dir) and self._load_entry(entry_dir) is None:
+                # Move the incomplete entry aside so it can be replaced
+                invalid = staging_dir(entry_dir)
+                try:
+                    os.rename(entry_dir, op.join(invalid, 'invalid'))
+                except OSError:
+                    pass  # Already replaced by another process
+                remove_in_background(invalid)
+            try:
+                os.rename(staging, entry_dir)
+            except OSError:
+                cached = self._load_entry(entry_dir)
+                if cached is None:
+                    raise
+                return cached  # Cached concurrently by another process
+        finally:
+            shutil.rmtree(staging, ignore_errors=True)
+        return outputs, paths
+
+    def _list_outputs(self):
+        outputs = self._outputs().get()
+        outputs.update((k, v) for k, v in self._cached_outputs.items()
+                       if v is not None)
+        return outputs
+
+    @classmethod
+    def _map_paths(cls, value, func):
+        if isinstance(value, str):
+            return func(value)
+        elif isinstance(value, (list, tuple)):
+            return [cls._map_paths(v, func) for v in value]
+        elif isinstance(value, dict):
+            return {k: cls._map_paths(v, func) for k, v in value.items()}
+        elif not isdefined(value):
+            return None
+        return value
+
+
 class SelectOneInputSpec(BaseInterfaceInputSpec):
     inlist = InputMultiPath(
         traits.Any, mandatory=True, desc='list of values to choose from')
@@ -0,0 +1,251 @@
+"""
+Generates synthetic datasets of arbitrary size for scaling tests and
+benchmarks (see benchmarks/scaling.py)
+"""
+import os
+import os.path as op
+import json
+import hashlib
+import zlib
+from arcana.data import Fileset, Field
+from arcana.data.file_format import text_format
+from arcana.pipeline.provenance import Record
+from arcana.repository import Dataset, LocalFileSystemRepo
+
+
+class SyntheticDataset(object):
+    """
+    A parametric description of a dataset containing acquired filesets and
+    fields in every session, along with derived filesets and fields and the
+    provenance records of the pipelines that generated them. The dataset can
+    either be generated in memory or written to disk in the layout of a
+    LocalFileSystemRepo.
+
+    Acquired filesets and fields are named 'fileset<i>' and 'field<i>' and
+    derived items 'derived_fileset<i>' and 'derived_field<i>'. The derived
+    items are assigned to the pipelines ('pipeline<i>') in turn.
+
+    Parameters
+    ----------
+    num_subjects : int
+        Number of subjects in the dataset
+    num_visits : int
+        Number of visits of each subject
+    filesets_per_session : int
+        Number of acquired (text) filesets in each session
+    fields_per_session : int
+        Number of acquired fields in each session
+    derived_filesets_per_session : int
+        Number of derived (text) filesets in each session
+    derived_fields_per_session : int
+        Number of derived fields in each session
+    pipelines_per_session : int
+        Number of pipelines, and therefore provenance records, the derived
+        items of each session are split between
+    file_size : int
+        Size in bytes of each fileset
+    analysis_name : str
+        Name of the analysis the derived items are generated by
+    """
+
+    FILESET_NAME = 'fileset{}'
+    FIELD_NAME = 'field{}'
+    DERIVED_FILESET_NAME = 'derived_fileset{}'
+    DERIVED_FIELD_NAME = 'derived_field{}'
+    PIPELINE_NAME = 'pipeline{}'
+    DATETIME = '2019-01-01T00:00:00'
+
+    def __init__(self, num_subjects, num_visits, filesets_per_session=2,
+                 fields_per_session=2, derived_filesets_per_session=1,
+                 derived_fields_per_session=1, pipelines_per_session=1,
+                 file_size=16, analysis_name='synthetic'):
+        self.num_subjects = num_subjects
+        self.num_visits = num_visits
+        self.filesets_per_session = filesets_per_session
+        self.fields_per_session = fields_per_session
+        self.derived_filesets_per_session = derived_filesets_per_session
+        self.derived_fields_per_session = derived_fields_per_session
+        self.pipelines_per_session = pipelines_per_session
+        self.file_size = file_size
+        self.analysis_name = analysis_name
+
+    def __repr__(self):
+        return ("{}(num_subjects={}, num_visits={}, filesets={}, fields={}, "
+                "derived_filesets={}, derived_fields={}, pipelines={})"
+                .format(type(self).__name__, self.num_subjects,
+                        self.num_visits, self.filesets_per_session,
+                        self.fields_per_session,
+                        self.derived_filesets_per_session,
+                        self.derived_fields_per_session,
+                        self.pipelines_per_session))
+
+    @property
+    def num_sessions(self):
+        return self.num_subjects * self.num_visits
+
+    @property
+    def subject_ids(self):
+        return ['SUBJ{:05d}'.format(i) for i in range(self.num_subjects)]
+
+    @property
+    def visit_ids(self):
+        return ['VISIT{}'.format(i) for i in range(self.num_visits)]
+
+    @property
+    def session_ids(self):
+        return [(s, v) for s in self.subject_ids for v in self.visit_ids]
+
+    @property
+    def fileset_names(self):
+        return [self.FILESET_NAME.format(i)
+                for i in range(self.filesets_per_session)]
+
+    @property
+    def field_names(self):
+        return [self.FIELD_NAME.format(i)
+                for i in range(self.fields_per_session)]
+
+    @property
+    def derived_fileset_names(self):
+        return [self.DERIVED_FILESET_NAME.format(i)
+                for i in range(self.derived_filesets_per_session)]
+
+    @property
+    def derived_field_names(self):
+        return [self.DERIVED_FIELD_NAME.format(i)
+                for i in range(self.derived_fields_per_session)]
+
+    @property
+    def pipeline_names(self):
+        return [self.PIPELINE_NAME.format(i)
+                for i in range(self.pipelines_per_session)]
+
+    def pipeline_outputs(self, pipeline_name):
+        """
+        The names of the derived items generated by the given pipeline
+        """
+        i = self.pipeline_names.index(pipeline_name)
+        return (self.derived_fileset_names + self.derived_field_names)[
+            i::self.pipelines_per_session]
+
+    def contents(self, subject_id, visit_id, name):
+        """
+        The contents of a fileset, which are unique to each fileset
+        """
+        prefix = '{}_{}_{}:'.format(subject_id, visit_id, name)
+        return (prefix + 'x' * max(self.file_size - len(prefix), 0))[
+            :self.file_size]
+
+    def field_value(self, subject_id, visit_id, name):
+        return (zlib.crc32('{}_{}_{}'.format(subject_id, visit_id,
+                                             name).encode()) % 1000) / 10.0
+
+    def items(self, dataset=None):
+        """
+        Generates the items of the dataset in memory, i.e. the data that
+        would be returned by Repository.find_data
+
+        Parameters
+        ----------
+        dataset : Dataset | None
+            The dataset the items belong to
+
+        Returns
+        -------
+        filesets : list[Fileset]
+            All the filesets in the dataset
+        fields : list[Field]
+            All the fields in the dataset
+        records : list[Record]
+            All the provenance records in the dataset
+        """
+        filesets = []
+        fields = []
+        records = []
+        for subject_id, visit_id in self.session_ids:
+            for name in self.fileset_names:
+                filesets.append(Fileset(
+                    name, text_format, subject_id=subject_id,
+                    visit_id=visit_id, dataset=dataset))
+            for name in self.field_names:
+                fields.append(Field(
+                    name, self.field_value(subject_id, visit_id, name),
+                    subject_id=subject_id, visit_id=visit_id,
+                    dataset=dataset))
+            for name in self.derived_fileset_names:
+                filesets.append(Fileset(
+                    name, text_format, subject_id=subject_id,
+                    visit_id=visit_id, dataset=dataset,
+                    from_analysis=self.analysis_name))
+            for name in self.derived_field_names:
+                fields.append(Field(
+                    name, self.field_value(subject_id, visit_id, name),
+                    subject_id=subject_id, visit_id=visit_id,
+                    dataset=dataset, from_analysis=self.analysis_name))
+            records.extend(self.records(subject_id, visit_id))
+        return filesets, fields, records
+
+    def records(self, subject_id, visit_id):
+        """
+        The provenance records of the pipelines in the given session, which
+        contain the checksums of the derived items
+        """
+        records = []
+        for pipeline_name in self.pipeline_names:
+            outputs = {}
+            for name in self.pipeline_outputs(pipeline_name):
+                if name in self.derived_field_names:
+                    outputs[name] = self.field_value(subject_id, visit_id,
+                                                     name)
+                else:
+                    outputs[name] = {'.': hashlib.md5(self.contents(
+                        subject_id, visit_id, name).encode()).hexdigest()}
+            records.append(Record(
+                pipeline_name, 'per_session', subject_id, visit_id,
+                self.analysis_name,
+                {'datetime': self.DATETIME,
+                 'inputs': {n: {} for n in self.fileset_names},
+                 'outputs': outputs}))
+        return records
+
+    def write(self, root_dir, **kwargs):
+        """
+        Writes the dataset to disk in the layout of a LocalFileSystemRepo
+
+        Parameters
+        ----------
+        root_dir : str
+            The directory to write the dataset to, created if it doesn't
+            exist
+        kwargs : dict
+            Keyword arguments passed through to the Dataset
+
+        Returns
+        -------
+        dataset : Dataset
+            The written dataset
+        """
+        repository = LocalFileSystemRepo()
+        for subject_id, visit_id in self.session_ids:
+            session_dir = op.join(root_dir, subject_id, visit_id)
+            derived_dir = op.join(session_dir, self.analysis_name)
+            prov_dir = op.join(derived_dir, repository.PROV_DIR)
+            os.makedirs(prov_dir)
+            for sess_dir, fileset_names, field_names in (
+                    (session_dir, self.fileset_names, self.field_names),
+                    (derived_dir, self.derived_fileset_names,
+                     self.derived_field_names)):
+                for name in fileset_names:
+                    with open(op.join(sess_dir, name + text_format.ext),
+                              'w') as f:
+                        f.write(self.contents(subject_id, visit_id, name))
+                if field_names:
+                    with open(op.join(sess_dir, repository.FIELDS_FNAME),
+                              'w') as f:
+                        json.dump(
+                            {n: self.field_value(subject_id, visit_id, n)
+                             for n in field_names}, f)
+            for record in self.records(subject_id, visit_id):
+                record.save(op.join(prov_dir,
+                                    record.pipeline_name + '.json'))
+        return Dataset(root_dir, repository=repository, depth=2, **kwargs)
@@ -0,0 +1,708 @@
+"""
+An in-process stand-in for an XNAT server, which implements the subset of
+the XNAT REST API used by XnatRepo. Intended for benchmarking and testing
+XnatRepo on machines without access to a real XNAT instance (see
+ci/xnat.sh). Latency and bandwidth limits can be applied to simulate a
+remote server.
+"""
+from __future__ import absolute_import
+import os.path as op
+import re
+import io
+import json
+import time
+import hashlib
+import threading
+import socketserver
+from itertools import count
+from collections import OrderedDict
+from zipfile import ZipFile
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from urllib.parse import urlparse, parse_qs, unquote
+import requests
+from arcana.exceptions import ArcanaError
+from arcana.repository.xnat import XnatRepo, special_char_re
+
+
+STREAM_CHUNK_SIZE = 2 ** 16
+
+project_re = re.compile(r'^/data/(?:archive/)?projects/([^/]+)')
+subject_re = re.compile(project_re.pattern + r'/subjects/([^/]+)')
+session_re = re.compile(subject_re.pattern + r'/experiments/([^/]+)')
+scan_re = re.compile(session_re.pattern + r'/scans/([^/]+)')
+resource_re = re.compile(scan_re.pattern + r'/resources/([^/]+)')
+
+
+class _ThreadingHTTPServer(socketserver.ThreadingMixIn, HTTPServer):
+    "Equivalent of http.server.ThreadingHTTPServer (Python >= 3.7)"
+
+    daemon_threads = True
+
+
+class StandInConflictError(Exception):
+    "Raised by request handlers to respond with '409 Conflict'"
+
+
+class XnatStandIn(object):
+    """
+    A minimal XNAT server that runs in a background thread of the current
+    process and stores all data in memory.
+
+    Parameters
+    ----------
+    latency : float
+        Delay in seconds added to every request
+    bandwidth : float | None
+        The maximum rate, in bytes per second, that request and response
+        bodies are transferred at. If None the rate isn't limited
+    """
+
+    def __init__(self, latency=0.0, bandwidth=None):
+        self.latency = latency
+        self.bandwidth = bandwidth
+        self.projects = OrderedDict()
+        self.num_requests = 0
+        self._lock = threading.RLock()
+        self._xid_counter = count(1)
+        self._httpd = None
+        self._thread = None
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, exception_type, exception_value, traceback):
+        self.stop()
+
+    @property
+    def server(self):
+        if self._httpd is None:
+            raise ArcanaError("XNAT stand-in server hasn't been started")
+        return 'http://{}:{}'.format(*self._httpd.server_address)
+
+    def start(self):
+        standin = self
+
+        class Handler(StandInRequestHandler):
+            server_data = standin
+
+        self._httpd = _ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+        self._httpd.daemon_threads = True
+        self._thread = threading.Thread(target=self._httpd.serve_forever)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self):
+        self._httpd.shutdown()
+        self._httpd.server_close()
+        self._thread.join()
+        self._httpd = None
+        self._thread = None
+
+    def repository(self, cache_dir, **kwargs):
+        """
+        Returns an XnatRepo that connects to the stand-in server
+        """
+        return StandInXnatRepo(self.server, cache_dir, **kwargs)
+
+    def add_project(self, project_id):
+        with self._lock:
+            return self.projects.setdefault(project_id, {
+                'subjects': OrderedDict(),
+                'sessions': OrderedDict(),
+                'session_labels': {}})
+
+    def add_subject(self, project_id, subject_label):
+        with self._lock:
+            project = self.add_project(project_id)
+            try:
+                return project['subjects'][subject_label]
+            except KeyError:
+                xid = project['subjects'][subject_label] = (
+                    '{}_S{:05d}'.format(project_id, next(self._xid_counter)))
+                return xid
+
+    def add_session(self, project_id, subject_label, session_label,
+                    fields=None, scans=None):
+        """
+        Adds a session to the server
+
+        Parameters
+        ----------
+        project_id : str
+            ID of the project to add the session to
+        subject_label : str
+            Label of the subject to add the session to, created if required
+        session_label : str
+            Label of the session
+        fields : dict[str, str]
+            Custom fields of the session
+        scans : dict[str, (str, dict[str, dict[str, bytes]])]
+            Scans of the session keyed by ID, with values consisting of the
+            scan type and a dictionary of resources mapping file names to
+            their contents
+
+        Returns
+        -------
+        xid : str
+            The internal ID of the created session
+        """
+        with self._lock:
+            subject_xid = self.add_subject(project_id, subject_label)
+            project = self.projects[project_id]
+            sessions = project['sessions']
+            try:
+                return project['session_labels'][session_label]
+            except KeyError:
+                pass
+            xid = project['session_labels'][session_label] = (
+                '{}_E{:05d}'.format(project_id, next(self._xid_counter)))
+            sessions[xid] = {
+                'label': session_label,
+                'subject_xid': subject_xid,
+                'fields': OrderedDict(fields if fields is not None else {}),
+                'scans': OrderedDict()}
+            if scans is not None:
+                for scan_id, (scan_type, resources) in scans.items():
+                    sessions[xid]['scans'][scan_id] = {
+                        'type': scan_type,
+                        'quality': 'usable',
+                        'resources': OrderedDict(
+                            (n, OrderedDict(f)) for n, f in resources.items())}
+            return xid
+
+    def populate(self, project_id, num_subjects, num_visits,
+                 scans_per_session=2, file_size=1024):
+        """
+        Fills a project with sessions containing scans of random data
+
+        Parameters
+        ----------
+        project_id : str
+            ID of the project to populate
+        num_subjects : int
+            Number of subjects to create
+        num_visits : int
+            Number of visits to create per subject
+        scans_per_session : int
+            Number of scans (each with a single text file) per session
+        file_size : int
+            Size in bytes of each file
+        """
+        contents = b'x' * file_size
+        for i in range(num_subjects):
+            subj_id = 'SUBJ{:05d}'.format(i)
+            for j in range(num_visits):
+                self.add_session(
+                    project_id, '{}_{}'.format(project_id, subj_id),
+                    '{}_{}_VISIT{}'.format(project_id, subj_id, j),
+                    fields={'age': str(20 + i % 50)},
+                    scans={str(k): ('scan{}'.format(k), {
+                        'TEXT': {'scan{}.txt'.format(k): contents}})
+                           for k in range(scans_per_session)})
+
+    def find_session(self, project_id, session_xid_or_label):
+        project = self.projects[project_id]
+        xid = project['session_labels'].get(session_xid_or_label,
+                                            session_xid_or_label)
+        return project['sessions'][xid]
+
+    def find_scan(self, session, scan_id_or_type):
+        try:
+            return session['scans'][scan_id_or_type]
+        except KeyError:
+            for scan in session['scans'].values():
+                if scan['type'] == scan_id_or_type:
+                    return scan
+        raise KeyError(scan_id_or_type)
+
+
+class StandInRequestHandler(BaseHTTPRequestHandler):
+    """
+    Handles requests to the XNAT stand-in server. The data is stored in the
+    XnatStandIn object set to the 'server_data' class attribute
+    """
+
+    server_data = None
+    protocol_version = 'HTTP/1.1'
+    # Headers and bodies are written separately so Nagle's algorithm would
+    # otherwise stall each keep-alive response on the client's delayed ACK
+    disable_nagle_algorithm = True
+
+    def log_message(self, format, *args):  # @ReservedAssignment
+        pass  # Don't print requests to stderr
+
+    def do_GET(self):
+        self._handle(self._get)
+
+    def do_PUT(self):
+        self._handle(self._put)
+
+    def do_POST(self):
+        self._handle(self._put)
+
+    def do_DELETE(self):
+        self._handle(self._delete)
+
+    def _handle(self, method):
+        data = self.server_data
+        with data._lock:
+            data.num_requests += 1
+        if data.latency:
+            time.sleep(data.latency)
+        url = urlparse(self.path)
+        path = unquote(url.path).rstrip('/')
+        query = {k: v[0] for k, v in parse_qs(url.query).items()}
+        body = self._read_body()
+        try:
+            with data._lock:
+                response = method(path, query, body)
+        except KeyError:
+            self._respond(404, b'Not found')
+        except StandInConflictError as e:
+            self._respond(409, str(e).encode())
+        else:
+            if isinstance(response, bytes):
+                self._respond(200, response, 'application/octet-stream')
+            else:
+                self._respond(200, json.dumps(response).encode(),
+                              'application/json')
+
+    def _read_body(self):
+        length = int(self.headers.get('Content-Length', 0))
+        chunks = []
+        while length:
+            chunk = self.rfile.read(min(length, STREAM_CHUNK_SIZE))
+            self._throttle(len(chunk))
+            chunks.append(chunk)
+            length -= len(chunk)
+        return b''.join(chunks)
+
+    def _respond(self, code, body, content_type='text/plain'):
+        self.send_response(code)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        for i in range(0, len(body), STREAM_CHUNK_SIZE):
+            chunk = body[i:i + STREAM_CHUNK_SIZE]
+            self.wfile.write(chunk)
+            self._throttle(len(chunk))
+
+    def _throttle(self, nbytes):
+        if self.server_data.bandwidth:
+            time.sleep(nbytes / self.server_data.bandwidth)
+
+    def _result_set(self, results):
+        return {'ResultSet': {'Result': results}}
+
+    def _get(self, path, query, body):
+        data = self.server_data
+        if path == '/data/projects':
+            return self._result_set([{'ID': p} for p in data.projects])
+        match = resource_re.match(path)
+        if match:
+            resource = self._resource(match)
+            if path.endswith('/files'):
+                if query.get('format') == 'zip':
+                    return self._zip(match, [match.group(5)])
+                return self._result_set([
+                    {'Name': n, 'digest': hashlib.md5(c).hexdigest(),
+                     'Size': len(c), 'URI': path + '/' + n}
+                    for n, c in resource.items()])
+            fname = path.split('/files/')[-1]
+            return resource[fname]
+        match = scan_re.match(path)
+        if match:
+            scan = self._scan(match)
+            if path.endswith('/files'):
+                if query.get('format') == 'zip':
+                    return self._zip(match, list(scan['resources']))
+                return self._result_set([
+                    {'Name': n, 'digest': hashlib.md5(c).hexdigest(),
+                     'Size': len(c)}
+                    for r in scan['resources'].values()
+                    for n, c in r.items()])
+            elif path.endswith('/resources'):
+                return self._result_set([
+                    {'label': l, 'xnat_abstractresource_id': l}
+                    for l in scan['resources']])
+            return {'ID': match.group(4), 'type': scan['type']}
+        match = session_re.match(path)
+        if match:
+            session = data.find_session(match.group(1), match.group(3))
+            if path.endswith('/scans'):
+                return self._result_set([
+                    {'ID': i, 'type': s['type']}
+                    for i, s in session['scans'].items()])
+            return self._session_json(match.group(1), match.group(3))
+        match = subject_re.match(path)
+        if match:
+            project = data.projects[match.group(1)]
+            subject_xid = self._subject_xid(project, match.group(2))
+            if path.endswith('/experiments'):
+                return self._result_set([
+                    {'ID': x, 'label': s['label']}
+                    for x, s in project['sessions'].items()
+                    if s['subject_xid'] == subject_xid])
+            return {'ID': subject_xid}
+        match = project_re.match(path)
+        if match:
+            project = data.projects[match.group(1)]
+            if path.endswith('/subjects'):
+                return self._result_set([
+                    {'ID': x, 'label': l}
+                    for l, x in project['subjects'].items()])
+            elif path.endswith('/experiments'):
+                return self._result_set([
+                    {'ID': x, 'label': s['label']}
+                    for x, s in project['sessions'].items()])
+            elif '/experiments/' in path:
+                return self._session_json(match.group(1),
+                                          path.split('/experiments/')[-1])
+            return {'ID': match.group(1)}
+        raise KeyError(path)
+
+    def _put(self, path, query, body):
+        data = self.server_data
+        match = resource_re.match(path)
+        if match:
+            scan = self._scan(match)
+            resource = scan['resources'].setdefault(match.group(5),
+                                                    OrderedDict())
+            if '/files/' in path:
+                fname = path.split('/files/')[-1]
+                # XNAT refuses to replace existing files unless requested
+                if fname in resource and query.get('overwrite') != 'true':
+                    raise StandInConflictError(
+                        "File '{}' already exists".format(fname))
+                resource[fname] = body
+            return {}
+        match = scan_re.match(path)
+        if match:
+            session = data.find_session(match.group(1), match.group(3))
+            scan = session['scans'].setdefault(match.group(4), {
+                'type': query.get('type', match.group(4)),
+                'quality': 'usable',
+                'resources': OrderedDict()})
+            return {'ID': match.group(4), 'type': scan['type']}
+        match = session_re.match(path)
+        if match:
+            if '/fields/' in path:
+                session = data.find_session(match.group(1), match.group(3))
+                session['fields'][path.split('/fields/')[-1]] = (
+                    body.decode())
+                return {}
+            return {'ID': data.add_session(match.group(1), match.group(2),
+                                           match.group(3))}
+        match = subject_re.match(path)
+        if match:
+            return {'ID': data.add_subject(match.group(1), match.group(2))}
+        raise KeyError(path)
+
+    def _delete(self, path, query, body):
+        match = resource_re.match(path)
+        if match:
+            scan = self._scan(match)
+            if '/files/' in path:
+                del scan['resources'][match.group(5)][
+                    path.split('/files/')[-1]]
+            else:
+                del scan['resources'][match.group(5)]
+            return {}
+        raise KeyError(path)
+
+    def _subject_xid(self, project, subject_xid_or_label):
+        if subject_xid_or_label in project['subjects'].values():
+            return subject_xid_or_label
+        return project['subjects'][subject_xid_or_label]
+
+    def _scan(self, match):
+        session = self.server_data.find_session(match.group(1),
+                                                match.group(3))
+        return self.server_data.find_scan(session, match.group(4))
+
+    def _resource(self, match):
+        return self._scan(match)['resources'][match.group(5)]
+
+    def _session_json(self, project_id, session_xid):
+        session = self.server_data.find_session(project_id, session_xid)
+        scans = []
+        for scan_id, scan in session['scans'].items():
+            scans.append({
+                'data_fields': {'ID': scan_id, 'type': scan['type'],
+                                'quality': scan['quality']},
+                'children': [{'field': 'file', 'items': [
+                    {'data_fields': {
+                        'label': l, 'file_count': len(files),
+                        'file_size': sum(len(c) for c in files.values())}}
+                    for l, files in scan['resources'].items()]}]})
+        return {'items': [{
+            'data_fields': {'subject_ID': session['subject_xid'],
+                            'label': session['label']},
+            'children': [
+                {'field': 'fields/field', 'items': [
+                    {'data_fields': {'name': n, 'field': v}}
+                    for n, v in session['fields'].items()]},
+                {'field': 'scans/scan', 'items': scans}]}]}
+
+    def _zip(self, match, resource_names):
+        """
+        Zips up the files in the given resources of a scan, using the same
+        directory layout as XNAT
+        """
+        session = self.server_data.find_session(match.group(1),
+                                                match.group(3))
+        scan = self.server_data.find_scan(session, match.group(4))
+        buff = io.BytesIO()
+        with ZipFile(buff, 'w') as zip_file:
+            for resource_name in resource_names:
+                for fname, contents in scan['resources'][
+                        resource_name].items():
+                    zip_file.writestr(op.join(
+                        session['label'], 'scans',
+                        '{}-{}'.format(match.group(4),
+                                       special_char_re.sub('_', scan['type'])),
+                        'resources', resource_name, 'files', fname),
+                        contents)
+        return buff.getvalue()
+
+
+class StandInLogin(object):
+    """
+    A light-weight client for the XNAT stand-in server, which provides the
+    parts of the xnat.XNATSession interface that are used by XnatRepo
+    """
+
+    def __init__(self, server):
+        self.server = server.rstrip('/')
+        self.session = requests.Session()
+        self.jsession = None
+        self.logged_in_user = 'guest'
+        self.classes = StandInClasses(self)
+        self.projects = StandInMapping(
+            self, '/data/projects', lambda r: r['ID'],
+            lambda r: StandInProject(self, r['ID']))
+
+    def request(self, method, uri, **kwargs):
+        response = self.session.request(method, self.server + uri, **kwargs)
+        if response.status_code == 404:
+            raise KeyError(uri)
+        response.raise_for_status()
+        return response
+
+    def get(self, uri, **kwargs):
+        return self.request('GET', uri, **kwargs)
+
+    def put(self, uri, **kwargs):
+        return self.request('PUT', uri, **kwargs)
+
+    def delete(self, uri, **kwargs):
+        return self.request('DELETE', uri, **kwargs)
+
+    def get_json(self, uri, **kwargs):
+        return self.get(uri, **kwargs).json()
+
+    def download_stream(self, uri, target_stream, format=None,  # @ReservedAssignment @IgnorePep8
+                        verbose=False, **kwargs):
+        params = {'format': format} if format is not None else {}
+        response = self.get(uri, params=params, stream=True)
+        for chunk in response.iter_content(STREAM_CHUNK_SIZE):
+            target_stream.write(chunk)
+
+    def disconnect(self):
+        self.session.close()
+
+
+class StandInMapping(object):
+    """
+    A lazily loaded mapping of the child objects listed at the given URI,
+    which can be looked up by their ID or secondary key (e.g. label/type)
+    """
+
+    def __init__(self, login, uri, key, create, secondary_key=None):
+        self._login = login
+        self._uri = uri
+        self._key = key
+        self._create = create
+        self._secondary_key = secondary_key
+        self._items = None
+
+    def _load(self):
+        if self._items is None:
+            try:
+                results = self._login.get_json(self._uri)
+            except KeyError:
+                results = {'ResultSet': {'Result': []}}
+            # Only set once loaded, as the mapping can be shared by threads
+            self._items = OrderedDict(
+                (self._key(r), r) for r in results['ResultSet']['Result'])
+        return self._items
+
+    def __getitem__(self, key):
+        items = self._load()
+        try:
+            row = items[key]
+        except KeyError:
+            if self._secondary_key is None:
+                raise
+            try:
+                row = next(r for r in items.values()
+                           if self._secondary_key(r) == key)
+            except StopIteration:
+                raise KeyError(key)
+        return self._create(row)
+
+    def __iter__(self):
+        return iter(self._load())
+
+    def keys(self):
+        return list(self._load().keys())
+
+
+class StandInProject(object):
+
+    def __init__(self, login, project_id):
+        self.xnat_session = login
+        self.id = project_id
+        self.uri = '/data/archive/projects/{}'.format(project_id)
+        self.subjects = StandInMapping(
+            login, '/data/projects/{}/subjects'.format(project_id),
+            lambda r: r['label'],
+            lambda r: StandInSubject(self, r['label'], r['ID']))
+
+
+class StandInSubject(object):
+
+    def __init__(self, project, label, xid):
+        self.xnat_session = project.xnat_session
+        self.project = project
+        self.label = label
+        self.id = xid
+        self.uri = '{}/subjects/{}'.format(project.uri, xid)
+        self.experiments = StandInMapping(
+            self.xnat_session, self.uri + '/experiments',
+            lambda r: r['label'],
+            lambda r: StandInSession(self, r['label'], r['ID']))
+
+
+class StandInSession(object):
+
+    def __init__(self, subject, label, xid):
+        self.xnat_session = subject.xnat_session
+        self.label = label
+        self.id = xid
+        self.uri = '{}/experiments/{}'.format(subject.uri, xid)
+        self.fields = StandInFields(self)
+        self.scans = StandInMapping(
+            self.xnat_session, self.uri + '/scans', lambda r: r['ID'],
+            lambda r: StandInScan(self, r['ID'], r['type']),
+            secondary_key=lambda r: r['type'])
+
+
+class StandInFields(object):
+
+    def __init__(self, session):
+        self._session = session
+
+    def __getitem__(self, name):
+        session_json = self._session.xnat_session.get_json(
+            self._session.uri)['items'][0]
+        fields_json = next(c['items'] for c in session_json['children']
+                           if c['field'] == 'fields/field')
+        try:
+            return next(js['data_fields']['field'] for js in fields_json
+                        if js['data_fields']['name'] == name)
+        except StopIteration:
+            raise KeyError(name)
+
+    def __setitem__(self, name, value):
+        self._session.xnat_session.put(
+            '{}/fields/{}'.format(self._session.uri, name),
+            data=str(value).encode())
+
+
+class StandInScan(object):
+
+    def __init__(self, session, scan_id, scan_type):
+        self.xnat_session = session.xnat_session
+        self.id = scan_id
+        self.type = scan_type
+        self.uri = '{}/scans/{}'.format(session.uri, scan_id)
+        self.resources = StandInMapping(
+            self.xnat_session, self.uri + '/resources', lambda r: r['label'],
+            lambda r: StandInResource(self, r['label']))
+
+    def create_resource(self, label):
+        self.xnat_session.put('{}/resources/{}'.format(self.uri, label))
+        return StandInResource(self, label)
+
+
+class StandInResource(object):
+
+    def __init__(self, scan, label):
+        self.xnat_session = scan.xnat_session
+        self.id = label
+        self.label = label
+        self.uri = '{}/resources/{}'.format(scan.uri, label)
+        self.files = StandInMapping(
+            self.xnat_session, self.uri + '/files', lambda r: r['Name'],
+            lambda r: StandInFile(self, r['Name']))
+
+    def upload(self, path, remotepath, overwrite=False, **kwargs):
+        params = {'overwrite': 'true'} if overwrite else {}
+        with open(path, 'rb') as f:
+            self.xnat_session.put('{}/files/{}'.format(self.uri, remotepath),
+                                  data=f, params=params)
+
+    def delete(self):
+        self.xnat_session.delete(self.uri)
+
+
+class StandInFile(object):
+
+    def __init__(self, resource, name):
+        self.xnat_session = resource.xnat_session
+        self.uri = '{}/files/{}'.format(resource.uri, name)
+
+    def delete(self):
+        self.xnat_session.delete(self.uri)
+
+
+class StandInClasses(object):
+    """
+    Constructors for new XNAT objects, mirroring the generated classes of
+    xnat.XNATSession.classes
+    """
+
+    def __init__(self, login):
+        self._login = login
+
+    def SubjectData(self, label, parent):
+        xid = self._login.put(parent.uri + '/subjects/' + label).json()['ID']
+        return StandInSubject(parent, label, xid)
+
+    def MrSessionData(self, label, parent):
+        xid = self._login.put(
+            '{}/subjects/{}/experiments/{}'.format(
+                parent.project.uri, parent.label, label)).json()['ID']
+        return StandInSession(parent, label, xid)
+
+    def MrScanData(self, id, type, parent):  # @ReservedAssignment
+        if id is None:
+            id = type  # @ReservedAssignment
+        self._login.put('{}/scans/{}'.format(parent.uri, id),
+                        params={'type': type})
+        return StandInScan(parent, id, type)
+
+
+class StandInXnatRepo(XnatRepo):
+    """
+    An XnatRepo that connects to an XnatStandIn server using the
+    light-weight StandInLogin client instead of xnat.connect
+    """
+
+    def connect(self):
+        if self.offline:
+            return
+        self._login = StandInLogin(self.server)
+        self._xobj_cache = {}
@@ -0,0 +1,141 @@
+"""
+Common utilities for the Arcana benchmark scripts
+"""
+import sys
+import json
+import time
+import platform
+import tracemalloc
+import logging
+from datetime import datetime
+from arcana.__about__ import __version__
+
+
+logger = logging.getLogger('arcana')
+
+
+class BenchmarkResults(object):
+    """
+    Collects timings of benchmarked operations so they can be printed and
+    saved to a JSON file for comparison between runs
+
+    Parameters
+    ----------
+    name : str
+        Name of the benchmark suite
+    params : dict
+        Parameters the suite was run with, saved alongside the results
+    """
+
+    def __init__(self, name, **params):
+        self.name = name
+        self.params = params
+        self.results = []
+
+    def time(self, operation, size, func, *args, num_bytes=None,
+             num_items=None, memory=False, **kwargs):
+        """
+        Times a call to 'func' and records the result. If 'memory' is set,
+        'func' is called a second time while tracing memory allocations to
+        record its peak memory usage, so the timing isn't skewed by the
+        tracing overhead
+
+        Parameters
+        ----------
+        operation : str
+            Name of the operation being benchmarked
+        size : int
+            Size of the dataset the operation was run over
+        func : callable
+            The function to time
+        num_bytes : int | None
+            Number of bytes transferred by the operation, used to calculate
+            the throughput
+        num_items : int | None
+            Number of items processed by the operation, used to calculate the
+            throughput
+        memory : bool
+            Whether to record the peak memory allocated during the call.
+            Requires that 'func' can be called repeatedly
+
+        Returns
+        -------
+        ret : object
+            The return value of 'func'
+        """
+        start = time.perf_counter()
+        ret = func(*args, **kwargs)
+        duration = time.perf_counter() - start
+        extra = {}
+        if memory:
+            extra['peak_memory'] = self.peak_memory(func, *args, **kwargs)
+        self.record(operation, size, duration, num_bytes=num_bytes,
+                    num_items=num_items, **extra)
+        return ret
+
+    @classmethod
+    def peak_memory(cls, func, *args, **kwargs):
+        """
+        Returns the peak memory, in bytes, allocated by Python during a call
+        to 'func' (on top of the memory already allocated before the call)
+        """
+        tracemalloc.start()
+        try:
+            func(*args, **kwargs)
+            return tracemalloc.get_traced_memory()[1]
+        finally:
+            tracemalloc.stop()
+
+    def record(self, operation, size, duration, num_bytes=None,
+               num_items=None, **extra):
+        result = {'operation': operation, 'size': size,
+                  'duration': duration}
+        if num_bytes is not None:
+            result['bytes'] = num_bytes
+            result['bytes_per_second'] = num_bytes / duration
+        if num_items is not None:
+            result['items'] = num_items
+            result['items_per_second'] = num_items / duration
+        result.update(extra)
+        self.results.append(result)
+        logger.info("%s (size=%s): %s", operation, size,
+                    ', '.join('{}={}'.format(k, self._fmt(v))
+                              for k, v in result.items()
+                              if k not in ('operation', 'size')))
+        return result
+
+    def to_dict(self):
+        return {
+            'name': self.name,
+            'arcana_version': __version__,
+            'python_version': platform.python_version(),
+            'platform': platform.platform(),
+            'date': datetime.now().isoformat(),
+            'params': self.params,
+            'results': self.results}
+
+    def save(self, path):
+        with open(path, 'w') as f:
+            json.dump(self.to_dict(), f, indent=2)
+
+    def print_table(self, stream=sys.stdout):
+        for result in self.results:
+            stream.write('{:<30} {:>8} {:>12.3f}s{}\n'.format(
+                result['operation'], result['size'], result['duration'],
+                ''.join('  {}={}'.format(k, self._fmt(result[k]))
+                        for k in ('items_per_second', 'bytes_per_second',
+                                  'peak_memory')
+                        if k in result)))
+
+    @classmethod
+    def _fmt(cls, value):
+        if isinstance(value, float):
+            return '{:.3f}'.format(value)
+        return str(value)
+
+
+def configure_logging(verbose=False):
+    handler = logging.StreamHandler()
+    handler.setFormatter(logging.Formatter('%(levelname)s - %(message)s'))
+    logger.addHandler(handler)
+    logger.setLevel(logging.INFO if verbose else logging.WARNING)
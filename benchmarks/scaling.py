@@ -0,0 +1,172 @@
+#!/usr/bin/env python3
+"""
+Benchmarks how the construction and querying of the data tree scales with
+the number of sessions in a dataset, using synthetic datasets generated by
+arcana.utils.testing.synthetic. The wall time and peak memory of each phase
+are recorded.
+
+Example
+-------
+
+    python benchmarks/scaling.py --sizes 100 1000 10000 \
+        --output scaling.json
+"""
+import os.path as op
+import shutil
+import tempfile
+from argparse import ArgumentParser
+import numpy as np
+from nipype.interfaces.utility import IdentityInterface
+from arcana.analysis.base import Analysis, AnalysisMetaClass
+from arcana.data import (
+    InputFilesetSpec, FilesetSpec, FieldSpec, FilesetFilter, FieldFilter,
+    FilesetSlice)
+from arcana.data.file_format import text_format
+from arcana.processor import SingleProc
+from arcana.repository import Tree, Dataset
+from arcana.utils.testing.synthetic import SyntheticDataset
+from base import BenchmarkResults, configure_logging  # noqa pylint: disable=import-error
+
+
+DEFAULT_SIZES = (100, 1000, 10000)
+
+
+class SyntheticAnalysis(Analysis, metaclass=AnalysisMetaClass):
+    """
+    An analysis whose single pipeline generates the derived items of a
+    SyntheticDataset with default parameters
+    """
+
+    add_data_specs = [
+        InputFilesetSpec('fileset0', text_format),
+        FilesetSpec('derived_fileset0', text_format, 'pipeline0'),
+        FieldSpec('derived_field0', float, 'pipeline0')]
+
+    def pipeline0(self, **name_maps):
+        pipeline = self.new_pipeline(
+            'pipeline0',
+            desc="Passes through the first fileset",
+            citations=[],
+            name_maps=name_maps)
+        pipeline.add(
+            'identity',
+            IdentityInterface(['fileset', 'field']),
+            inputs={
+                'fileset': ('fileset0', text_format)},
+            outputs={
+                'derived_fileset0': ('fileset', text_format),
+                'derived_field0': ('field', float)})
+        return pipeline
+
+
+def to_process(analysis):
+    """
+    Runs Processor._to_process for the pipeline of the synthetic analysis
+    over the whole dataset
+    """
+    processor = analysis.processor
+    tree = analysis.dataset.tree
+    subject_inds = {s.id: i for i, s in enumerate(tree.subjects)}
+    visit_inds = {v.id: i for i, v in enumerate(tree.visits)}
+    shape = (len(subject_inds), len(visit_inds))
+    pipeline = analysis.pipeline('pipeline0')
+    pipeline.cap()
+    return processor._to_process(
+        pipeline, None, np.zeros(shape, dtype=bool),
+        np.zeros(shape, dtype=bool), np.ones(shape, dtype=bool),
+        subject_inds, visit_inds, False)
+
+
+def lazy_single_session(dataset):
+    """
+    Constructs a lazy tree of the dataset and loads the items of one of its
+    sessions
+    """
+    lazy = Dataset(dataset.name, repository=dataset.repository,
+                   depth=dataset.depth, lazy=True)
+    session = next(iter(lazy.tree.sessions))
+    return list(session.filesets)
+
+
+def benchmark_size(results, num_sessions, args):
+    generator = SyntheticDataset(
+        max(num_sessions // args.visits, 1), args.visits,
+        filesets_per_session=args.filesets,
+        fields_per_session=args.fields,
+        file_size=args.file_size,
+        analysis_name='synthetic')
+    num_sessions = generator.num_sessions
+    mem = not args.no_memory
+    work_dir = tempfile.mkdtemp()
+    try:
+        dataset = results.time(
+            'generate', num_sessions, generator.write,
+            op.join(work_dir, 'dataset'), num_items=num_sessions)
+        items = results.time(
+            'find_data', num_sessions, dataset.repository.find_data, dataset,
+            num_items=num_sessions, memory=mem)
+        tree = results.time(
+            'tree_construct', num_sessions, Tree.construct, dataset, *items,
+            num_items=num_sessions, memory=mem)
+        dataset._cached_tree = tree
+        results.time(
+            'lazy_single_session', num_sessions, lazy_single_session, dataset,
+            num_items=1, memory=mem)
+        fileset_filter = FilesetFilter('fileset0', 'fileset0', text_format)
+        field_filter = FieldFilter('field0', 'field0', float)
+        results.time(
+            'fileset_filter_match', num_sessions, fileset_filter.match, tree,
+            num_items=num_sessions, memory=mem)
+        results.time(
+            'field_filter_match', num_sessions, field_filter.match, tree,
+            num_items=num_sessions, memory=mem)
+        filesets = [s.fileset('fileset0') for s in tree.sessions]
+        results.time(
+            'slice_construct', num_sessions, FilesetSlice, 'fileset0',
+            filesets, format=text_format, frequency='per_session',
+            num_items=num_sessions, memory=mem)
+        analysis = SyntheticAnalysis(
+            'synthetic', dataset,
+            SingleProc(op.join(work_dir, 'work'), reprocess=True),
+            inputs=[fileset_filter])
+        results.time(
+            'to_process', num_sessions, to_process, analysis,
+            num_items=num_sessions, memory=mem)
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+
+def main(argv=None):
+    parser = ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--sizes', type=int, nargs='+',
+                        default=list(DEFAULT_SIZES),
+                        help="Numbers of sessions to benchmark")
+    parser.add_argument('--visits', type=int, default=2,
+                        help="Number of visits per subject")
+    parser.add_argument('--filesets', type=int, default=4,
+                        help="Number of acquired filesets per session")
+    parser.add_argument('--fields', type=int, default=4,
+                        help="Number of acquired fields per session")
+    parser.add_argument('--file_size', type=int, default=64,
+                        help="Size in bytes of each fileset")
+    parser.add_argument('--no_memory', action='store_true', default=False,
+                        help="Don't measure the peak memory of each phase")
+    parser.add_argument('--output', default=None,
+                        help="Path of a JSON file to save the results in")
+    parser.add_argument('--verbose', action='store_true', default=False,
+                        help="Log each result as it is measured")
+    args = parser.parse_args(argv)
+    configure_logging(args.verbose)
+    results = BenchmarkResults(
+        'scaling', **{k: v for k, v in vars(args).items()
+                      if k not in ('output', 'verbose')})
+    for size in args.sizes:
+        benchmark_size(results, size, args)
+    results.print_table()
+    if args.output is not None:
+        results.save(args.output)
+    return results
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,131 @@
+#!/usr/bin/env python3
+"""
+Benchmarks tree construction, download and upload throughput of XnatRepo
+against an in-process XNAT stand-in server (see
+arcana.utils.testing.xnat_standin), so that changes can be measured without
+access to a real XNAT instance.
+
+Example
+-------
+
+    python benchmarks/xnat_repo.py --sizes 100 1000 --latency 0.005 \
+        --output xnat_repo.json
+"""
+import os
+import os.path as op
+import shutil
+import tempfile
+from argparse import ArgumentParser
+from arcana.data import Fileset
+from arcana.data.file_format import text_format
+from arcana.utils.testing.xnat_standin import XnatStandIn
+from base import BenchmarkResults, configure_logging  # noqa pylint: disable=import-error
+
+
+PROJECT_ID = 'BENCH'
+DEFAULT_SIZES = (100, 1000, 10000)
+
+
+def benchmark_size(results, num_sessions, args):
+    num_visits = args.visits
+    num_subjects = max(num_sessions // num_visits, 1)
+    num_sessions = num_subjects * num_visits
+    num_transfer = min(args.transfer_sessions, num_sessions)
+    work_dir = tempfile.mkdtemp()
+    try:
+        with XnatStandIn(latency=args.latency,
+                         bandwidth=args.bandwidth) as standin:
+            standin.populate(PROJECT_ID, num_subjects, num_visits,
+                             scans_per_session=args.scans,
+                             file_size=args.file_size)
+            repo = standin.repository(op.join(work_dir, 'cache'))
+            dataset = repo.dataset(PROJECT_ID)
+            # Tree construction
+            num_requests = standin.num_requests
+            with repo:
+                tree = results.time('tree_build', num_sessions,
+                                    lambda: repo.dataset(PROJECT_ID).tree,
+                                    num_items=num_sessions)
+            results.results[-1]['requests'] = (standin.num_requests -
+                                               num_requests)
+            sessions = list(tree.sessions)[:num_transfer]
+            filesets = [f for s in sessions for f in s.filesets]
+            for fileset in filesets:
+                fileset.format = text_format
+            num_bytes = len(filesets) * args.file_size
+            # Download
+            with repo:
+                results.time(
+                    'download', num_sessions,
+                    lambda: [repo.get_fileset(f) for f in filesets],
+                    num_bytes=num_bytes, num_items=len(filesets))
+                results.time(
+                    'get_checksums', num_sessions,
+                    lambda: [repo.get_checksums(f) for f in filesets],
+                    num_items=len(filesets))
+            # Upload
+            src_path = op.join(work_dir, 'derived.txt')
+            with open(src_path, 'wb') as f:
+                f.write(os.urandom(args.file_size))
+            derived = [
+                Fileset('derived{}'.format(i), text_format,
+                        subject_id=s.subject_id, visit_id=s.visit_id,
+                        dataset=dataset, from_analysis='bench',
+                        path=src_path)
+                for s in sessions for i in range(args.scans)]
+            with repo:
+                results.time(
+                    'upload', num_sessions,
+                    lambda: [repo.put_fileset(f) for f in derived],
+                    num_bytes=len(derived) * args.file_size,
+                    num_items=len(derived))
+                # Repeat the upload to measure the cost of skipping
+                # unchanged filesets
+                num_requests = standin.num_requests
+                results.time(
+                    'reupload_unchanged', num_sessions,
+                    lambda: [repo.put_fileset(f) for f in derived],
+                    num_items=len(derived))
+                results.results[-1]['requests'] = (standin.num_requests -
+                                                   num_requests)
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+
+def main(argv=None):
+    parser = ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--sizes', type=int, nargs='+',
+                        default=list(DEFAULT_SIZES),
+                        help="Numbers of sessions to benchmark")
+    parser.add_argument('--visits', type=int, default=2,
+                        help="Number of visits per subject")
+    parser.add_argument('--scans', type=int, default=2,
+                        help="Number of scans per session")
+    parser.add_argument('--file_size', type=int, default=1024 * 1024,
+                        help="Size in bytes of each scan file")
+    parser.add_argument('--transfer_sessions', type=int, default=100,
+                        help=("Maximum number of sessions to download from "
+                              "and upload to for each size"))
+    parser.add_argument('--latency', type=float, default=0.0,
+                        help="Latency in seconds added to each request")
+    parser.add_argument('--bandwidth', type=float, default=None,
+                        help="Bandwidth limit of the server in bytes/s")
+    parser.add_argument('--output', default=None,
+                        help="Path of a JSON file to save the results in")
+    parser.add_argument('--verbose', action='store_true', default=False,
+                        help="Log each result as it is measured")
+    args = parser.parse_args(argv)
+    configure_logging(args.verbose)
+    results = BenchmarkResults(
+        'xnat_repo', **{k: v for k, v in vars(args).items()
+                        if k not in ('output', 'verbose')})
+    for size in args.sizes:
+        benchmark_size(results, size, args)
+    results.print_table()
+    if args.output is not None:
+        results.save(args.output)
+    return results
+
+
+if __name__ == '__main__':
+    main()
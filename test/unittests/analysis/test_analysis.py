@@ -339,6 +339,13 @@ class TestAnalysis(BaseMultiSubjectTestCase):
                 ids = f.read().split('\n')
             self.assertEqual(sorted(ids), sorted(self.SUBJECT_IDS))
 
+    def test_prefetch(self):
+        analysis = self.make_analysis()
+        analysis.prefetch(num_workers=2, max_bandwidth=1.0)
+        for name in ('one', 'ten'):
+            for fileset in analysis.data(name):
+                self.assertTrue(os.path.exists(fileset.path))
+
     def test_visit_ids_access(self):
         analysis = self.make_analysis()
         analysis.data('visit_ids', derive=True)
@@ -1,8 +1,12 @@
 from builtins import next
+import os
 import os.path
+import gzip
 from arcana.utils.testing import BaseTestCase
 from nipype.pipeline import engine as pe
-from arcana.utils.interfaces import ZipDir, UnzipDir
+from arcana.utils.interfaces import (
+    ZipDir, UnzipDir, NativeZipDir, NativeUnzipDir, NativeTarGzDir,
+    NativeUnTarGzDir, ParallelGzipWriter)
 
 
 class TestUtilsInterface(BaseTestCase):
@@ -28,3 +32,57 @@ class TestUtilsInterface(BaseTestCase):
                              if n.name == 'unzip').result
         self.assertEqual(
             os.listdir(unzip_results.outputs.unzipped), ['test_file'])
+
+    def test_native_zip_unzip(self):
+        zipnode = pe.Node(NativeZipDir(), name='zip')
+        zipnode.inputs.dirname = self.test_path
+        unzipnode = pe.Node(NativeUnzipDir(), name='unzip')
+        workflow = pe.Workflow('test_native_zip', base_dir=self.work_dir)
+        workflow.connect(zipnode, 'zipped', unzipnode, 'zipped')
+        exc_graph = workflow.run()
+        unzip_results = next(n for n in exc_graph.nodes()
+                             if n.name == 'unzip').result
+        self.assertEqual(os.path.basename(unzip_results.outputs.unzipped),
+                         'test_dir')
+        self.assertEqual(
+            os.listdir(unzip_results.outputs.unzipped), ['test_file'])
+
+    def test_native_targz_untargz(self):
+        # Add enough data to be compressed in multiple blocks
+        with open(os.path.join(self.test_path, 'large_file'), 'wb') as f:
+            f.write(os.urandom(3 * ParallelGzipWriter.BLOCK_SIZE))
+        for num_threads in (1, 4):
+            targznode = pe.Node(NativeTarGzDir(num_threads=num_threads),
+                                name='targz')
+            targznode.inputs.dirname = self.test_path
+            untargznode = pe.Node(NativeUnTarGzDir(), name='untargz')
+            workflow = pe.Workflow(
+                'test_native_targz{}'.format(num_threads),
+                base_dir=self.work_dir)
+            workflow.connect(targznode, 'zipped', untargznode, 'gzipped')
+            exc_graph = workflow.run()
+            untargz_results = next(n for n in exc_graph.nodes()
+                                   if n.name == 'untargz').result
+            gunzipped = untargz_results.outputs.gunzipped
+            self.assertEqual(os.path.basename(gunzipped), 'test_dir')
+            self.assertEqual(sorted(os.listdir(gunzipped)),
+                             ['large_file', 'test_file'])
+            for fname in ('large_file', 'test_file'):
+                with open(os.path.join(self.test_path, fname), 'rb') as f:
+                    orig = f.read()
+                with open(os.path.join(gunzipped, fname), 'rb') as f:
+                    self.assertEqual(f.read(), orig)
+
+    def test_parallel_gzip(self):
+        data = os.urandom(1000) * 5000
+        path = os.path.join(self.work_dir, 'parallel.gz')
+        with ParallelGzipWriter(path, 4, block_size=100000) as gz_file:
+            for i in range(0, len(data), 30000):
+                gz_file.write(data[i:i + 30000])
+        with gzip.open(path) as f:
+            self.assertEqual(f.read(), data)
+        # Empty files are still valid gzip files
+        with ParallelGzipWriter(path, 4):
+            pass
+        with gzip.open(path) as f:
+            self.assertEqual(f.read(), b'')
@@ -9,7 +9,7 @@ from arcana.data import (
     InputFieldSpec, FieldFilter)
 from arcana.data.file_format import text_format
 from arcana.data import Field
-from arcana.repository import Tree
+from arcana.repository import Tree, Dataset, LocalFileSystemRepo
 from arcana.environment import BaseRequirement
 from arcana.exceptions import (
     ArcanaReprocessException, ArcanaProtectedOutputConflictError)
@@ -316,6 +316,34 @@ class TestProvBasic(BaseTestCase):
             new_derived_field4.record.prov['outputs']['derived_field4'],
             new_value)
 
+    def test_checksum_algorithm_change(self):
+        analysis_name = 'checksum_algorithm_analysis'
+        analysis = self.create_analysis(
+            TestProvAnalysis,
+            analysis_name,
+            inputs=STUDY_INPUTS)
+        self.assertEqual(
+            analysis.data('derived_field2',
+                          derive=True).value(*self.SESSION), 156.0)
+        # Provenance saved with MD5 checksums should still match after the
+        # checksum algorithm of the repository is changed
+        analysis = self.create_analysis(
+            TestProvAnalysis,
+            analysis_name,
+            inputs=STUDY_INPUTS,
+            dataset=Dataset(self.project_dir, depth=2,
+                            repository=LocalFileSystemRepo(
+                                checksum_algorithm='sha256')))
+        self.assertEqual(
+            analysis.data('derived_field2',
+                          derive=True).value(*self.SESSION), 156.0)
+        fileset = analysis.data('derived_fileset1',
+                                derive=True).item(*self.SESSION)
+        self.assertTrue(all(c.startswith('sha256:')
+                            for c in fileset.checksums.values()))
+        self.assertEqual(fileset.checksums_as('md5'),
+                         fileset.recorded_checksums)
+
     def test_protect_manually(self):
         """Protect manually altered files and fields from overwrite"""
         analysis_name = 'manual_protect'
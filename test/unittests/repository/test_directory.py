@@ -1,14 +1,24 @@
 import os
 import os.path as op
+from itertools import chain
+import pickle as pkl
+import json
+from unittest.mock import patch
 from arcana.data.file_format import text_format
 from arcana.analysis import Analysis, AnalysisMetaClass
 from arcana.data import (
-    Fileset, InputFilesetSpec, FilesetSpec, Field)
+    Fileset, InputFilesetSpec, FilesetSpec, Field, FilesetFilter, FieldFilter)
 from arcana.utils.testing import BaseMultiSubjectTestCase
-from arcana.repository import Tree
+from arcana.repository import (
+    Tree, Dataset, Session, LocalFileSystemRepo)
+from arcana.pipeline.provenance import Record
 from future.utils import with_metaclass
 from arcana.utils.testing import BaseTestCase
+from arcana.utils.testing.synthetic import SyntheticDataset
 from arcana.data.file_format import FileFormat
+from arcana.processor import SingleProc
+from arcana.utils import save_array
+from nipype.interfaces.utility import IdentityInterface
 
 
 # A dummy format that contains a header
@@ -41,6 +51,28 @@ class DummyAnalysis(with_metaclass(AnalysisMetaClass, Analysis)):
         pass
 
 
+class LazyAnalysis(with_metaclass(AnalysisMetaClass, Analysis)):
+
+    add_data_specs = [
+        InputFilesetSpec('source', text_format),
+        FilesetSpec('copied', text_format, 'copy_pipeline')]
+
+    def copy_pipeline(self, **name_maps):
+        pipeline = self.new_pipeline(
+            'copy_pipeline',
+            desc="Passes through the source fileset",
+            citations=[],
+            name_maps=name_maps)
+        pipeline.add(
+            'identity',
+            IdentityInterface(['fileset']),
+            inputs={
+                'fileset': ('source', text_format)},
+            outputs={
+                'copied': ('fileset', text_format)})
+        return pipeline
+
+
 class TestLocalFileSystemRepo(BaseTestCase):
 
     STUDY_NAME = 'local_repo'
@@ -52,6 +84,265 @@ class TestLocalFileSystemRepo(BaseTestCase):
     def test_get_fileset(self):
         pass
 
+    def test_field_get_refresh(self):
+        dataset_dir = op.join(self.work_dir, 'field-refresh')
+        os.makedirs(dataset_dir)
+        dataset = Dataset(dataset_dir, depth=2)
+        Field('a', value=1, subject_id='subject1', visit_id='visit1',
+              dataset=dataset).put()
+        field = dataset.tree.session('subject1', 'visit1').field('a')
+        # Alter the value in the repository after the tree has been loaded
+        Field('a', value=2, subject_id='subject1', visit_id='visit1',
+              dataset=dataset).put()
+        # The value loaded with the tree is used unless a refresh is requested
+        field.get()
+        self.assertEqual(field.value, 1)
+        field.get(refresh=True)
+        self.assertEqual(field.value, 2)
+
+    def test_put_fields(self):
+        dataset_dir = op.join(self.work_dir, 'put-fields')
+        os.makedirs(dataset_dir)
+        dataset = Dataset(dataset_dir, depth=2)
+        Field('a', value=1, subject_id='subject1', visit_id='visit1',
+              dataset=dataset).put()
+        fields = [
+            Field(n, value=v, subject_id='subject1', visit_id='visit1',
+                  dataset=dataset)
+            for n, v in (('b', 2.0), ('c', 'three'), ('d', [4, 5]))]
+        fields.append(Field('e', value=6, subject_id='subject2',
+                            visit_id='visit1', dataset=dataset))
+        with patch('arcana.repository.local.os.replace',
+                   wraps=os.replace) as replace:
+            dataset.put_fields(fields)
+        # One write per fields JSON
+        self.assertEqual(replace.call_count, 2)
+        session = dataset.tree.session('subject1', 'visit1')
+        self.assertEqual(
+            {f.name: f.value for f in session.fields},
+            {'a': 1, 'b': 2.0, 'c': 'three', 'd': [4, 5]})
+        self.assertEqual(
+            dataset.tree.session('subject2', 'visit1').field('e').value, 6)
+        self.assertEqual(
+            sorted(os.listdir(op.join(dataset_dir, 'subject1', 'visit1'))),
+            ['fields.json', 'fields.json.lock'])
+
+    def test_binary_array_fields(self):
+        dataset_dir = op.join(self.work_dir, 'binary-arrays')
+        os.makedirs(dataset_dir)
+        dataset = Dataset(dataset_dir, depth=2,
+                          repository=LocalFileSystemRepo(
+                              binary_array_length=10))
+        large = [i / 3 for i in range(100)]
+        dataset.put_fields([
+            Field(n, value=v, subject_id='subject1', visit_id='visit1',
+                  dataset=dataset)
+            for n, v in (('large', large), ('small', [1, 2, 3]),
+                         ('strs', ['a'] * 20))])
+        session_dir = op.join(dataset_dir, 'subject1', 'visit1')
+        with open(op.join(session_dir, 'fields.json')) as f:
+            dct = json.load(f)
+        self.assertEqual(dct['large'], {'npy': '.field-arrays/large.npy',
+                                        'dtype': 'float'})
+        self.assertEqual(dct['small'], [1, 2, 3])
+        self.assertEqual(dct['strs'], ['a'] * 20)
+        field = dataset.tree.session('subject1', 'visit1').field('large')
+        # Binary arrays are only loaded when accessed
+        self.assertIsNone(field._value)
+        self.assertEqual((field.dtype, field.array), (float, True))
+        self.assertEqual(field.value, large)
+        # Rewriting the binary file changes the fingerprint of the tree
+        # without the values being loaded
+        dataset.clear_cache()
+        tree = dataset.tree
+        fingerprint = tree.fingerprint
+        save_array(op.join(session_dir, '.field-arrays', 'large.npy'),
+                   [-v for v in large], float)
+        dataset.clear_cache()
+        new_tree = dataset.tree
+        self.assertNotEqual(new_tree.fingerprint, fingerprint)
+        self.assertEqual([(n.subject_id, n.visit_id)
+                          for n in new_tree.diff(tree)],
+                         [('subject1', 'visit1')])
+        for t in (tree, new_tree):
+            self.assertIsNone(
+                t.session('subject1', 'visit1').field('large')._value)
+        # Binary files are removed when arrays are stored inline again
+        Field('large', value=[1.0], subject_id='subject1', visit_id='visit1',
+              dataset=dataset).put()
+        self.assertEqual(
+            dataset.tree.session('subject1', 'visit1').field('large').value,
+            [1.0])
+        self.assertEqual(
+            os.listdir(op.join(session_dir, '.field-arrays')), [])
+
+    def test_synthetic_dataset(self):
+        generator = SyntheticDataset(3, 2, pipelines_per_session=2)
+        dataset = generator.write(op.join(self.work_dir, 'synthetic'))
+        tree = dataset.tree
+        self.assertEqual(sorted(tree.session_ids), generator.session_ids)
+        session = tree.session('SUBJ00001', 'VISIT1')
+        self.assertEqual(len(list(session.filesets)), 3)
+        self.assertEqual(len(list(session.fields)), 3)
+        self.assertEqual(len(list(session.records)), 2)
+        # Derived items are linked to records holding matching checksums
+        derived = session.fileset('derived_fileset0',
+                                  from_analysis='synthetic')
+        derived.format = text_format
+        self.assertEqual(derived.record.pipeline_name, 'pipeline0')
+        self.assertEqual(derived.checksums, derived.recorded_checksums)
+        field = session.field('derived_field0', from_analysis='synthetic')
+        self.assertEqual(field.record.pipeline_name, 'pipeline1')
+        self.assertEqual(field.value, field.recorded_checksums)
+        # The in-memory items match those found in the repository
+        in_memory = Tree.construct(dataset, *generator.items(dataset))
+        self.assertEqual(
+            sorted((f.name, f.from_analysis) for f in chain(
+                *(s.filesets for s in in_memory.sessions))),
+            sorted((f.name, f.from_analysis) for f in chain(
+                *(s.filesets for s in tree.sessions))))
+
+    def test_newest_record_used(self):
+        old, = SyntheticDataset(1, 1).records('SUBJ00001', 'VISIT1')
+        new = Record('pipeline1', 'per_session', 'SUBJ00001', 'VISIT1',
+                     'synthetic', dict(old.prov, datetime='2020-01-01'))
+        session = Session('SUBJ00001', 'VISIT1',
+                          filesets=[Fileset('derived_fileset0', text_format,
+                                            subject_id='SUBJ00001',
+                                            visit_id='VISIT1',
+                                            from_analysis='synthetic')],
+                          records=[new, old])
+        self.assertIs(session.fileset('derived_fileset0',
+                                      from_analysis='synthetic').record, new)
+
+    def test_tree_pickle(self):
+        generator = SyntheticDataset(2, 2)
+        dataset = generator.write(op.join(self.work_dir, 'pickled'))
+        tree = dataset.tree
+        fileset = tree.session('SUBJ00000', 'VISIT0').fileset('fileset0')
+        fileset.format = text_format
+        # Items are stored in slots rather than a per-instance dictionary
+        self.assertFalse(hasattr(fileset, '__dict__'))
+        self.assertIs(fileset.subject_id,
+                      tree.session('SUBJ00000', 'VISIT1').subject_id)
+        unpickled = pkl.loads(pkl.dumps(tree))
+        self.assertEqual(unpickled, tree,
+                         tree.find_mismatch(unpickled))
+
+    def test_lazy_tree(self):
+        generator = SyntheticDataset(3, 2)
+        eager = generator.write(op.join(self.work_dir, 'lazy')).tree
+        dataset = Dataset(op.join(self.work_dir, 'lazy'), depth=2, lazy=True)
+        tree = dataset.tree
+        self.assertEqual(sorted(tree.session_ids), generator.session_ids)
+        # Only the sessions that are accessed are loaded
+        session = tree.session('SUBJ00001', 'VISIT1')
+        self.assertFalse(session.loaded)
+        self.assertEqual(
+            sorted(f.name for f in session.filesets),
+            sorted(generator.fileset_names + generator.derived_fileset_names))
+        self.assertTrue(session.loaded)
+        self.assertFalse(tree.session('SUBJ00001', 'VISIT0').loaded)
+        self.assertEqual(
+            session.field('derived_field0',
+                          from_analysis='synthetic').record.pipeline_name,
+            'pipeline0')
+        self.assertEqual(tree, eager, tree.find_mismatch(eager))
+
+    def test_lazy_analysis(self):
+        generator = SyntheticDataset(3, 2)
+        root_dir = op.join(self.work_dir, 'lazy_analysis')
+        generator.write(root_dir)
+        dataset = Dataset(root_dir, depth=2, lazy=True)
+        analysis = LazyAnalysis(
+            'lazy', dataset, SingleProc(op.join(self.work_dir, 'lazy_work')),
+            inputs=[FilesetFilter('source', 'fileset0', text_format)])
+        tree = dataset.tree
+        # Binding the inputs and specs doesn't load any of the nodes
+        self.assertFalse(any(n.loaded for n in tree.nodes()))
+        session_id = ('SUBJ00001', 'VISIT1')
+        copied = analysis.data('copied', derive=True,
+                               session_ids=[session_id])
+        with open(next(iter(copied)).path) as f:
+            self.assertEqual(f.read(),
+                             generator.contents(*session_id, 'fileset0'))
+        # Only the processed session was loaded to check for existing
+        # outputs and to source and sink the data
+        self.assertEqual([n for n in tree.nodes() if n.loaded],
+                         [tree.session(*session_id)])
+        self.assertEqual(
+            [n for n in dataset.tree.nodes() if n.loaded],
+            [dataset.tree.session(*session_id)])
+
+    def test_name_index(self):
+        generator = SyntheticDataset(2, 2, filesets_per_session=3)
+        tree = generator.write(op.join(self.work_dir, 'indexed')).tree
+        index = tree.name_index('fileset', 'per_session')
+        self.assertEqual(sorted(index),
+                         sorted(generator.fileset_names
+                                + generator.derived_fileset_names))
+        self.assertEqual(len(index['fileset1']), 4)
+        # Regex matches are returned in the order they appear in the node
+        fileset_slice = FilesetFilter(
+            'fileset', 'fileset[12]', text_format, is_regex=True,
+            order=1).match(tree)
+        self.assertEqual([f.name for f in fileset_slice], ['fileset2'] * 4)
+        field_slice = FieldFilter('field', 'field1', float).match(tree)
+        self.assertEqual(
+            [f.value for f in field_slice],
+            [generator.field_value(s, v, 'field1')
+             for s, v in generator.session_ids])
+        session = tree.session('SUBJ00001', 'VISIT0')
+        self.assertEqual(session.matching_items('field', 'field.*', True),
+                         [session.field('field0'), session.field('field1')])
+
+    def test_fingerprint_diff(self):
+        generator = SyntheticDataset(3, 2)
+        root_dir = op.join(self.work_dir, 'fingerprint')
+        tree = generator.write(root_dir).tree
+        self.assertEqual(tree.diff(Dataset(root_dir, depth=2).tree), [])
+        # Fingerprints are saved when the tree is pickled
+        self.assertEqual(pkl.loads(pkl.dumps(tree)).__dict__['_fingerprint'],
+                         tree.fingerprint)
+        path = tree.session('SUBJ00001', 'VISIT0').fileset('fileset0').path
+        with open(path, 'w') as f:
+            f.write('modified')
+        mtime = op.getmtime(path) + 10
+        os.utime(path, (mtime, mtime))
+        modified = Dataset(root_dir, depth=2).tree
+        self.assertNotEqual(modified.fingerprint, tree.fingerprint)
+        self.assertEqual(
+            modified.subject('SUBJ00000').fingerprint,
+            tree.subject('SUBJ00000').fingerprint)
+        self.assertEqual(modified.diff(tree),
+                         [modified.session('SUBJ00001', 'VISIT0')])
+        # Memoised fingerprints are cleared when the tree is dropped from the
+        # cache of its dataset
+        dataset = Dataset(root_dir, depth=2)
+        session = dataset.tree.session('SUBJ00001', 'VISIT0')
+        fingerprint = dataset.tree.fingerprint
+        dataset.clear_cache()
+        self.assertNotIn('_fingerprint', session.__dict__)
+        self.assertEqual(dataset.tree.fingerprint, fingerprint)
+
+    def test_directory_fingerprint(self):
+        # Files nested within directory filesets are included in their
+        # fingerprints
+        root_dir = op.join(self.work_dir, 'dir_fingerprint')
+        nested_dir = op.join(root_dir, 'SUBJ1', 'VISIT1', 'directory', 'sub')
+        os.makedirs(nested_dir)
+        nested_path = op.join(nested_dir, 'nested.txt')
+        with open(nested_path, 'w') as f:
+            f.write('nested')
+        mtime = op.getmtime(nested_path) - 100
+        for path in (nested_path, nested_dir, op.dirname(nested_dir)):
+            os.utime(path, (mtime, mtime))
+        tree = Dataset(root_dir, depth=2).tree
+        fingerprint = tree.fingerprint
+        os.utime(nested_path, (mtime + 50, mtime + 50))
+        self.assertNotEqual(Dataset(root_dir, depth=2).tree.fingerprint,
+                            fingerprint)
+
 
 class TestDirectoryProjectInfo(BaseMultiSubjectTestCase):
     """
@@ -200,7 +491,7 @@ class TestDirectoryProjectInfo(BaseMultiSubjectTestCase):
             for fileset in filesets:
                 fileset.get()
             for field in fields:
-                field.get()
+                field.get(refresh=True)
         tree = Tree.construct(self.dataset, filesets, fields)
         return tree
 
@@ -1,17 +1,28 @@
 from __future__ import absolute_import
+import os
 import os.path as op
+import stat
 import tempfile
+import time
 import unittest
 import sys
+import copyreg
+import pickle as pkl
 from collections import OrderedDict
-from unittest import TestCase
+from unittest import TestCase, mock
 import xnat
+import requests
 from arcana.utils.testing import BaseTestCase
-from arcana.data import FilesetFilter
+from arcana.data import (
+    FilesetFilter, Field, Fileset, InputFilesetSpec, FilesetSpec, FieldSpec)
+from arcana.exceptions import ArcanaUsageError
 from arcana.data.file_format import text_format
 from arcana.repository import XnatRepo
 from arcana.processor import SingleProc
+from arcana.analysis.base import Analysis, AnalysisMetaClass
 from arcana.utils.testing.xnat import SKIP_ARGS, SERVER, TestOnXnatMixin
+from arcana.utils.testing.xnat_standin import XnatStandIn
+from nipype.interfaces.utility import IdentityInterface
 
 
 # Import TestExistingPrereqs analysis to test it on XNAT
@@ -43,6 +54,30 @@ class TestConnectDisconnect(TestCase):
             self._test_open(repository)
         self._test_closed(repository)
 
+    @unittest.skipIf(*SKIP_ARGS)
+    def test_shared_session(self):
+        cache_dir = tempfile.mkdtemp()
+        repository = XnatRepo(server=SERVER, cache_dir=cache_dir,
+                              share_session=True)
+        with repository:
+            jsession = repository._login.jsession
+        token_path = repository.session_token_path
+        self.assertEqual(stat.S_IMODE(os.stat(token_path).st_mode),
+                         stat.S_IRUSR | stat.S_IWUSR)
+        # A second repository (e.g. in a worker process) reuses the session
+        other = XnatRepo(server=SERVER, cache_dir=cache_dir,
+                         share_session=True)
+        with other:
+            self.assertEqual(other._login.jsession, jsession)
+        # An invalid token triggers a new login
+        with open(token_path, 'w') as f:
+            f.write('expired')
+        with other:
+            jsession = other._login.jsession
+        self.assertNotEqual(jsession, 'expired')
+        with open(token_path) as f:
+            self.assertEqual(f.read().split()[-1], jsession)
+
     def _test_open(self, repository):
         repository._login.classes  # check connection
 
@@ -54,6 +89,413 @@ class TestConnectDisconnect(TestCase):
             'classes')
 
 
+class TestSharedSessionToken(TestCase):
+
+    class MockLogin(object):
+
+        def __init__(self, jsession, logged_in_user):
+            self.jsession = jsession
+            self.logged_in_user = logged_in_user
+            self.disconnected = False
+
+        def disconnect(self):
+            self.disconnected = True
+
+    def connect(self, saved, logins):
+        cache_dir = tempfile.mkdtemp()
+        repository = XnatRepo(server='http://xnat.example.com',
+                              cache_dir=cache_dir, share_session=True)
+        with open(repository.session_token_path, 'w') as f:
+            f.write(saved)
+        with mock.patch('xnat.connect', side_effect=logins) as connect:
+            repository.connect()
+        with open(repository.session_token_path) as f:
+            saved = f.read()
+        return repository._login, connect.call_count, saved
+
+    def test_reuse(self):
+        login, num_connects, saved = self.connect(
+            'user1\nabc', [self.MockLogin('abc', 'user1')])
+        self.assertEqual((login.jsession, num_connects), ('abc', 1))
+        # Tokens saved by earlier versions don't record the user
+        login, num_connects, saved = self.connect(
+            'abc', [self.MockLogin('abc', 'user1')])
+        self.assertEqual((login.jsession, num_connects), ('abc', 1))
+
+    def test_expired_to_guest(self):
+        guest = self.MockLogin('abc', 'guest')
+        login, num_connects, saved = self.connect(
+            'user1\nabc', [guest, self.MockLogin('def', 'user1')])
+        self.assertTrue(guest.disconnected)
+        self.assertEqual((login.jsession, num_connects), ('def', 2))
+        self.assertEqual(saved, 'user1\ndef')
+
+    def test_different_user(self):
+        login, num_connects, saved = self.connect(
+            'user1\nabc', [self.MockLogin('abc', 'user2'),
+                           self.MockLogin('def', 'user1')])
+        self.assertEqual((login.jsession, num_connects), ('def', 2))
+
+
+class TestChangedFiles(TestCase):
+
+    class MockLogin(object):
+
+        def __init__(self, digests):
+            self.digests = digests
+
+        def get_json(self, uri):
+            return {'ResultSet': {'Result': [
+                {'Name': n, 'digest': d} for n, d in self.digests.items()]}}
+
+    class MockResource(object):
+
+        uri = '/data/experiments/x/scans/1/resources/TEXT'
+
+    def test_changed_files(self):
+        tmp_dir = tempfile.mkdtemp()
+        fpaths = []
+        for fname, contents in (('a.txt', 'foo'), ('b.txt', 'bar')):
+            fpath = op.join(tmp_dir, fname)
+            with open(fpath, 'w') as f:
+                f.write(contents)
+            fpaths.append((fname, fpath))
+        checksums = {'a.txt': 'acbd18db4cc2f85cedef654fccc4a4d8',
+                     'b.txt': '37b51d194a7513e45b56f6524f2d51f2'}
+        repository = XnatRepo(server='http://localhost',
+                              cache_dir=tempfile.mkdtemp())
+        # Identical contents on the server
+        repository._login = self.MockLogin(dict(checksums))
+        self.assertEqual(
+            repository._changed_files(self.MockResource(), fpaths,
+                                      checksums, tmp_dir),
+            ([], []))
+        # One modified file and one stale file on the server
+        repository._login = self.MockLogin({
+            'a.txt': checksums['a.txt'], 'b.txt': 'modified',
+            'c.txt': 'stale'})
+        self.assertEqual(
+            repository._changed_files(self.MockResource(), fpaths,
+                                      checksums, tmp_dir),
+            ([fpaths[1]], ['c.txt']))
+
+
+class TestXsessionCache(TestCase):
+
+    class CountingDict(dict):
+
+        def __init__(self, *args, **kwargs):
+            dict.__init__(self, *args, **kwargs)
+            self.lookups = 0
+
+        def __getitem__(self, key):
+            self.lookups += 1
+            return dict.__getitem__(self, key)
+
+    class MockObject(object):
+
+        def __init__(self, **kwargs):
+            self.__dict__.update(kwargs)
+
+    class MockRepo(XnatRepo):
+
+        def connect(self):
+            self._login = self.mock_login
+            self._xobj_cache = {}
+
+        def disconnect(self):
+            self._login = None
+            self._xobj_cache = {}
+
+    def test_xsession_cache(self):
+        xsession = self.MockObject(fields={})
+        xsubject = self.MockObject(
+            experiments=self.CountingDict(PROJ_S1_V1=xsession))
+        xproject = self.MockObject(
+            subjects=self.CountingDict(PROJ_S1=xsubject))
+        projects = self.CountingDict(PROJ=xproject)
+        repository = self.MockRepo(server='http://localhost',
+                                   cache_dir=tempfile.mkdtemp())
+        repository.mock_login = self.MockObject(projects=projects)
+        dataset = repository.dataset('PROJ')
+        fields = [Field(n, 1, frequency='per_session', subject_id='S1',
+                        visit_id='V1', dataset=dataset)
+                  for n in ('a', 'b', 'c')]
+        with repository:
+            for field in fields:
+                self.assertIs(repository.get_xsession(field), xsession)
+        self.assertEqual(projects.lookups, 1)
+        self.assertEqual(xproject.subjects.lookups, 1)
+        self.assertEqual(xsubject.experiments.lookups, 1)
+        # Cache is cleared on disconnect
+        with repository:
+            repository.get_xsession(fields[0])
+        self.assertEqual(projects.lookups, 2)
+
+
+class OfflineAnalysis(Analysis, metaclass=AnalysisMetaClass):
+
+    add_data_specs = [
+        InputFilesetSpec('source', text_format),
+        FilesetSpec('derived', text_format, 'derive_pipeline'),
+        FieldSpec('derived_field', str, 'derive_pipeline')]
+
+    def derive_pipeline(self, **name_maps):
+        pipeline = self.new_pipeline(
+            'derive_pipeline',
+            desc="Passes through the source fileset",
+            citations=[],
+            name_maps=name_maps)
+        identity = pipeline.add(
+            'identity',
+            IdentityInterface(['fileset', 'field']),
+            inputs={
+                'fileset': ('source', text_format)},
+            outputs={
+                'derived': ('fileset', text_format),
+                'derived_field': ('field', str)})
+        identity.inputs.field = 'derived'
+        return pipeline
+
+
+class TestOfflineMode(TestCase):
+
+    def test_offline(self):
+        cache_dir = tempfile.mkdtemp()
+        repository = XnatRepo(server='http://localhost', cache_dir=cache_dir,
+                              offline=True)
+        dataset = repository.dataset('PROJ')
+        # Save a manifest as would be done by an online 'find_data'
+        fileset = Fileset('source1', id='1', uri='/data/experiments/x/1',
+                          subject_id='S1', visit_id='V1', dataset=dataset,
+                          resource_name='TEXT')
+        repository._save_manifest(dataset, [fileset], [
+            Field('a', 1, subject_id='S1', visit_id='V1', dataset=dataset)],
+            [])
+        cache_path = repository._cache_path(fileset)
+        os.makedirs(cache_path)
+        with open(op.join(cache_path, 'source1.txt'), 'w') as f:
+            f.write('source1')
+        with open(cache_path + XnatRepo.MD5_SUFFIX, 'w') as f:
+            f.write('{".": "dummy"}')
+        # Access the data without a connection to the server
+        tree = dataset.tree
+        session = tree.session('S1', 'V1')
+        self.assertEqual(session.field('a').value, 1)
+        source1 = session.fileset('1')
+        source1.format = text_format
+        self.assertEqual(source1.path, op.join(cache_path, 'source1.txt'))
+        self.assertEqual(source1.checksums, {'.': 'dummy'})
+        # Writes are journaled
+        Field('a', 2, subject_id='S1', visit_id='V1',
+              dataset=dataset).put()
+        field = dataset.tree.session('S1', 'V1').field('a')
+        field.get(refresh=True)
+        self.assertEqual(field.value, 2)
+        self.assertTrue(op.exists(repository._journal_path(dataset)))
+        self.assertRaises(ArcanaUsageError, repository.push_journal,
+                          dataset)
+        # Derivatives written offline are found when the tree is reloaded
+        work_dir = tempfile.mkdtemp()
+        analysis = OfflineAnalysis(
+            'offline', dataset, SingleProc(work_dir),
+            inputs=[FilesetFilter('source', 'source1', text_format)])
+        analysis.derive(['derived', 'derived_field'])
+        dataset.clear_cache()
+        session = dataset.tree.session('S1', 'V1')
+        derived = session.fileset('derived', from_analysis='offline')
+        derived.format = text_format
+        with open(derived.path) as f:
+            self.assertEqual(f.read(), 'source1')
+        self.assertEqual(
+            session.field('derived_field', from_analysis='offline').value,
+            'derived')
+        self.assertIn('derive_pipeline',
+                      [r.pipeline_name for r in session.records])
+        # So they aren't derived again
+        num_entries = len(repository._load_journal(dataset))
+        analysis = OfflineAnalysis(
+            'offline', dataset, SingleProc(work_dir),
+            inputs=[FilesetFilter('source', 'source1', text_format)])
+        analysis.derive(['derived', 'derived_field'])
+        self.assertEqual(len(repository._load_journal(dataset)), num_entries)
+
+
+class TestXnatStandIn(TestCase):
+
+    def test_roundtrip(self):
+        work_dir = tempfile.mkdtemp()
+        with XnatStandIn() as standin:
+            standin.populate('PROJ', 2, 2, file_size=16)
+            repository = standin.repository(op.join(work_dir, 'cache'))
+            dataset = repository.dataset('PROJ')
+            tree = dataset.tree
+            self.assertEqual(len(list(tree.sessions)), 4)
+            session = tree.session('SUBJ00000', 'VISIT0')
+            self.assertEqual(session.field('age').value, 20)
+            source = session.fileset('0')
+            source.format = text_format
+            with open(source.path) as f:
+                self.assertEqual(f.read(), 'x' * 16)
+            # Upload a derived fileset and check unchanged filesets aren't
+            # uploaded again
+            path = op.join(work_dir, 'derived.txt')
+            with open(path, 'w') as f:
+                f.write('derived')
+            derived = Fileset('derived', text_format, subject_id='SUBJ00000',
+                              visit_id='VISIT0', dataset=dataset,
+                              from_analysis='analysis', path=path)
+            with repository:
+                repository.put_fileset(derived)
+                num_requests = standin.num_requests
+                repository.put_fileset(derived)
+                self.assertLess(standin.num_requests - num_requests, 10)
+            dataset.clear_cache()
+            session = dataset.tree.session('SUBJ00000', 'VISIT0')
+            self.assertIn('derived',
+                          [f.name for f in session.filesets
+                           if f.from_analysis == 'analysis'])
+            # Only the sessions of the nodes that are accessed are requested
+            # from lazily constructed trees
+            lazy_tree = repository.dataset('PROJ', lazy=True).tree
+            self.assertEqual(sorted(lazy_tree.session_ids),
+                             sorted(dataset.tree.session_ids))
+            num_requests = standin.num_requests
+            lazy_session = lazy_tree.session('SUBJ00000', 'VISIT0')
+            self.assertEqual(lazy_session, session,
+                             lazy_session.find_mismatch(session))
+            self.assertLess(standin.num_requests - num_requests, 6)
+
+
+    def test_fields(self):
+        work_dir = tempfile.mkdtemp()
+        with XnatStandIn() as standin:
+            standin.populate('PROJ', 1, 1)
+            repository = standin.repository(op.join(work_dir, 'cache'))
+            dataset = repository.dataset('PROJ')
+            age = dataset.tree.session('SUBJ00000', 'VISIT0').field('age')
+            array = Field('array', value=[1, 2, 3], subject_id='SUBJ00000',
+                          visit_id='VISIT0', dataset=dataset)
+            with repository:
+                # The array resource of the session isn't listed for fields
+                # that aren't stored in binary (the stand-in doesn't
+                # implement session resources)
+                self.assertEqual(repository.get_field(age), 20)
+                repository.put_field(array)
+                repository.put_field(array)
+                self.assertEqual(repository.get_field(array), [1, 2, 3])
+
+    def test_old_tree_cache(self):
+        work_dir = tempfile.mkdtemp()
+        with XnatStandIn() as standin:
+            standin.populate('PROJ', 1, 1)
+            repository = standin.repository(op.join(work_dir, 'cache'))
+            dataset = repository.dataset('PROJ')
+            cache_path = op.join(work_dir, 'datatree-cache.pkl')
+            # Items pickled before they had slots saved their state in a
+            # dict
+            fileset = Fileset('a', text_format, subject_id='SUBJ00000',
+                              visit_id='VISIT0')
+            with open(cache_path, 'wb') as f:
+                pickler = pkl.Pickler(f, protocol=2)
+                pickler.dispatch_table = copyreg.dispatch_table.copy()
+                pickler.dispatch_table[Fileset] = lambda f: (
+                    copyreg.__newobj__, (Fileset,),
+                    {'_name': f.name, '_format': f.format})
+                pickler.dump(fileset)
+            with open(cache_path, 'rb') as f:
+                self.assertRaises(AttributeError, pkl.load, f)
+            # The tree is rebuilt instead
+            with mock.patch.object(type(dataset), '_tree_cache_path',
+                                   cache_path):
+                self.assertEqual(len(list(dataset.tree.sessions)), 1)
+
+    def test_upload_overwrite(self):
+        work_dir = tempfile.mkdtemp()
+        path = op.join(work_dir, 'file.txt')
+        with open(path, 'w') as f:
+            f.write('file')
+        with XnatStandIn() as standin:
+            standin.populate('PROJ', 1, 1, scans_per_session=1)
+            repository = standin.repository(op.join(work_dir, 'cache'))
+            with repository:
+                xscan = repository._login.projects['PROJ'].subjects[
+                    'PROJ_SUBJ00000'].experiments[
+                        'PROJ_SUBJ00000_VISIT0'].scans['0']
+                xresource = xscan.resources['TEXT']
+                # Existing files are only replaced if requested, as in XNAT
+                self.assertRaises(requests.HTTPError, xresource.upload,
+                                  path, 'scan0.txt')
+                xresource.upload(path, 'scan0.txt', overwrite=True)
+                xresource.upload(path, 'new.txt')
+            self.assertEqual(
+                standin.find_scan(
+                    standin.find_session('PROJ', 'PROJ_SUBJ00000_VISIT0'),
+                    '0')['resources']['TEXT']['scan0.txt'], b'file')
+
+
+    def test_fingerprint_diff(self):
+        work_dir = tempfile.mkdtemp()
+        path = op.join(work_dir, 'file.txt')
+        with open(path, 'w') as f:
+            f.write('file')
+        with XnatStandIn() as standin:
+            standin.populate('PROJ', 2, 1, scans_per_session=1)
+            repository = standin.repository(op.join(work_dir, 'cache'))
+            dataset = repository.dataset('PROJ')
+            tree = dataset.tree
+            tree.fingerprint  # noqa pylint: disable=pointless-statement
+            # Remote filesets are fingerprinted from the resource listing
+            # without downloading them
+            self.assertTrue(all(f._path is None
+                                for s in tree.sessions for f in s.filesets))
+            with repository:
+                repository._login.projects['PROJ'].subjects[
+                    'PROJ_SUBJ00001'].experiments[
+                        'PROJ_SUBJ00001_VISIT0'].scans['0'].resources[
+                            'TEXT'].upload(path, 'new.txt')
+            dataset.clear_cache()
+            self.assertEqual(dataset.tree.diff(tree),
+                             [dataset.tree.session('SUBJ00001', 'VISIT0')])
+
+
+class PrefetchAnalysis(Analysis, metaclass=AnalysisMetaClass):
+
+    add_data_specs = [
+        InputFilesetSpec('scan', text_format)]
+
+
+class TestPrefetch(TestCase):
+
+    FILE_SIZE = 100000
+
+    def test_prefetch_bandwidth(self):
+        work_dir = tempfile.mkdtemp()
+        with XnatStandIn() as standin:
+            for i in range(2):
+                # Random contents so the downloaded zip can't be compressed
+                standin.add_session(
+                    'PROJ', 'PROJ_SUBJ{}'.format(i),
+                    'PROJ_SUBJ{}_VISIT0'.format(i), scans={
+                        '0': ('scan', {'TEXT': {
+                            'scan.txt': os.urandom(self.FILE_SIZE)}})})
+            repository = standin.repository(op.join(work_dir, 'cache'))
+            analysis = PrefetchAnalysis(
+                'prefetch', repository.dataset('PROJ'),
+                SingleProc(op.join(work_dir, 'work')),
+                inputs=[FilesetFilter('scan', 'scan', text_format)])
+            max_bandwidth = 0.2  # MB/s
+            start = time.time()
+            analysis.prefetch(num_workers=2, max_bandwidth=max_bandwidth)
+            elapsed = time.time() - start
+            for fileset in analysis.data('scan'):
+                self.assertTrue(op.exists(op.join(
+                    repository._cache_path(fileset), 'scan.txt')))
+            # Allow for the zip headers and timer resolution
+            min_time = 0.9 * 2 * self.FILE_SIZE / (max_bandwidth * 1e6)
+            self.assertGreaterEqual(elapsed, min_time)
+
+
 class TestProvInputChangeOnXnat(TestOnXnatMixin,
                                 test_to_process.TestProvInputChange):
 
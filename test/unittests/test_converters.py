@@ -1,4 +1,7 @@
 import os
+import stat
+import shutil
+import threading
 import tempfile
 import os.path as op
 from arcana.data import InputFilesetSpec, FilesetSpec, FilesetFilter, Fileset
@@ -7,15 +10,19 @@ from arcana.data.file_format import (
 from arcana.analysis.base import Analysis, AnalysisMetaClass
 from arcana.utils.testing import BaseTestCase
 from nipype.interfaces.utility import IdentityInterface
-from arcana.utils.interfaces import ZipDir
+from arcana.utils.interfaces import (
+    ZipDir, NativeZipDir, NativeUnzipDir, CachedInterface, default_dir_mode)
+from arcana.repository import LocalFileSystemRepo
 from future.utils import with_metaclass
-from unittest import TestCase
+from unittest import TestCase, mock
 
 
 class TestConverterAvailability(TestCase):
 
     def test_find_converter(self):
         converter = zip_format.converter_from(directory_format)
+        self.assertIsInstance(converter.interface, NativeZipDir)
+        converter = zip_format.converter_from(directory_format, native=False)
         self.assertIsInstance(converter.interface, ZipDir)
 
 
@@ -130,3 +137,82 @@ class TestFormatConversions(BaseTestCase):
         self.assertCreated(list(analysis.data('zip_from_directory_on_input', derive=True))[0])
         self.assertCreated(list(analysis.data('directory_from_zip_on_output', derive=True))[0])
         self.assertCreated(list(analysis.data('zip_from_directory_on_output', derive=True))[0])
+
+    def test_conversion_cache(self):
+        inputs = [
+            FilesetFilter('text', 'text', text_format),
+            FilesetFilter('directory', 'directory', directory_format),
+            FilesetFilter('zip', 'zip', zip_format)]
+        unzip = NativeUnzipDir._run_interface
+        num_unzips = []
+        with mock.patch.object(NativeUnzipDir, '_run_interface',
+                               autospec=True, side_effect=unzip) as run:
+            for name in ('conversion', 'conversion2'):
+                analysis = self.create_analysis(ConversionAnalysis, name,
+                                                inputs)
+                self.assertCreated(list(analysis.data(
+                    'directory_from_zip_on_input', derive=True))[0])
+                num_unzips.append(run.call_count)
+                run.reset_mock()
+        # The input zip file is only unzipped by the first analysis, both
+        # unzip the output of the pipeline, which isn't cached
+        self.assertEqual(num_unzips, [2, 1])
+        # One entry for each of the zip and directory inputs converted
+        cache_dir = analysis.processor.conversion_cache_dir
+        self.assertEqual(len(os.listdir(cache_dir)), 2)
+
+
+class TestCachedInterface(TestCase):
+
+    def setUp(self):
+        self.tempdir = tempfile.mkdtemp()
+        self.cache_dir = op.join(self.tempdir, 'cache')
+        os.mkdir(self.cache_dir)
+        dir_path = op.join(self.tempdir, 'directory')
+        os.mkdir(dir_path)
+        with open(op.join(dir_path, 'dummy.txt'), 'w') as f:
+            f.write('blah')
+        zipper = NativeZipDir()
+        zipper.inputs.dirname = dir_path
+        zipper.inputs.zipped = op.join(self.tempdir, 'directory.zip')
+        self.zipped = zipper.run().outputs.zipped
+
+    def tearDown(self):
+        shutil.rmtree(self.tempdir)
+
+    def unzip(self):
+        unzipper = NativeUnzipDir()
+        unzipper.inputs.zipped = self.zipped
+        return CachedInterface(unzipper, 'zipped', self.cache_dir).run()
+
+    def test_cache_entries(self):
+        unzip = NativeUnzipDir._run_interface
+        with mock.patch.object(NativeUnzipDir, '_run_interface',
+                               autospec=True, side_effect=unzip) as run:
+            unzipped = self.unzip().outputs.unzipped
+            self.assertEqual(self.unzip().outputs.unzipped, unzipped)
+            self.assertEqual(run.call_count, 1)
+            # Entries missing any of their files are rebuilt
+            os.remove(op.join(unzipped, 'dummy.txt'))
+            self.assertEqual(self.unzip().outputs.unzipped, unzipped)
+            self.assertEqual(run.call_count, 2)
+        self.assertTrue(op.exists(op.join(unzipped, 'dummy.txt')))
+        # Wait for the replaced entry to be deleted in the background
+        for thread in threading.enumerate():
+            if thread.name == 'arcana-remove':
+                thread.join()
+        # Entries are created with the permissions of new directories
+        entry_dir = op.dirname(unzipped)
+        self.assertEqual(stat.S_IMODE(os.stat(entry_dir).st_mode),
+                         default_dir_mode(self.cache_dir))
+        self.assertEqual(os.listdir(self.cache_dir),
+                         [op.basename(entry_dir)])
+
+    def test_sink_transfer_method(self):
+        repository = LocalFileSystemRepo(transfer='move')
+        unzipped = Fileset.from_path(self.unzip().outputs.unzipped,
+                                     format=directory_format)
+        # Cached outputs must not be moved out of the cache
+        self.assertEqual(repository.transfer_method(unzipped), 'reflink')
+        self.assertEqual(repository.transfer_method(
+            Fileset.from_path(self.zipped, format=zip_format)), 'move')
@@ -1,17 +1,25 @@
 import tempfile
 import shutil
 import os
+import threading
 import os.path as op
 import unittest
-from unittest import TestCase
+from unittest import TestCase, mock
 from nipype.interfaces.utility import IdentityInterface
 from arcana.utils.testing import BaseTestCase, BaseMultiSubjectTestCase
 from arcana.analysis.base import Analysis, AnalysisMetaClass
 from arcana.analysis.parameter import SwitchSpec
 from arcana.data import (
-    InputFilesetSpec, FilesetSpec, FieldSpec, FilesetFilter)
+    InputFilesetSpec, FilesetSpec, FieldSpec, FilesetFilter, Fileset,
+    Field, FieldSlice)
 from arcana.data.file_format import text_format, FileFormat
-from arcana.exceptions import ArcanaDesignError, ArcanaError
+from arcana.data.dicom import DicomHeaderCache
+from arcana.utils import (
+    FileHasher, staging_dir, swap_in, wait_for_swap)
+import arcana.utils.base
+from arcana.repository import Dataset
+from arcana.exceptions import (
+    ArcanaDesignError, ArcanaError, ArcanaIndexError)
 from future.utils import PY2
 from future.utils import with_metaclass
 import pydicom
@@ -70,6 +78,12 @@ class DicomFormat(FileFormat):
         return values
 
 
+class RelabelledDicomFormat(FileFormat):
+
+    def dicom_values(self, fileset, tags):
+        return [fileset.name for _ in tags]
+
+
 dicom_format = DicomFormat(name='dicom', extension=None,
                            resource_names={'xnat': ['DICOM']},
                            directory=True, within_dir_exts=['.dcm'])
@@ -101,6 +115,225 @@ class TestFilesetSpecPickle(TestCase):
             self.assertEqual(obj, re_obj)
 
 
+class TestSlice(TestCase):
+
+    def test_per_session_items(self):
+        ids = [('subj{}'.format(s), 'visit{}'.format(v))
+               for v in (1, 0) for s in (2, 0, 1)]
+        field_slice = FieldSlice(
+            'a', [Field('a', '{}-{}'.format(s, v), subject_id=s, visit_id=v)
+                  for s, v in ids])
+        self.assertEqual(list(field_slice._slice), ['subj0', 'subj1', 'subj2'])
+        self.assertEqual(list(field_slice._slice['subj1']),
+                         ['visit0', 'visit1'])
+        self.assertEqual(
+            [f.value for f in field_slice.items(*zip(*ids))],
+            ['{}-{}'.format(s, v) for s, v in ids])
+        self.assertEqual(field_slice.items(*zip(*ids)),
+                         [field_slice.item(s, v) for s, v in ids])
+        self.assertRaises(ArcanaIndexError, field_slice.items,
+                          ['subj0', 'subj3'], ['visit0', 'visit0'])
+
+
+class TestParallelHashing(TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.num_threads = FileHasher.num_threads
+        self.mmap_threshold = FileHasher.mmap_threshold
+
+    def tearDown(self):
+        FileHasher.set_num_threads(self.num_threads)
+        FileHasher.mmap_threshold = self.mmap_threshold
+        shutil.rmtree(self.tmp_dir)
+
+    def test_parallel_matches_serial(self):
+        dir_path = op.join(self.tmp_dir, 'dicom')
+        os.mkdir(dir_path)
+        for i in range(20):
+            with open(op.join(dir_path, '{}.dcm'.format(i)), 'wb') as f:
+                f.write(os.urandom(1000 * i))
+        fileset = Fileset.from_path(dir_path, format=dicom_format)
+        FileHasher.set_num_threads(1)
+        serial = fileset.calculate_checksums()
+        FileHasher.set_num_threads(4)
+        self.assertEqual(fileset.calculate_checksums(), serial)
+        # Files above the threshold are memory-mapped
+        FileHasher.mmap_threshold = 5000
+        self.assertEqual(fileset.calculate_checksums(), serial)
+        self.assertEqual(
+            fileset.calculate_checksums('sha256'),
+            {k: 'sha256:' + FileHasher.hash_file(op.join(dir_path, k),
+                                                 'sha256')
+             for k in serial})
+
+    def test_set_num_threads_while_hashing(self):
+        paths = []
+        for i in range(10):
+            paths.append(op.join(self.tmp_dir, '{}.txt'.format(i)))
+            with open(paths[-1], 'wb') as f:
+                f.write(os.urandom(1000))
+        expected = [FileHasher.hash_file(p, 'md5') for p in paths]
+        errors = []
+
+        def hash_repeatedly():
+            try:
+                for _ in range(20):
+                    self.assertEqual(FileHasher.hash_files(paths, 'md5'),
+                                     expected)
+            except Exception as e:
+                errors.append(e)
+
+        FileHasher.set_num_threads(2)
+        threads = [threading.Thread(target=hash_repeatedly)
+                   for _ in range(4)]
+        for thread in threads:
+            thread.start()
+        for i in range(20):
+            # Swapping the pool mustn't break hashing in other threads
+            FileHasher.set_num_threads(2 + i % 3)
+        for thread in threads:
+            thread.join()
+        self.assertEqual(errors, [])
+
+
+class TestFilesetTransfer(TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def test_swap_in(self):
+        path = op.join(self.tmp_dir, 'swapped')
+        for renameat2 in (arcana.utils.base.renameat2, None):
+            # Swap with and without the atomic exchange
+            with mock.patch.object(arcana.utils.base, 'renameat2',
+                                   renameat2):
+                for i in range(2):
+                    staging = staging_dir(path)
+                    new_path = op.join(staging, 'new')
+                    os.mkdir(new_path)
+                    with open(op.join(new_path, 'a.txt'), 'w') as f:
+                        f.write(str(i))
+                    swap_in(new_path, path, staging).join()
+                    with open(op.join(path, 'a.txt')) as f:
+                        self.assertEqual(f.read(), str(i))
+        # Missing paths that aren't being swapped in aren't waited for
+        self.assertFalse(wait_for_swap(op.join(self.tmp_dir, 'missing'),
+                                       timeout=60))
+
+    def test_transfer_to(self):
+        aux_format = FileFormat(name='with_aux', extension='.txt',
+                                aux_files={'header': '.hdr'})
+        for method in FileHasher.TRANSFER_METHODS:
+            src_dir = op.join(self.tmp_dir, method, 'src')
+            os.makedirs(op.join(src_dir, 'sub'))
+            for fname in ('a.txt', 'a.hdr', op.join('sub', 'b.txt')):
+                with open(op.join(src_dir, fname), 'wb') as f:
+                    f.write(os.urandom(2000))
+            file_fileset = Fileset(
+                'a', aux_format, path=op.join(src_dir, 'a.txt'),
+                aux_files={'header': op.join(src_dir, 'a.hdr')})
+            dir_fileset = Fileset.from_path(op.join(src_dir, 'sub'),
+                                            format=dicom_format)
+            for fileset, target in ((file_fileset, 'copied.txt'),
+                                    (dir_fileset, 'copied')):
+                target = op.join(self.tmp_dir, method, target)
+                expected = fileset.calculate_checksums()
+                checksums = fileset.transfer_to(target, method=method)
+                self.assertEqual(checksums, expected)
+                copied = (Fileset(
+                    'copied', aux_format, path=target,
+                    aux_files=aux_format.default_aux_file_paths(target))
+                    if fileset is file_fileset
+                    else Fileset.from_path(target, format=dicom_format))
+                self.assertEqual(
+                    sorted(copied.calculate_checksums().values()),
+                    sorted(checksums.values()))
+                if method == 'move':
+                    # Moved filesets point to their new location
+                    self.assertEqual(fileset.path, target)
+                    self.assertEqual(fileset.calculate_checksums(),
+                                     copied.calculate_checksums())
+                else:
+                    self.assertEqual(fileset.calculate_checksums(), expected)
+                if method == 'hardlink':
+                    self.assertTrue(op.samefile(
+                        op.join(src_dir, 'a.txt'),
+                        op.join(self.tmp_dir, method, 'copied.txt')))
+                # Transferring onto itself leaves the files in place
+                self.assertEqual(copied.transfer_to(target, method=method),
+                                 copied.calculate_checksums())
+
+    def test_replace_directory(self):
+        target = op.join(self.tmp_dir, 'repo', 'dicom')
+        os.makedirs(target)
+        for i in range(5):
+            with open(op.join(target, 'old{}.dcm'.format(i)), 'w') as f:
+                f.write('old')
+        src_dir = op.join(self.tmp_dir, 'dicom')
+        os.mkdir(src_dir)
+        with open(op.join(src_dir, 'new.dcm'), 'w') as f:
+            f.write('new')
+        fileset = Fileset.from_path(src_dir, format=dicom_format)
+        checksums = fileset.transfer_to(target)
+        self.assertEqual(list(checksums), ['new.dcm'])
+        self.assertEqual(os.listdir(target), ['new.dcm'])
+        # The previous directory is deleted in the background
+        for thread in threading.enumerate():
+            if thread.name == 'arcana-remove':
+                thread.join()
+        self.assertEqual(os.listdir(op.join(self.tmp_dir, 'repo')),
+                         ['dicom'])
+        # Failed transfers leave the existing directory in place
+        os.chmod(op.join(src_dir, 'new.dcm'), 0)
+        if not os.access(op.join(src_dir, 'new.dcm'), os.R_OK):
+            with self.assertRaises(OSError):
+                fileset.transfer_to(target)
+            self.assertEqual(os.listdir(target), ['new.dcm'])
+            self.assertEqual(os.listdir(op.join(self.tmp_dir, 'repo')),
+                             ['dicom'])
+
+
+class TestFormatDetection(TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def test_detect_format(self):
+        json_format = FileFormat(name='json', extension='.json')
+        candidates = [dicom_format, json_format, text_format]
+        text_path = op.join(self.tmp_dir, 'a.txt')
+        dicom_path = op.join(self.tmp_dir, 'dicom')
+        os.mkdir(dicom_path)
+        for path in (text_path, op.join(dicom_path, '1.dcm')):
+            with open(path, 'w') as f:
+                f.write('content')
+        for path, expected in ((text_path, text_format),
+                               (dicom_path, dicom_format)):
+            fileset = Fileset.from_path(path)
+            self.assertEqual(fileset.detect_format(candidates), expected)
+            # Matches the first candidate in the same way as 'matches'
+            self.assertEqual(
+                next(c for c in candidates if c.matches(fileset)), expected)
+            # Memoised results are returned while the path is unmodified
+            self.assertIs(FileFormat.detect(fileset, candidates), expected)
+        self.assertIsNone(FileFormat.detect(Fileset.from_path(text_path),
+                                            [json_format, dicom_format]))
+        # Modifications to the contents of directories are detected
+        with open(op.join(dicom_path, '2.txt'), 'w') as f:
+            f.write('content')
+        mtime = op.getmtime(dicom_path) + 10
+        os.utime(dicom_path, (mtime, mtime))
+        self.assertIsNone(FileFormat.detect(Fileset.from_path(dicom_path),
+                                            candidates))
+
+
 class TestMatchAnalysis(with_metaclass(AnalysisMetaClass, Analysis)):
 
     add_data_specs = [
@@ -163,6 +396,84 @@ class TestDicomTagMatch(BaseTestCase):
         self.assertEqual(mag.name, 'gre_field_mapping_3mm_mag')
 
 
+class TestDicomHeaderCache(TestCase):
+
+    IMAGE_TYPE_TAG = ('0008', '0008')
+    SERIES_NUMBER_TAG = ('0020', '0011')
+
+    def setUp(self):
+        self.work_dir = tempfile.mkdtemp()
+        self.dataset_dir = op.join(self.work_dir, 'dataset')
+        for series_number, (name, image_type) in enumerate([
+                ('gre_phase', ['ORIGINAL', 'PRIMARY', 'P', 'ND']),
+                ('gre_mag', ['ORIGINAL', 'PRIMARY', 'M', 'ND'])]):
+            series_dir = op.join(self.dataset_dir, name)
+            os.makedirs(series_dir)
+            for i in range(3):
+                self._write_dicom(op.join(series_dir, '{}.dcm'.format(i)),
+                                  image_type, series_number)
+
+    def tearDown(self):
+        shutil.rmtree(self.work_dir, ignore_errors=True)
+
+    def _write_dicom(self, path, image_type, series_number):
+        meta = pydicom.dataset.FileMetaDataset()
+        meta.MediaStorageSOPClassUID = pydicom.uid.generate_uid()
+        meta.MediaStorageSOPInstanceUID = pydicom.uid.generate_uid()
+        meta.TransferSyntaxUID = pydicom.uid.ExplicitVRLittleEndian
+        dcm = pydicom.dataset.FileDataset(path, {}, file_meta=meta,
+                                          preamble=b'\0' * 128)
+        dcm.ImageType = image_type
+        dcm.SeriesNumber = series_number
+        dcm.PixelData = b'\0' * 64
+        dcm.save_as(path, enforce_file_format=True)
+
+    def test_dicom_tag_match(self):
+        dataset = Dataset(self.dataset_dir)
+        fileset_slice = FilesetFilter(
+            'gre_phase', 'gre_.*', dicom_format, is_regex=True,
+            dicom_tags={self.IMAGE_TYPE_TAG: ['ORIGINAL', 'PRIMARY', 'P',
+                                              'ND']}).match(dataset.tree)
+        self.assertEqual([f.name for f in fileset_slice], ['gre_phase'])
+        # The headers of all candidates were cached when they were matched
+        cache = DicomHeaderCache.for_dataset(dataset)
+        mag = next(iter(dataset.tree.sessions)).fileset('gre_mag')
+        self.assertEqual(
+            list(cache.lookup(mag, [self.IMAGE_TYPE_TAG]).values()),
+            [['ORIGINAL', 'PRIMARY', 'M', 'ND']])
+        self.assertIsNone(cache.lookup(mag, [self.SERIES_NUMBER_TAG]))
+
+    def test_format_dicom_values(self):
+        # The DICOM values are read by the format when it defines how to
+        dataset = Dataset(self.dataset_dir)
+        fileset_slice = FilesetFilter(
+            'gre_phase', 'gre_.*', RelabelledDicomFormat(
+                name='relabelled_dicom', extension=None, directory=True,
+                within_dir_exts=['.dcm']),
+            is_regex=True,
+            dicom_tags={self.IMAGE_TYPE_TAG: 'gre_mag'}).match(dataset.tree)
+        self.assertEqual([f.name for f in fileset_slice], ['gre_mag'])
+
+    def test_persistent_cache(self):
+        cache_dir = op.join(self.work_dir, 'cache')
+        fileset = next(iter(
+            Dataset(self.dataset_dir).tree.sessions)).fileset('gre_mag')
+        fileset.format = dicom_format
+        DicomHeaderCache(cache_dir).prefetch(
+            [fileset], [self.IMAGE_TYPE_TAG, self.SERIES_NUMBER_TAG])
+        cache = DicomHeaderCache(cache_dir)
+        self.assertEqual(
+            cache.values(fileset, [self.SERIES_NUMBER_TAG]), [1])
+        # Modified filesets are read again
+        for i in range(3):
+            self._write_dicom(
+                op.join(self.dataset_dir, 'gre_mag', '{}.dcm'.format(i)),
+                ['DERIVED'], 1)
+        self.assertIsNone(cache.lookup(fileset, [self.IMAGE_TYPE_TAG]))
+        self.assertEqual(cache.values(fileset, [self.IMAGE_TYPE_TAG]),
+                         ['DERIVED'])
+
+
 class TestDerivableAnalysis(with_metaclass(AnalysisMetaClass, Analysis)):
 
     add_data_specs = [